@@ -0,0 +1,76 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Memory held by a full LumberBuffer (a deque of str) against a
+CompactLumberBuffer holding the same lines, for a few line widths.
+
+    python benchmarks/buffer_memory.py --lines=100000 --widths=40,120,1000
+"""
+from __future__ import print_function
+
+import os
+import sys
+import optparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lumberjack.models import LumberBuffer, CompactLumberBuffer
+
+
+opt_list = [
+    optparse.make_option('-n', '--lines', action="store", type="int",
+                         dest="lines", default=100000,
+                         help="Lines to keep. Default: 100000"),
+    optparse.make_option('-w', '--widths', action="store", type="string",
+                         dest="widths", default="40,120,1000",
+                         help="Comma separated line widths to try"),
+    optparse.make_option('-b', '--batch', action="store", type="int",
+                         dest="batch", default=50,
+                         help="Lines per append. Default: 50"),
+    ]
+
+
+def measure(make_buffer, make_lines, batch):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    buf = make_buffer()
+    lines = make_lines()
+    for i in range(0, len(lines), batch):
+        buf.append_list(lines[i:i+batch])
+    del lines # only count what the buffer holds on to
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, len(buf)
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    print('width\tlines\tdeque_bytes\tcompact_bytes\tdeque_per_line\tcompact_per_line')
+    for width in [ int(w) for w in opts.widths.split(',') ]:
+        def make_lines():
+            return [ ('%08d ' % i).ljust(width, 'x') for i in range(opts.lines) ]
+        payload = opts.lines * width
+
+        old, n = measure(lambda: LumberBuffer(maxlen=opts.lines),
+                         make_lines, opts.batch)
+        new, m = measure(lambda: CompactLumberBuffer(max_bytes=payload),
+                         make_lines, opts.batch)
+        assert n == m == opts.lines
+        print('%d\t%d\t%d\t%d\t%.1f\t%.1f' % (width, n, old, new,
+                                            float(old) / n, float(new) / m))
+
+
+if __name__ == '__main__':
+    main()
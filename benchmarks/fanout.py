@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Per-append cost of LumberBuffer fan-out against the number of subscribers.
+
+"before" subscribers encode the lines themselves, the way LumberHandler and
+LumberSocket used to; "after" subscribers share the buffer's Frame.
+
+    python benchmarks/fanout.py --lines=20 --subscribers=1,10,100,500
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lumberjack.models import LumberBuffer
+from lumberjack.util import serialize
+
+
+opt_list = [
+    optparse.make_option('-n', '--lines', action="store", type="int",
+                         dest="lines", default=20,
+                         help="Lines per append. Default: 20"),
+    optparse.make_option('-w', '--width', action="store", type="int",
+                         dest="width", default=120,
+                         help="Characters per line. Default: 120"),
+    optparse.make_option('-s', '--subscribers', action="store", type="string",
+                         dest="subscribers", default="1,10,100,500",
+                         help="Comma separated subscriber counts to try"),
+    optparse.make_option('-r', '--repeat', action="store", type="int",
+                         dest="repeat", default=200,
+                         help="Appends per measurement. Default: 200"),
+    ]
+
+
+def sink(payload):
+    pass
+
+
+def before(frame):
+    sink(serialize(dict(logs=frame.data['logs'])))
+
+
+def after_http(frame):
+    sink(frame.json)
+
+
+def after_websocket(frame):
+    sink(frame.websocket)
+
+
+def per_append(callbacks, subscribers, lines, repeat):
+    buf = LumberBuffer(maxlen=200)
+    for i in range(subscribers):
+        buf.subscribe(i, callbacks[i % len(callbacks)])
+    seconds = timeit.timeit(lambda: buf.append_list(lines), number=repeat)
+    return seconds / repeat * 1e6 # microseconds
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    lines = [ ('%06d ' % i).ljust(opts.width, 'x') for i in range(opts.lines) ]
+
+    print('subscribers\tbefore_us\tafter_us\tspeedup')
+    for n in [ int(s) for s in opts.subscribers.split(',') ]:
+        old = per_append([before], n, lines, opts.repeat)
+        new = per_append([after_http, after_websocket], n, lines, opts.repeat)
+        print('%d\t%.1f\t%.1f\t%.1fx' % (n, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+What the benchmarks share: starting and stopping a real lumberjack, writing
+timestamped lines at a steady rate, and measuring what it all cost.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('lumberjack never came up on port %d' % port)
+
+
+def start_lumberjack(port, paths, *args, **kwargs):
+    """
+    A lumberjack on port tailing paths, in a process group of its own so
+    stop_lumberjack() gets any workers too. args are extra command line
+    options. Returns once it's listening.
+    """
+    server = subprocess.Popen(
+        [ sys.executable, '-c', 'import lumberjack; lumberjack.main()',
+          '--listenport=%d' % port, '--logging=warning' ] + list(args) + list(paths),
+        cwd=ROOT, preexec_fn=os.setsid )
+    try:
+        wait_for_port(port, kwargs.get('timeout', 15))
+    except RuntimeError:
+        stop_lumberjack(server)
+        raise
+    return server
+
+
+def stop_lumberjack(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    server.wait()
+
+
+def write_lines(path, rate, duration, width=120, tick=0.01):
+    """
+    Append rate lines a second to path for duration seconds, each starting
+    with the time it was written and a count, padded out to width. Returns
+    how many were written.
+    """
+    written = 0
+    per_tick = max(int(rate * tick), 1)
+    start = time.time()
+    with open(path, 'a') as f:
+        while time.time() - start < duration:
+            now = time.time()
+            f.write(''.join( ('%.6f %09d ' % (now, written + i)).ljust(width, 'x') + '\n'
+                             for i in range(per_tick) ))
+            f.flush()
+            written += per_tick
+            time.sleep(max(tick - (time.time() - now), 0))
+    return written
+
+
+def line_latency(line, now):
+    """Seconds since a line from write_lines was written"""
+    return now - float(line.split(' ', 1)[0])
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """{'p50': ..., 'max': ...} of values, or Nones if there aren't any"""
+    values = sorted(values)
+    result = dict( ('p%d' % p, values[min(int(len(values) * p / 100.0), len(values) - 1)]
+                    if values else None)
+                   for p in points )
+    result['max'] = values[-1] if values else None
+    return result
+
+
+def _group_stats(pgid):
+    """(pid, /proc/<pid>/stat fields after the command) in a process group"""
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                # the command can have spaces in it, but it's in parentheses
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if int(fields[2]) == pgid:
+            yield pid, fields
+
+
+def group_usage(pgid):
+    """
+    (cpu seconds, resident bytes) summed over every process in a process
+    group, from /proc. (None, None) where there's no /proc.
+    """
+    if not os.path.isdir('/proc'):
+        return None, None
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu, rss = 0.0, 0
+    for pid, fields in _group_stats(pgid):
+        cpu += (int(fields[11]) + int(fields[12])) / float(ticks)
+        rss += int(fields[21]) * page
+    return cpu, rss
+
+
+def group_syscalls(pgid):
+    """
+    (read syscalls, write syscalls) summed over every process in a process
+    group, from /proc/<pid>/io. Sends and receives count too. (None, None)
+    where there's no /proc.
+    """
+    if not os.path.isdir('/proc'):
+        return None, None
+    reads, writes = 0, 0
+    for pid, fields in _group_stats(pgid):
+        try:
+            with open('/proc/%s/io' % pid) as f:
+                io = dict( line.split(':') for line in f.read().splitlines() )
+        except (IOError, OSError, ValueError):
+            continue
+        reads += int(io.get('syscr', 0))
+        writes += int(io.get('syscw', 0))
+    return reads, writes
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
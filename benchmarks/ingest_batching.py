@@ -0,0 +1,163 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+What ingest micro-batching saves under a writer making lots of small
+writes. For each --ingest_flush_interval in --intervals, starts a
+lumberjack tailing one file with --websocket consumers, appends --rate
+lines a second a few lines at a time, and reports the lumberjack's CPU
+and syscalls per line written, alongside the latency it costs. Frames per
+line (lumberjack_ingest_batches_total over lines written) is each
+client's share of the writes, for kernels that don't count socket sends
+in /proc/<pid>/io.
+
+    python benchmarks/ingest_batching.py --rate=20000 --websocket=20 \\
+        --intervals=0,0.02,0.05,0.1
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import optparse
+import multiprocessing
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+import harness
+import load
+
+
+opt_list = [
+    optparse.make_option('-r', '--rate', action="store", type="int",
+                         dest="rate", default=20000,
+                         help="Lines a second. Default: 20000"),
+    optparse.make_option('-t', '--tick', action="store", type="float",
+                         dest="tick", default=0.001,
+                         help="Seconds between the writer's writes. "+
+                         "Default: 0.001"),
+    optparse.make_option('-w', '--width', action="store", type="int",
+                         dest="width", default=120,
+                         help="Characters per line. Default: 120"),
+    optparse.make_option('-d', '--duration', action="store", type="float",
+                         dest="duration", default=5,
+                         help="Seconds to write for, per interval. Default: 5"),
+    optparse.make_option('--websocket', action="store", type="int",
+                         dest="websocket", default=20,
+                         help="Websocket consumers. Default: 20"),
+    optparse.make_option('-i', '--intervals', action="store", type="string",
+                         dest="intervals", default="0,0.02,0.05,0.1",
+                         help="Comma separated --ingest_flush_interval "+
+                         "values to try. Default: 0,0.02,0.05,0.1"),
+    optparse.make_option('-p', '--port', action="store", type="int",
+                         dest="port", default=18160,
+                         help="Port to run lumberjack on. Default: 18160"),
+    optparse.make_option('-o', '--output', action="store", type="string",
+                         dest="output", default="",
+                         help="Write the JSON here as well as to stdout"),
+    ]
+
+
+def batches(port):
+    """lumberjack_ingest_batches_total, summed over files"""
+    text = urlopen('http://127.0.0.1:%d/metrics' % port).read().decode('utf-8')
+    return sum( float(line.rsplit(' ', 1)[1]) for line in text.splitlines()
+                if line.startswith('lumberjack_ingest_batches_total{') )
+
+
+def measure(opts, interval):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'ingest.log')
+    open(path, 'w').close()
+
+    server = harness.start_lumberjack(opts.port, [path],
+                                      '--ingest_flush_interval=%s' % interval)
+    client = None
+    try:
+        ready, stop, results = ( multiprocessing.Queue(), multiprocessing.Event(),
+                                 multiprocessing.Queue() )
+        client = multiprocessing.Process(
+            target=load.consume,
+            args=('websocket',
+                  load.urls_for('websocket', opts.websocket, opts.port, [path]),
+                  10, ready, stop, results) )
+        client.start()
+        ready.get(timeout=60)
+
+        cpu_before, rss = harness.group_usage(server.pid)
+        reads_before, writes_before = harness.group_syscalls(server.pid)
+        batches_before = batches(opts.port)
+        start = time.time()
+        written = harness.write_lines(path, opts.rate, opts.duration,
+                                      opts.width, tick=opts.tick)
+        time.sleep(max(interval, 0.1) * 2) # for the last batch to go out
+        seconds = time.time() - start
+        cpu_after, rss = harness.group_usage(server.pid)
+        reads_after, writes_after = harness.group_syscalls(server.pid)
+        batches_after = batches(opts.port)
+        time.sleep(1)
+
+        stop.set()
+        kind, stats = results.get(timeout=60)
+        client.join()
+    finally:
+        if client is not None and client.is_alive():
+            client.terminate()
+        harness.stop_lumberjack(server)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    latency = harness.percentiles(stats['latencies'])
+    result = dict(
+        interval=interval,
+        seconds=seconds,
+        written=written,
+        delivered=stats['lines'] / float(written * opts.websocket),
+        frames_per_line=(batches_after - batches_before) / float(written),
+        latency_ms=dict( (k, v * 1000 if v is not None else None)
+                         for k, v in latency.items() ) )
+    if cpu_before is not None:
+        result.update(
+            cpu_us_per_line=(cpu_after - cpu_before) * 1e6 / written,
+            read_syscalls_per_line=(reads_after - reads_before) / float(written),
+            write_syscalls_per_line=(writes_after - writes_before) / float(written) )
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    runs = list()
+    for interval in opts.intervals.split(','):
+        runs.append(measure(opts, float(interval)))
+        print('interval %(interval)gs: %(frames_per_line).3f frames/line, '
+              'p50 latency %(p50).1fms' % dict(runs[-1], **runs[-1]['latency_ms']))
+
+    report = dict(
+        commit=harness.git_commit(),
+        time=time.time(),
+        options=opts.__dict__,
+        runs=runs )
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
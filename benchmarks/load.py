@@ -0,0 +1,277 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+End-to-end load test, with results as JSON to diff between commits.
+
+Starts a lumberjack tailing --files scratch files and a writer process per
+file appending timestamped lines at --rate. Every kind of consumer gets its
+own client process:
+
+    http       the JSON stream, GET /<file>
+    websocket  /<file>/socket
+    proxied    /127.0.0.1/<file>/socket: the lumberjack proxying from
+               itself, so through a shared upstream and back out
+    sluice     a Sluice with a parser that only times lines
+
+Consumers are spread across the files. Reports, per kind, how many of the
+lines it should have seen arrived, lines a second, and write-to-receive
+latency percentiles, plus the lumberjack's CPU and memory.
+
+    python benchmarks/load.py --rate=2000 --http=50 --websocket=50 \\
+        --proxied=10 --sluice=5 --output=before.json
+    git stash; python benchmarks/load.py ... --output=after.json
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import optparse
+import platform
+import multiprocessing
+
+import harness
+
+KINDS = ('http', 'websocket', 'proxied', 'sluice')
+
+opt_list = [
+    optparse.make_option('-f', '--files', action="store", type="int",
+                         dest="files", default=1,
+                         help="Files, each with its own writer. Default: 1"),
+    optparse.make_option('-r', '--rate', action="store", type="int",
+                         dest="rate", default=1000,
+                         help="Lines a second per file. Default: 1000"),
+    optparse.make_option('-w', '--width', action="store", type="int",
+                         dest="width", default=120,
+                         help="Characters per line. Default: 120"),
+    optparse.make_option('-d', '--duration', action="store", type="float",
+                         dest="duration", default=10,
+                         help="Seconds to write for. Default: 10"),
+    optparse.make_option('--http', action="store", type="int",
+                         dest="http", default=10,
+                         help="HTTP stream consumers. Default: 10"),
+    optparse.make_option('--websocket', action="store", type="int",
+                         dest="websocket", default=10,
+                         help="Websocket consumers. Default: 10"),
+    optparse.make_option('--proxied', action="store", type="int",
+                         dest="proxied", default=2,
+                         help="Consumers of the file proxied. Default: 2"),
+    optparse.make_option('--sluice', action="store", type="int",
+                         dest="sluice", default=2,
+                         help="Sluices. Default: 2"),
+    optparse.make_option('--sample', action="store", type="int",
+                         dest="sample", default=10,
+                         help="Time every nth line received. Default: 10"),
+    optparse.make_option('--lumberjack-args', action="store", type="string",
+                         dest="lumberjack_args", default="",
+                         help="Extra options for the lumberjack, e.g. "+
+                         "'--workers=2 --compression_level=0'"),
+    optparse.make_option('-p', '--port', action="store", type="int",
+                         dest="port", default=18150,
+                         help="Port to run lumberjack on. Default: 18150"),
+    optparse.make_option('-o', '--output', action="store", type="string",
+                         dest="output", default="",
+                         help="Write the JSON here as well as to stdout"),
+    ]
+
+
+def consume(kind, urls, sample, ready, stop, results):
+    """Hold a consumer of kind open on each of urls until stop is set"""
+    import tornado.gen
+    import tornado.ioloop
+    import tornado.websocket
+    from lumberjack.framing import LineFramer
+    from lumberjack.sluice.models import Sluice
+    from lumberjack.sluice.stream import HTTPStream
+
+    stats = dict(lines=0, bytes=0, latencies=list(), connected=0)
+
+    def received(logs):
+        now = time.time()
+        stats['lines'] += len(logs)
+        stats['latencies'].extend( harness.line_latency(line, now)
+                                   for line in logs[::sample] )
+
+    def http_consumer(url):
+        framer = LineFramer(max_line_length=256 * 1024 * 1024)
+        def on_chunk(chunk):
+            stats['bytes'] += len(chunk)
+            for document in framer.feed(chunk):
+                if document:
+                    received(json.loads(document)['logs'])
+        stream = HTTPStream(url, on_chunk, headers=dict(Accept='application/json'))
+        tornado.ioloop.IOLoop.current().add_future(stream.start(), lambda f: None)
+        return stream
+
+    @tornado.gen.coroutine
+    def websocket_consumer(url):
+        conn = yield tornado.websocket.websocket_connect(url)
+        @tornado.gen.coroutine
+        def read():
+            while True:
+                message = yield conn.read_message()
+                if message is None:
+                    return
+                stats['bytes'] += len(message)
+                received(json.loads(message)['logs'])
+        tornado.ioloop.IOLoop.current().spawn_callback(read)
+        raise tornado.gen.Return(conn)
+
+    def sluice_consumer(url):
+        def parser(data):
+            received(data['logs'])
+        return Sluice(url, parser).open()
+
+    @tornado.gen.coroutine
+    def run():
+        conns = list()
+        for url in urls:
+            if kind == 'http':
+                conns.append(http_consumer(url))
+            elif kind == 'sluice':
+                conns.append(sluice_consumer(url))
+            else:
+                conn = yield websocket_consumer(url)
+                conns.append(conn)
+            stats['connected'] += 1
+        # the initial backlog isn't part of the measurement
+        yield tornado.gen.sleep(0.5)
+        stats['lines'], stats['bytes'], stats['latencies'] = 0, 0, list()
+        if kind == 'sluice':
+            # sluices count their own bytes
+            stats['bytes'] = -sum( conn.stats.raw_received for conn in conns )
+        ready.put(kind)
+        while not stop.is_set():
+            yield tornado.gen.sleep(0.1)
+        if kind == 'sluice':
+            stats['bytes'] += sum( conn.stats.raw_received for conn in conns )
+        for conn in conns:
+            conn.close()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    results.put( (kind, stats) )
+
+
+def urls_for(kind, count, port, paths):
+    from lumberjack.util import slug
+    urls = list()
+    for i in range(count):
+        name = slug(paths[i % len(paths)])
+        if kind in ('http', 'sluice'):
+            urls.append('http://127.0.0.1:%d/%s' % (port, name))
+        elif kind == 'websocket':
+            urls.append('ws://127.0.0.1:%d/%s/socket' % (port, name))
+        else:
+            urls.append('ws://127.0.0.1:%d/127.0.0.1/%s/socket' % (port, name))
+    return urls
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    paths = [ os.path.join(tmp, 'load_%d.log' % i) for i in range(opts.files) ]
+    for path in paths:
+        open(path, 'w').close()
+
+    server = harness.start_lumberjack(opts.port, paths,
+                                      *opts.lumberjack_args.split())
+    clients = list()
+    try:
+        time.sleep(0.5) # for any workers to reach the ingest bus
+        ready, stop, results = ( multiprocessing.Queue(), multiprocessing.Event(),
+                                 multiprocessing.Queue() )
+        for kind in KINDS:
+            count = getattr(opts, kind)
+            if not count:
+                continue
+            clients.append( (kind, count, multiprocessing.Process(
+                target=consume,
+                args=(kind, urls_for(kind, count, opts.port, paths),
+                      opts.sample, ready, stop, results) )) )
+        for kind, count, client in clients:
+            client.start()
+        for client in clients:
+            ready.get(timeout=60)
+
+        pool = multiprocessing.Pool(len(paths))
+        cpu_before, rss = harness.group_usage(server.pid)
+        rss_max = rss
+        start = time.time()
+        writing = [ pool.apply_async(harness.write_lines,
+                                     (path, opts.rate, opts.duration, opts.width))
+                    for path in paths ]
+        while not all( w.ready() for w in writing ):
+            time.sleep(0.5)
+            cpu, rss = harness.group_usage(server.pid)
+            if rss is not None:
+                rss_max = max(rss_max, rss)
+        seconds = time.time() - start
+        cpu_after, rss_end = harness.group_usage(server.pid)
+        written = [ w.get() for w in writing ]
+        pool.close()
+        time.sleep(2) # let the stragglers arrive
+
+        stop.set()
+        stats = dict( results.get(timeout=60) for client in clients )
+        for kind, count, client in clients:
+            client.join()
+    finally:
+        for kind, count, client in clients:
+            if client.is_alive():
+                client.terminate()
+        harness.stop_lumberjack(server)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    consumers = dict()
+    for kind, count, client in clients:
+        s = stats[kind]
+        # consumer i watches file i % files
+        expected = sum( written[i % len(paths)] for i in range(count) )
+        latency = harness.percentiles(s['latencies'])
+        consumers[kind] = dict(
+            consumers=count,
+            connected=s['connected'],
+            lines=s['lines'],
+            delivered=s['lines'] / float(expected) if expected else None,
+            lines_per_s=s['lines'] / seconds,
+            bytes_per_s=s['bytes'] / seconds,
+            latency_ms=dict( (k, v * 1000 if v is not None else None)
+                             for k, v in latency.items() ) )
+
+    report = dict(
+        commit=harness.git_commit(),
+        time=time.time(),
+        python=platform.python_version(),
+        options=opts.__dict__,
+        seconds=seconds,
+        written=dict(lines=sum(written), lines_per_s=sum(written) / seconds),
+        server=dict(
+            cpu_seconds=(cpu_after - cpu_before) if cpu_before is not None else None,
+            cpu_percent=(cpu_after - cpu_before) * 100 / seconds
+                        if cpu_before is not None else None,
+            rss_max_bytes=rss_max,
+            rss_end_bytes=rss_end ),
+        consumers=consumers )
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Thousands of in-process Fellows checking in against a local lodge.
+
+Measures check-ins per second, first with lumberfiles and then as deltas
+without them, then the same fellows forwarded through regional lodges in
+batches, and finally how long listings take: the whole lodge, a revalidated
+(304) copy, a page, and a search.
+
+    python benchmarks/lodge_sim.py --fellows=5000 --files=5 --regions=10
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import socket
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
+import tornado.httpclient
+
+import lumberjack # defines the options the models read
+from lumberjack.handlers import LodgeHandler
+from lumberjack.models import Lodge, Fellow, AttrBag
+from lumberjack.util import serialize, slug
+
+
+opt_list = [
+    optparse.make_option('-n', '--fellows', action="store", type="int",
+                         dest="fellows", default=2000,
+                         help="Fellows checking in. Default: 2000"),
+    optparse.make_option('-f', '--files', action="store", type="int",
+                         dest="files", default=5,
+                         help="Lumberfiles per fellow. Default: 5"),
+    optparse.make_option('-c', '--concurrency', action="store", type="int",
+                         dest="concurrency", default=50,
+                         help="Check-ins in flight at once. Default: 50"),
+    optparse.make_option('-r', '--regions', action="store", type="int",
+                         dest="regions", default=10,
+                         help="Regional lodges to forward through. Default: 10"),
+    optparse.make_option('-l', '--listings', action="store", type="int",
+                         dest="listings", default=50,
+                         help="Requests per listing measurement. Default: 50"),
+    ]
+
+
+def make_fellow(i, files):
+    paths = [ '/var/log/app%d/%d.log' % (i % 97, j) for j in range(files) ]
+    return Fellow( name='host-%05d' % i,
+                   lumberfiles=[ AttrBag(path=p, slug=slug(p)) for p in paths ] )
+
+
+@tornado.gen.coroutine
+def check_in_all(client, url, bodies, concurrency):
+    """Seconds to POST every body, concurrency at a time"""
+    start = time.time()
+    for i in range(0, len(bodies), concurrency):
+        yield [ client.fetch(url, method='POST', body=body)
+                for body in bodies[i:i+concurrency] ]
+    raise tornado.gen.Return(time.time() - start)
+
+
+@tornado.gen.coroutine
+def latency(client, url, repeat, **kwargs):
+    """(median, worst) milliseconds to fetch url"""
+    times = list()
+    for i in range(repeat):
+        start = time.time()
+        yield client.fetch(url, raise_error=False, **kwargs)
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    raise tornado.gen.Return( (times[len(times) // 2], times[-1]) )
+
+
+@tornado.gen.coroutine
+def simulate(opts, port):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=opts.concurrency)
+    url = 'http://127.0.0.1:%d/lodge' % port
+    fellows = [ make_fellow(i, opts.files) for i in range(opts.fellows) ]
+
+    print('phase\tcheck_ins\tseconds\tper_second')
+    full = [ serialize(f) for f in fellows ]
+    seconds = yield check_in_all(client, url, full, opts.concurrency)
+    print('full\t%d\t%.2f\t%.0f' % (len(full), seconds, len(full) / seconds))
+
+    deltas = list()
+    for f in fellows:
+        body = f._serialize()
+        del body['lumberfiles']
+        deltas.append(serialize(body))
+    seconds = yield check_in_all(client, url, deltas, opts.concurrency)
+    print('delta\t%d\t%.2f\t%.0f' % (len(deltas), seconds, len(deltas) / seconds))
+
+    if opts.regions:
+        regions = [ Lodge([Fellow(name='region-%d' % r, lumberfiles=[])],
+                          check_in=False, parent='127.0.0.1:%d' % port)
+                    for r in range(opts.regions) ]
+        start = time.time()
+        for i, fellow in enumerate(fellows):
+            regions[i % len(regions)].check_in(fellow)
+        yield [ region.forward_to_parent() for region in regions ]
+        # and again, now the root has everyone's files
+        for i, fellow in enumerate(fellows):
+            regions[i % len(regions)].check_in(fellow)
+        yield [ region.forward_to_parent() for region in regions ]
+        seconds = time.time() - start
+        print('regional\t%d\t%.2f\t%.0f' % (2 * len(fellows), seconds,
+                                           2 * len(fellows) / seconds))
+
+    print()
+    print('listing\tmedian_ms\tworst_ms')
+    response = yield client.fetch(url)
+    etag = response.headers['ETag']
+    for name, listing_url, kwargs in (
+            ('whole lodge', url, dict()),
+            ('revalidated', url, dict(headers={'If-None-Match': etag})),
+            ('page of 50', url + '?offset=%d&limit=50' % (opts.fellows // 2), dict()),
+            ('search', url + '?q=app42&limit=50', dict()) ):
+        median, worst = yield latency(client, listing_url, opts.listings, **kwargs)
+        print('%s\t%.2f\t%.2f' % (name, median, worst))
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    lodge = Lodge([Fellow(name='root', lumberfiles=[])], check_in=False)
+    app = tornado.web.Application([ (r'/lodge/?', LodgeHandler, dict(lodge=lodge)) ])
+    sockets = tornado.netutil.bind_sockets(0, '127.0.0.1', family=socket.AF_INET)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+
+    tornado.ioloop.IOLoop.current().run_sync(
+        lambda: simulate(opts, sockets[0].getsockname()[1]))
+
+
+if __name__ == '__main__':
+    main()
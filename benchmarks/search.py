@@ -0,0 +1,160 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+What a search index costs on the way in and saves on the way out.
+
+Fills a buffer of --lines made-up log lines, with and without a
+SearchIndex, each in a process of its own. Reports the time to append a
+line, the memory the buffer takes on top of the lines themselves, and how
+long each kind of query takes:
+
+    rare     a request id that's on a handful of lines
+    common   a log level that's on a tenth of them
+    absent   words that are each common, but never together
+    short    two letters, which the index can't help with
+
+It also reports the longest the ioloop went without getting round to
+other callbacks while they ran, which streaming clients would notice.
+
+    python benchmarks/search.py --lines=1000000
+"""
+from __future__ import print_function
+
+import os
+import time
+import random
+import optparse
+import multiprocessing
+
+import harness
+
+opt_list = [
+    optparse.make_option('-n', '--lines', action="store", type="int",
+                         dest="lines", default=1000000,
+                         help="Lines in the buffer. Default: 1000000"),
+    optparse.make_option('-b', '--batch', action="store", type="int",
+                         dest="batch", default=100,
+                         help="Lines appended at a time. Default: 100"),
+    optparse.make_option('-q', '--queries', action="store", type="int",
+                         dest="queries", default=20,
+                         help="Times to run each query. Default: 20"),
+    optparse.make_option('-l', '--limit', action="store", type="int",
+                         dest="limit", default=100,
+                         help="Matches asked for. Default: 100"),
+    optparse.make_option('--no-scan', action="store_false",
+                         dest="scan", default=True,
+                         help="Skip the unindexed buffer, which is slow to search"),
+    ]
+
+LEVELS = ['INFO'] * 6 + ['DEBUG'] * 3 + ['ERROR']
+MODULES = ['db.pool', 'http.server', 'cache', 'worker.queue', 'auth', 'scheduler']
+
+
+def make_lines(count, seed=1):
+    rand = random.Random(seed)
+    words = [ ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz')
+                      for _ in range(rand.randint(3, 9)))
+              for _ in range(5000) ]
+    for i in range(count):
+        yield '2024-05-01T%02d:%02d:%02d.%03dZ %s [%s] req=%08x user=%d %s' % (
+            i // 3600000 % 24, i // 60000 % 60, i // 1000 % 60, i % 1000,
+            rand.choice(LEVELS), rand.choice(MODULES), rand.getrandbits(32),
+            rand.randint(1, 50000),
+            ' '.join( rand.choice(words) for _ in range(rand.randint(4, 14)) ))
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(indexed, opts, results):
+    import tornado.gen
+    import tornado.ioloop
+    from lumberjack.models import LumberBuffer
+    from lumberjack.search import SearchIndex
+
+    lines = list(make_lines(opts.lines))
+    rare = lines[len(lines) // 2].split()[3] # a req=<id>
+    queries = [ ('rare', rare), ('common', 'error'),
+                ('absent', 'scheduler] req=ffff'), ('short', 'zq') ]
+
+    before = rss()
+    buf = LumberBuffer(maxlen=opts.lines,
+                       index=SearchIndex(share_lines=True) if indexed else None)
+    start = time.time()
+    for i in range(0, len(lines), opts.batch):
+        buf.append_list(lines[i:i + opts.batch])
+    ingest = time.time() - start
+    memory = rss() - before
+    del lines
+
+    @tornado.gen.coroutine
+    def run():
+        # a callback that keeps asking to be run again straight away
+        io_loop = tornado.ioloop.IOLoop.current()
+        lag = dict(max=0.0, last=time.time(), running=True)
+        def tick():
+            now = time.time()
+            lag['max'] = max(lag['max'], now - lag['last'])
+            lag['last'] = now
+            if lag['running']:
+                io_loop.add_callback(tick)
+        tick()
+
+        timings = dict()
+        for name, query in queries:
+            seconds = list()
+            for i in range(opts.queries):
+                start = time.time()
+                result = yield buf.search(query, limit=opts.limit, context=2)
+                seconds.append(time.time() - start)
+            timings[name] = dict(harness.percentiles(seconds),
+                                 matches=len(result['matches']))
+        lag['running'] = False
+        raise tornado.gen.Return( (timings, lag['max']) )
+
+    timings, lag = tornado.ioloop.IOLoop.current().run_sync(run)
+    results.put( (indexed, dict(ingest_us=ingest * 1e6 / opts.lines,
+                                memory=memory, timings=timings, lag=lag)) )
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    report = dict()
+    for indexed in ([ False, True ] if opts.scan else [ True ]):
+        child = multiprocessing.Process(target=measure,
+                                        args=(indexed, opts, results))
+        child.start()
+        key, report[key] = results.get()
+        child.join()
+
+    print('buffer\tus_per_line\tmemory_mb\tmax_lag_ms')
+    for indexed, r in sorted(report.items()):
+        print('%s\t%.1f\t%.0f\t%.1f' % (indexed and 'indexed' or 'scan',
+                                        r['ingest_us'], r['memory'] / 1e6,
+                                        r['lag'] * 1000))
+    print()
+    print('buffer\tquery\tmatches\tp50_ms\tp99_ms\tmax_ms')
+    for indexed, r in sorted(report.items()):
+        for name in ('rare', 'common', 'absent', 'short'):
+            t = r['timings'][name]
+            print('%s\t%s\t%d\t%.2f\t%.2f\t%.2f' % (
+                indexed and 'indexed' or 'scan', name, t['matches'],
+                t['p50'] * 1000, t['p99'] * 1000, t['max'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+What a bulk-insert sink costs per line, with and without sluice batching.
+
+Starts a lumberjack tailing a scratch file and points two Sluices at it,
+each feeding its own sqlite database that commits on every call, like a
+database or metric store sink would. One gets every message as it comes,
+the other gets batches. Another process appends lines in small bursts, so
+the lumberjack sends lots of small messages. Reports calls into the sink
+and time spent in it per line.
+
+    python benchmarks/sluice_batching.py --lines=20000 --batch-lines=1000
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import signal
+import shutil
+import sqlite3
+import tempfile
+import optparse
+import subprocess
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from harness import wait_for_port
+
+import tornado.gen
+import tornado.ioloop
+
+from lumberjack.sluice.models import Sluice
+from lumberjack.util import slug
+
+
+opt_list = [
+    optparse.make_option('-n', '--lines', action="store", type="int",
+                         dest="lines", default=20000,
+                         help="Lines to push through. Default: 20000"),
+    optparse.make_option('-b', '--burst', action="store", type="int",
+                         dest="burst", default=20,
+                         help="Lines written at a time. Default: 20"),
+    optparse.make_option('--batch-lines', action="store", type="int",
+                         dest="batch_lines", default=1000,
+                         help="batch_lines for the batched sluice. Default: 1000"),
+    optparse.make_option('--batch-latency', action="store", type="float",
+                         dest="batch_latency", default=0.5,
+                         help="batch_latency for the batched sluice. Default: 0.5"),
+    optparse.make_option('-p', '--port', action="store", type="int",
+                         dest="port", default=18099,
+                         help="Port to run lumberjack on. Default: 18099"),
+    optparse.make_option('-t', '--timeout', action="store", type="float",
+                         dest="timeout", default=120,
+                         help="Give up after this many seconds. Default: 120"),
+    ]
+
+
+class Sink(object):
+    """Inserts every line it's handed and commits, timing itself"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE logs (seq INTEGER, line TEXT)')
+        self.calls   = 0
+        self.lines   = 0
+        self.seconds = 0.0
+
+
+    def __call__(self, data):
+        start = time.time()
+        seq = data.get('seq') or 0
+        self.db.executemany('INSERT INTO logs VALUES (?, ?)',
+                            [ (seq + i, line) for i, line in enumerate(data['logs']) ])
+        self.db.commit()
+        self.calls += 1
+        self.lines += len(data['logs'])
+        self.seconds += time.time() - start
+
+
+
+def write_lines(path, count, burst):
+    with open(path, 'a') as f:
+        for i in range(0, count, burst):
+            f.write(''.join( 'line %09d\n' % n
+                             for n in range(i, min(i + burst, count)) ))
+            f.flush()
+            time.sleep(0.001)
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'batching.log')
+    open(path, 'w').close()
+    server = subprocess.Popen(
+        [ sys.executable, '-c', 'import lumberjack; lumberjack.main()',
+          '--listenport=%d' % opts.port, '--logging=warning',
+          '--subscriber_buffer_bytes=%d' % (256 * 1024 * 1024), path ],
+        cwd=ROOT, preexec_fn=os.setsid )
+
+    sinks = [ ('per_message', Sink(os.path.join(tmp, 'per_message.db')), dict()),
+              ('batched', Sink(os.path.join(tmp, 'batched.db')),
+               dict(batch_lines=opts.batch_lines, batch_latency=opts.batch_latency)) ]
+
+    @tornado.gen.coroutine
+    def run():
+        url = 'http://127.0.0.1:%d/%s' % (opts.port, slug(path))
+        sluices = [ Sluice(url, sink, io_loop=tornado.ioloop.IOLoop.current(),
+                           **batching).open()
+                    for name, sink, batching in sinks ]
+        yield tornado.gen.sleep(0.5)
+
+        writer = multiprocessing.Process(target=write_lines,
+                                         args=(path, opts.lines, opts.burst))
+        start = time.time()
+        writer.start()
+        while any( sink.lines + sluice.stats.log_dropped < opts.lines
+                   for (name, sink, b), sluice in zip(sinks, sluices) ) and \
+              time.time() - start < opts.timeout:
+            yield tornado.gen.sleep(0.05)
+        writer.join()
+        for sluice in sluices:
+            sluice.close()
+
+        print('sluice\tlines\tcalls\tlines_per_call\tsink_ms\tus_per_line')
+        for name, sink, batching in sinks:
+            print('%s\t%d\t%d\t%.1f\t%.0f\t%.1f' % (
+                name, sink.lines, sink.calls,
+                sink.lines / float(max(sink.calls, 1)),
+                sink.seconds * 1000,
+                sink.seconds * 1e6 / max(sink.lines, 1) ))
+
+    try:
+        wait_for_port(opts.port)
+        tornado.ioloop.IOLoop.current().run_sync(run)
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Fault injection for sluice checkpoints: counts lines a parser sees twice,
+or never, while its connection keeps dropping and the sluice keeps being
+restarted.
+
+Starts a lumberjack tailing a scratch file and, in front of it, a proxy that
+cuts every connection after a second or few. A `sluice` process with a
+checkpoint file reads through the proxy into a parser that appends each
+line to a file. It's restarted every few seconds, with SIGINT, or SIGKILL
+with --kill, while another process writes numbered lines. At the end the
+parser's file is checked against what was written.
+
+    python benchmarks/sluice_faults.py --lines=3000
+    python benchmarks/sluice_faults.py --no-checkpoint     # to compare
+    python benchmarks/sluice_faults.py --kill              # crashes lose acks
+    python benchmarks/sluice_faults.py --restart-lumberjack=7 --bufferlen=500
+
+SIGINT restarts and dropped connections should show no duplicates. A
+SIGKILL loses up to --checkpoint-interval of acks, which are parsed again.
+
+--restart-lumberjack restarts the lumberjack too. Each time, it reads its
+last --bufferlen lines again as new ones, so expect up to that many
+duplicates per restart, but nothing missing. Without --spill the numbering
+also starts over at 0. The epoch the sluices resume with tells the
+lumberjack that, so it sends them everything it has and they log a reset.
+With --spill the numbering carries on and there are no resets.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import signal
+import shutil
+import tempfile
+import optparse
+import subprocess
+import multiprocessing
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from harness import wait_for_port
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+import tornado.tcpserver
+
+from lumberjack.util import slug
+
+
+opt_list = [
+    optparse.make_option('-n', '--lines', action="store", type="int",
+                         dest="lines", default=3000,
+                         help="Lines to write. Default: 3000"),
+    optparse.make_option('-r', '--rate', action="store", type="int",
+                         dest="rate", default=200,
+                         help="Lines written a second. Default: 200"),
+    optparse.make_option('--restart-every', action="store", type="float",
+                         dest="restart_every", default=4,
+                         help="Seconds between sluice restarts. Default: 4"),
+    optparse.make_option('--cut-after', action="store", type="float",
+                         dest="cut_after", default=1.5,
+                         help="The proxy cuts connections after between this "+
+                         "and twice this many seconds. Default: 1.5"),
+    optparse.make_option('--checkpoint-interval', action="store", type="float",
+                         dest="checkpoint_interval", default=1.0,
+                         help="The sluice's --checkpoint-interval. Default: 1"),
+    optparse.make_option('--no-checkpoint', action="store_false",
+                         dest="checkpoint", default=True,
+                         help="Run the sluice without a checkpoint file"),
+    optparse.make_option('--kill', action="store_true",
+                         dest="kill", default=False,
+                         help="Restart the sluice with SIGKILL, not SIGINT"),
+    optparse.make_option('--restart-lumberjack', action="store", type="float",
+                         dest="restart_lumberjack", default=0,
+                         help="Seconds between lumberjack restarts. "+
+                         "Default: 0, never"),
+    optparse.make_option('--bufferlen', action="store", type="int",
+                         dest="bufferlen", default=0,
+                         help="The lumberjack's --bufferlen, which is also "+
+                         "how much it re-reads on restart. Default: twice "+
+                         "--lines"),
+    optparse.make_option('--spill', action="store_true",
+                         dest="spill", default=False,
+                         help="Give the lumberjack a --spill_dir"),
+    optparse.make_option('-p', '--port', action="store", type="int",
+                         dest="port", default=18100,
+                         help="Port to run lumberjack on, the proxy gets the "+
+                         "next one. Default: 18100"),
+    optparse.make_option('-t', '--timeout', action="store", type="float",
+                         dest="timeout", default=180,
+                         help="Give up after this many seconds. Default: 180"),
+    ]
+
+SLUICE_CONFIG = """
+out = open(%(out)r, 'a')
+
+def parser(data):
+    for line in data['logs']:
+        out.write(line + '\\n')
+    out.flush()
+
+sluice_config = { %(url)r: dict(parser=parser) }
+"""
+
+
+class FlakyProxy(tornado.tcpserver.TCPServer):
+    """Forwards to port, hanging up on each connection after a while"""
+
+    def __init__(self, port, cut_after):
+        super(FlakyProxy, self).__init__()
+        self.port      = port
+        self.cut_after = cut_after
+        self.cuts      = 0
+
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        upstream = yield tornado.tcpclient.TCPClient().connect('127.0.0.1',
+                                                              self.port)
+        def cut():
+            if not stream.closed():
+                self.cuts += 1
+            stream.close()
+            upstream.close()
+        tornado.ioloop.IOLoop.current().call_later(
+            random.uniform(self.cut_after, 2 * self.cut_after), cut)
+        self.pipe(stream, upstream)
+        self.pipe(upstream, stream)
+
+
+    @tornado.gen.coroutine
+    def pipe(self, source, sink):
+        try:
+            while True:
+                data = yield source.read_bytes(65536, partial=True)
+                yield sink.write(data)
+        except tornado.iostream.StreamClosedError:
+            source.close()
+            sink.close()
+
+
+
+def write_lines(path, count, rate):
+    with open(path, 'a') as f:
+        for n in range(count):
+            f.write('line %09d\n' % n)
+            f.flush()
+            time.sleep(1.0 / rate)
+
+
+def count_lines(path):
+    try:
+        with open(path) as f:
+            return sum(1 for line in f)
+    except IOError:
+        return 0
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'faults.log')
+    out = os.path.join(tmp, 'parsed.log')
+    config = os.path.join(tmp, 'sluice_config.py')
+    open(path, 'w').close()
+    with open(config, 'w') as f:
+        f.write(SLUICE_CONFIG % dict(
+            out=out,
+            url='http://127.0.0.1:%d/%s' % (opts.port + 1, slug(path)) ))
+
+    server_args = [ sys.executable, '-c', 'import lumberjack; lumberjack.main()',
+                    '--listenport=%d' % opts.port, '--logging=warning',
+                    '--bufferlen=%d' % (opts.bufferlen or opts.lines * 2) ]
+    if opts.spill:
+        server_args.append('--spill_dir=%s' % os.path.join(tmp, 'spill'))
+    state = dict(server=None, sluice=None, restarts=0, server_restarts=0)
+    def start_server():
+        state['server'] = subprocess.Popen(server_args + [path], cwd=ROOT,
+                                           preexec_fn=os.setsid)
+    def stop_server():
+        if state['server'] is not None:
+            os.killpg(state['server'].pid, signal.SIGTERM)
+            state['server'].wait()
+            state['server'] = None
+
+    start_server()
+    proxy = FlakyProxy(opts.port, opts.cut_after)
+    proxy.listen(opts.port + 1, '127.0.0.1')
+
+    sluice_args = [ sys.executable, '-c',
+                    'from lumberjack.sluice import main; main()',
+                    '--config=%s' % config, '--logging=warning' ]
+    if opts.checkpoint:
+        sluice_args += [ '--checkpoint-file=%s' % os.path.join(tmp, 'checkpoints'),
+                         '--checkpoint-interval=%s' % opts.checkpoint_interval ]
+
+    def stop_sluice():
+        if state['sluice'] is not None:
+            state['sluice'].send_signal(signal.SIGKILL if opts.kill else
+                                        signal.SIGINT)
+            state['sluice'].wait()
+            state['sluice'] = None
+
+    @tornado.gen.coroutine
+    def run():
+        writer = multiprocessing.Process(target=write_lines,
+                                         args=(path, opts.lines, opts.rate))
+        writer.start()
+        start = time.time()
+        last_restart = 0
+        last_server_restart = start
+        while time.time() - start < opts.timeout:
+            if opts.restart_lumberjack and writer.is_alive() and \
+               time.time() - last_server_restart > opts.restart_lumberjack:
+                stop_server()
+                start_server()
+                wait_for_port(opts.port)
+                state['server_restarts'] += 1
+                last_server_restart = time.time()
+            if writer.is_alive() and \
+               time.time() - last_restart > opts.restart_every:
+                if state['sluice'] is not None:
+                    stop_sluice()
+                    state['restarts'] += 1
+                state['sluice'] = subprocess.Popen(sluice_args, cwd=ROOT)
+                last_restart = time.time()
+            if not writer.is_alive() and count_lines(out) >= opts.lines:
+                break
+            yield tornado.gen.sleep(0.1)
+        # let anything in flight land before counting
+        yield tornado.gen.sleep(1)
+        writer.join()
+
+    try:
+        wait_for_port(opts.port)
+        tornado.ioloop.IOLoop.current().run_sync(run)
+        stop_sluice()
+
+        with open(out) as f:
+            seen = Counter( line.rstrip('\n') for line in f )
+        written = set( 'line %09d' % n for n in range(opts.lines) )
+        print('lines\treceived\tduplicates\tmissing\trestarts\t'
+              'lumberjack restarts\tcuts\tcheckpoint')
+        print('%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s' % (
+            opts.lines, sum(seen.values()),
+            sum( n - 1 for n in seen.values() if n > 1 ),
+            len(written - set(seen)),
+            state['restarts'], state['server_restarts'], proxy.cuts,
+            opts.checkpoint and ('every %ss' % opts.checkpoint_interval) or 'no' ))
+    finally:
+        stop_sluice()
+        stop_server()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+How long a sluice config with lots of URLs on one host takes to connect.
+
+Starts a lumberjack tailing --urls scratch files, each with a line in it,
+opens a Sluice per file all at once, and reports how long it took for
+every one to get its first message, and how many had to reconnect.
+
+    python benchmarks/sluice_startup.py --urls=500
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import signal
+import shutil
+import resource
+import tempfile
+import optparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from harness import wait_for_port
+
+import tornado.gen
+import tornado.ioloop
+
+from lumberjack.sluice.models import Sluice
+from lumberjack.util import slug
+
+
+opt_list = [
+    optparse.make_option('-u', '--urls', action="store", type="int",
+                         dest="urls", default=500,
+                         help="Files, and sluices. Default: 500"),
+    optparse.make_option('-p', '--port', action="store", type="int",
+                         dest="port", default=18130,
+                         help="Port to run lumberjack on. Default: 18130"),
+    optparse.make_option('-t', '--timeout', action="store", type="float",
+                         dest="timeout", default=120,
+                         help="Give up after this many seconds. Default: 120"),
+    ]
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    # a socket and a file per url, on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, opts.urls * 4 + 256)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    tmp = tempfile.mkdtemp()
+    paths = [ os.path.join(tmp, 'startup_%04d.log' % i) for i in range(opts.urls) ]
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write('hello\n')
+    server = subprocess.Popen(
+        [ sys.executable, '-c', 'import lumberjack; lumberjack.main()',
+          '--listenport=%d' % opts.port, '--logging=warning' ] + paths,
+        cwd=ROOT, preexec_fn=os.setsid )
+
+    first = dict()
+    def parser_for(path):
+        def parse(data):
+            first.setdefault(path, time.time())
+        return parse
+
+    @tornado.gen.coroutine
+    def run():
+        start = time.time()
+        sluices = [ Sluice('http://127.0.0.1:%d/%s' % (opts.port, slug(path)),
+                           parser_for(path),
+                           io_loop=tornado.ioloop.IOLoop.current()).open()
+                    for path in paths ]
+        while len(first) < len(paths) and time.time() - start < opts.timeout:
+            yield tornado.gen.sleep(0.01)
+        times = sorted( t - start for t in first.values() )
+        for sluice in sluices:
+            sluice.close()
+
+        print('urls\tconnected\tp50_s\tp99_s\tall_s\treconnects')
+        print('%d\t%d\t%.2f\t%.2f\t%.2f\t%d' % (
+            opts.urls, len(times),
+            times[len(times) // 2] if times else 0,
+            times[int(len(times) * 0.99)] if times else 0,
+            times[-1] if times else 0,
+            sum( sluice.stats.recv_fail for sluice in sluices ) ))
+
+    try:
+        wait_for_port(opts.port, 30)
+        tornado.ioloop.IOLoop.current().run_sync(run)
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Lines per second one sluice takes in from a local lumberjack.
+
+Starts a lumberjack tailing a scratch file, points a Sluice with a parser
+that only counts at it, and has another process append lines as fast as it
+can. Reports how long it took for every line to reach the parser, and how
+many messages they came in.
+
+    python benchmarks/sluice_throughput.py --lines=200000 --width=120
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import optparse
+import subprocess
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from harness import wait_for_port
+
+import tornado.gen
+import tornado.ioloop
+
+from lumberjack.sluice.models import Sluice
+from lumberjack.util import slug
+
+
+opt_list = [
+    optparse.make_option('-n', '--lines', action="store", type="int",
+                         dest="lines", default=200000,
+                         help="Lines to push through. Default: 200000"),
+    optparse.make_option('-w', '--width', action="store", type="int",
+                         dest="width", default=120,
+                         help="Characters per line. Default: 120"),
+    optparse.make_option('-p', '--port', action="store", type="int",
+                         dest="port", default=18098,
+                         help="Port to run lumberjack on. Default: 18098"),
+    optparse.make_option('-t', '--timeout', action="store", type="float",
+                         dest="timeout", default=120,
+                         help="Give up after this many seconds. Default: 120"),
+    ]
+
+
+def write_lines(path, count, width, batch=1000):
+    with open(path, 'a') as f:
+        for i in range(0, count, batch):
+            f.write(''.join( ('%09d ' % n).ljust(width, 'x') + '\n'
+                             for n in range(i, min(i + batch, count)) ))
+            f.flush()
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'throughput.log')
+    open(path, 'w').close()
+    server = subprocess.Popen(
+        [ sys.executable, '-c', 'import lumberjack; lumberjack.main()',
+          '--listenport=%d' % opts.port, '--logging=warning',
+          '--compression_level=0',
+          '--subscriber_buffer_bytes=%d' % (256 * 1024 * 1024), path ],
+        cwd=ROOT, preexec_fn=os.setsid )
+
+    counts = dict(messages=0, lines=0)
+    def count(data):
+        counts['messages'] += 1
+        counts['lines'] += len(data['logs'])
+
+    @tornado.gen.coroutine
+    def run():
+        sluice = Sluice('http://127.0.0.1:%d/%s' % (opts.port, slug(path)),
+                        count, io_loop=tornado.ioloop.IOLoop.current()).open()
+        yield tornado.gen.sleep(0.5)
+
+        writer = multiprocessing.Process(target=write_lines,
+                                         args=(path, opts.lines, opts.width))
+        start = time.time()
+        writer.start()
+        while counts['lines'] + sluice.stats.log_dropped < opts.lines and \
+              time.time() - start < opts.timeout:
+            yield tornado.gen.sleep(0.01)
+        seconds = time.time() - start
+        writer.join()
+
+        print('lines\tmessages\tseconds\tlines_per_s\tMB_per_s\tdropped\tbad_messages')
+        print('%d\t%d\t%.2f\t%.0f\t%.1f\t%d\t%d' % (
+            counts['lines'], counts['messages'], seconds,
+            counts['lines'] / seconds,
+            sluice.stats.raw_received / seconds / 1e6,
+            sluice.stats.log_dropped,
+            sluice.stats.recv_fail ))
+
+    try:
+        wait_for_port(opts.port)
+        tornado.ioloop.IOLoop.current().run_sync(run)
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
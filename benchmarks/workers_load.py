@@ -0,0 +1,170 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+How concurrent websocket subscribers scale with --workers.
+
+Starts a real lumberjack for each worker count, connects the subscribers
+from several client processes, appends timestamped lines to the tailed file
+at a steady rate and reports how many lines reached subscribers per second
+and how long they took to get there. The clients share the machine with
+the server, so give them cores of their own (--clients) when comparing.
+
+    python benchmarks/workers_load.py --workers=1,2,4 --subscribers=1000
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import tempfile
+import optparse
+import subprocess
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from harness import wait_for_port
+
+opt_list = [
+    optparse.make_option('-w', '--workers', action="store", type="string",
+                         dest="workers", default="1,2,4",
+                         help="Comma separated worker counts to try"),
+    optparse.make_option('-s', '--subscribers', action="store", type="int",
+                         dest="subscribers", default=500,
+                         help="Websocket subscribers. Default: 500"),
+    optparse.make_option('-c', '--clients', action="store", type="int",
+                         dest="clients", default=4,
+                         help="Client processes holding the subscribers. Default: 4"),
+    optparse.make_option('-r', '--rate', action="store", type="int",
+                         dest="rate", default=500,
+                         help="Lines appended per second. Default: 500"),
+    optparse.make_option('-d', '--duration', action="store", type="float",
+                         dest="duration", default=10,
+                         help="Seconds to append for. Default: 10"),
+    optparse.make_option('-p', '--port', action="store", type="int",
+                         dest="port", default=18099,
+                         help="Port to run lumberjack on. Default: 18099"),
+    ]
+
+
+def subscribe(url, count, ready, results):
+    """Hold count websockets open on url, timing every line that arrives"""
+    import tornado.gen
+    import tornado.ioloop
+    import tornado.websocket
+
+    stats = dict(lines=0, latencies=list())
+
+    @tornado.gen.coroutine
+    def read(conn):
+        while True:
+            message = yield conn.read_message()
+            if message is None:
+                return
+            now = time.time()
+            logs = json.loads(message)['logs']
+            stats['lines'] += len(logs)
+            # a sample is plenty, and keeps the clients cheap
+            stats['latencies'].extend( now - float(line.split(' ', 1)[0])
+                                       for line in logs[::50] )
+
+    @tornado.gen.coroutine
+    def run():
+        conns = list()
+        for i in range(count):
+            conn = yield tornado.websocket.websocket_connect(url)
+            conns.append(conn)
+            tornado.ioloop.IOLoop.current().spawn_callback(read, conn)
+        ready.put(True)
+        # wait to be told the writer has finished
+        while results.empty():
+            yield tornado.gen.sleep(0.1)
+        for conn in conns:
+            conn.close()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    ready.put(stats)
+
+
+def measure(opts, workers):
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'load.log')
+    open(path, 'w').close()
+    server = subprocess.Popen(
+        [ sys.executable, '-c', 'import lumberjack; lumberjack.main()',
+          '--workers=%d' % workers, '--listenport=%d' % opts.port,
+          '--bus_socket=%s' % os.path.join(tmp, 'bus.sock'),
+          '--logging=warning', path ],
+        cwd=ROOT, preexec_fn=os.setsid )
+    try:
+        wait_for_port(opts.port)
+        time.sleep(1) # for the workers to reach the ingest bus
+
+        from lumberjack.util import slug
+        url = 'ws://127.0.0.1:%d/%s/socket' % (opts.port, slug(path))
+        ready, done = multiprocessing.Queue(), multiprocessing.Queue()
+        per_client = opts.subscribers // opts.clients
+        clients = [ multiprocessing.Process(target=subscribe,
+                                            args=(url, per_client, ready, done))
+                    for i in range(opts.clients) ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            ready.get()
+
+        written = 0
+        tick = 0.01
+        per_tick = max(int(opts.rate * tick), 1)
+        start = time.time()
+        with open(path, 'a') as f:
+            while time.time() - start < opts.duration:
+                f.write(''.join( '%.6f line %d\n' % (time.time(), written + i)
+                                 for i in range(per_tick) ))
+                f.flush()
+                written += per_tick
+                time.sleep(tick)
+        time.sleep(2) # let the stragglers arrive
+
+        done.put(True)
+        stats = [ ready.get() for client in clients ]
+        for client in clients:
+            client.join()
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    received = sum(s['lines'] for s in stats)
+    latencies = sorted(l for s in stats for l in s['latencies']) or [0]
+    return ( received / float(written * per_client * opts.clients),
+             received / opts.duration,
+             latencies[len(latencies) // 2] * 1000,
+             latencies[int(len(latencies) * 0.99)] * 1000 )
+
+
+def main():
+    parser = optparse.OptionParser(option_list=opt_list)
+    (opts, args) = parser.parse_args()
+
+    print('workers\tsubscribers\tdelivered\tlines_per_s\tmedian_ms\tp99_ms')
+    for workers in [ int(w) for w in opts.workers.split(',') ]:
+        delivered, rate, median, p99 = measure(opts, workers)
+        print('%d\t%d\t%.1f%%\t%.0f\t%.1f\t%.1f' % (
+            workers, opts.subscribers, delivered * 100, rate, median, p99))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,8 @@ from __future__ import absolute_import
 import os
 import sys
 import socket
+import datetime
+import tempfile
 import logging
 from functools import partial
 
@@ -24,7 +26,9 @@ log = logging.getLogger(__name__)
 
 import tornado.web
 import tornado.ioloop
+import tornado.netutil
 import tornado.process
+import tornado.httpserver
 import tornado.options 
 from tornado.options import define, options
 
@@ -32,65 +36,296 @@ from .handlers import (
     MainHandler,
     LodgeHandler,
     LumberHandler, LumberSocket,
-    ProxyHandler, ProxySocket
+    ProxyHandler, ProxySocket,
+    MergeHandler, MergeSocket,
+    MultiplexSocket,
+    HistoryHandler,
+    SearchHandler,
+    StatsHandler,
+    MetricsHandler,
+    compression_options
 )
 from .models import (
         LumberBuffer, 
+        CompactLumberBuffer,
         AttrBag, 
         Lodge,
-        Fellow
+        Fellow,
+        Subscriber
+)
+from .bus import IngestBus, BusClient, ReplicaLodge
+from .metrics import LoopLag
+from .proxy import UpstreamPool
+from .search import SearchIndex
+from .timestamps import TimestampParser, DEFAULT_FORMATS as DEFAULT_TIMESTAMP_FORMATS
+from .spill import SegmentStore
+from .tailer import Tailer
+from .framing import LineFramer, DEFAULT_MAX_LINE_LENGTH
+from .batching import (
+    IngestBatcher, unbatched,
+    DEFAULT_INTERVAL as DEFAULT_INGEST_INTERVAL,
+    DEFAULT_MAX_BYTES as DEFAULT_INGEST_BYTES
 )
 from .util import slug
 
 define( 'listenport', default=8080, 
         help="HTTP will be served on this port", 
         type=int )
+define( 'workers',    default=1,
+        help="HTTP worker processes. With more than one, a separate "+
+        "process tails the files and passes lines to the workers",
+        type=int )
+define( 'bus_socket', default=None,
+        help="Unix socket between the tailing process and the workers. "+
+        "Defaults to lumberjack-<listenport>.sock in the temp directory",
+        type=str )
 define( 'bufferlen',  default=200,  
         help="Lines of logs to keep in memory", 
         type=int )
+define( 'buffer_bytes', default=0,
+        help="Keep this many bytes of logs in memory per file, stored "+
+        "compactly, instead of --bufferlen lines",
+        type=int )
+define( 'spill_dir',  default=None,
+        help="Also keep history on disk under this directory, so it can "+
+        "be paged through at /<file>/history",
+        type=str )
+define( 'spill_segment_bytes', default=64*1024*1024,
+        help="Size of each on-disk history segment",
+        type=int )
+define( 'spill_max_bytes', default=1024*1024*1024,
+        help="On-disk history to keep per file, in bytes",
+        type=int )
+define( 'spill_max_age', default=0,
+        help="Drop on-disk history older than this many seconds. "+
+        "0 keeps it until --spill_max_bytes runs out",
+        type=int )
+define( 'search_index', default=False,
+        help="Keep a trigram index of each file's buffer, so searches "+
+        "take milliseconds however many lines it holds. Costs CPU per "+
+        "line, and memory about the size of the buffer's text",
+        type=bool )
+define( 'timestamp_formats', default=DEFAULT_TIMESTAMP_FORMATS,
+        help="Comma separated formats of the timestamps lines start with, "+
+        "for ?from= and ?to=: any of iso, syslog and epoch, or a strptime "+
+        "format. Lines without one are stamped with the time the line "+
+        "before had, or when they arrived. Empty stamps every line with "+
+        "when it arrived",
+        type=str )
 define( 'lodge',      default=None,   
         help="Lodge host. Connect to this host to show other running "+
         "lumberjacks. Defaults to set up a lodge that other "+
         "lumberjacks can connect to.",
         type=str )
+define( 'parent_lodge', default=None,
+        help="Make this lodge a regional one, forwarding its lumberjacks' "+
+        "check-ins to this host's lodge. Ignored with --lodge",
+        type=str )
+define( 'lodge_forward_interval', default=10,
+        help="Seconds between a regional lodge's forwards to its parent",
+        type=int )
+define( 'lodge_ttl',  default=60,
+        help="Seconds to trust a copy of a remote lodge's membership "+
+        "before revalidating it, when its pushed updates aren't coming",
+        type=int )
+define( 'lodge_push', default=True,
+        help="Follow a remote lodge's membership changes as they happen",
+        type=bool )
 define( 'name',       default=socket.gethostname(), 
         help="If using a lodge, use this name to identify myself. "+
         "Defaults to the system hostname",
         type=str )
+define( 'inotify',    default=True,
+        help="Use inotify to notice file changes where available. "+
+        "Falls back to polling otherwise.",
+        type=bool )
+define( 'poll_interval', default=1.0,
+        help="Seconds between checks of followed files when inotify "+
+        "isn't available",
+        type=float )
+define( 'ingest_flush_interval', default=DEFAULT_INGEST_INTERVAL,
+        help="Seconds to hold lines read from a file so they go out to "+
+        "clients together, one frame per tick rather than one per write. "+
+        "0 sends every read's lines as soon as they're read",
+        type=float )
+define( 'ingest_flush_bytes', default=DEFAULT_INGEST_BYTES,
+        help="Send held lines early once this many bytes of them are read",
+        type=int )
+define( 'unbatched_files', default='',
+        help="Comma separated globs of files whose lines are sent as soon "+
+        "as they're read, whatever --ingest_flush_interval says",
+        type=str )
+define( 'max_line_length', default=DEFAULT_MAX_LINE_LENGTH,
+        help="Lines longer than this many bytes are truncated",
+        type=int )
+define( 'encoding',   default='utf-8',
+        help="Character encoding of the files being streamed",
+        type=str )
+define( 'encoding_errors', default='replace',
+        help="What to do with bytes that aren't valid in --encoding: "+
+        "replace, ignore, or strict (drop the line)",
+        type=str )
+define( 'compression_level', default=6,
+        help="zlib level for compressing streams to clients that support "+
+        "it (gzip for HTTP, permessage-deflate for websockets). 0 turns "+
+        "compression off",
+        type=int )
+define( 'compression_min_bytes', default=256,
+        help="Don't bother compressing websocket messages smaller than this",
+        type=int )
+define( 'slow_consumer_policy', default='drop',
+        help="What to do when a streaming client falls more than "+
+        "--subscriber_buffer_bytes behind: "+', '.join(Subscriber.POLICIES),
+        type=str )
+define( 'subscriber_buffer_bytes', default=1024*1024,
+        help="Bytes of output to queue for a client that isn't keeping up",
+        type=int )
+define( 'proxy_grace_period', default=30,
+        help="Seconds to keep a proxied file's upstream connection open "+
+        "after its last viewer leaves",
+        type=int )
+define( 'merge_window', default=1.0,
+        help="Seconds a merged stream (/merge) holds lines back for "+
+        "quieter files, so lines from different files come out in the "+
+        "order they were written",
+        type=float )
+
+
+def make_lumberbuffer(filename, readonly=False, served=True):
+    """
+    A buffer for filename as the options ask, spilling, indexing and
+    parsing timestamps if they say to. Only buffers that clients will read
+    from (served) need indexes and timestamps.
+    """
+    spill = None
+    if options.spill_dir:
+        spill = SegmentStore( os.path.join(options.spill_dir, slug(filename)),
+                              segment_bytes=options.spill_segment_bytes,
+                              max_bytes=options.spill_max_bytes,
+                              max_age=options.spill_max_age,
+                              readonly=readonly )
+    index = None
+    if served and options.search_index:
+        # a LumberBuffer keeps every line's string anyway, so share them
+        index = SearchIndex(share_lines=not options.buffer_bytes)
+    timestamps = None
+    if served and options.timestamp_formats:
+        timestamps = TimestampParser(options.timestamp_formats)
+    if options.buffer_bytes:
+        return CompactLumberBuffer(max_bytes=options.buffer_bytes, spill=spill,
+                                   index=index, timestamps=timestamps)
+    return LumberBuffer(maxlen=options.bufferlen, spill=spill, index=index,
+                        timestamps=timestamps)
 
 
-def setup_global_models(logs_to_stream):
+def setup_global_models(logs_to_stream, served=True):
     lumberbuffers = dict()
     lodge = None # populated later in this function
     me = Fellow(name=options.name)
 
-    def _logstream_cb(data=False, lumberbuffer=None):
-        if data and filename:
-            lines = data.rstrip('\r\n').split('\n')
-            lumberbuffer.append_list(lines)
-        else:
-            logging.debug('Closing %s' % filename)
+    tailer = Tailer(poll_interval=options.poll_interval,
+                    use_inotify=options.inotify)
+
+    def _logstream_cb(data, framer=None, lumberbuffer=None, batcher=None):
+        lumberbuffer.ingested_bytes += len(data)
+        lines = framer.feed(data)
+        if lines:
+            batcher.add(lines, len(data))
             
     for filename in logs_to_stream:
-        lumberbuffers[filename] = LumberBuffer(maxlen=options.bufferlen)
+        lumberbuffers[filename] = make_lumberbuffer(filename, served=served)
+        interval = options.ingest_flush_interval
+        if unbatched(filename, options.unbatched_files):
+            interval = 0
+        batcher = IngestBatcher(lumberbuffers[filename].append_list,
+                                interval=interval,
+                                max_bytes=options.ingest_flush_bytes)
         me.lumberfiles.append( 
             AttrBag( path=filename, slug=slug(filename) )
             )
-        p = tornado.process.Subprocess(['tail', '-f', filename, '-n'+str(options.bufferlen)], 
-                                       stdout=tornado.process.Subprocess.STREAM)
-        p.stdout.read_until_close(
-            callback=lambda *args, **kwargs: None, # called on stream close; should probably
-            # Do something intelligent here (close something?)
-            streaming_callback=partial(_logstream_cb, 
-                                       lumberbuffer=lumberbuffers[filename])
-            )
+        framer = LineFramer(max_line_length=options.max_line_length,
+                            encoding=options.encoding,
+                            errors=options.encoding_errors)
+        tailer.watch(filename,
+                     partial(_logstream_cb, 
+                             framer=framer,
+                             lumberbuffer=lumberbuffers[filename],
+                             batcher=batcher),
+                     backlog=options.bufferlen)
+
+    tailer.start()
 
     # make a lodge with just me in it
-    lodge = Lodge([me,], host=options.lodge)
+    lodge = Lodge([me,], host=options.lodge,
+                  parent=None if options.lodge else options.parent_lodge,
+                  forward_interval=datetime.timedelta(
+                      seconds=options.lodge_forward_interval))
+
+    return (lumberbuffers, lodge)
+
 
+def setup_worker_models(logs_to_stream):
+    """
+    Replicas of the ingest process's buffers and lodge for an HTTP worker,
+    to be kept up to date by a BusClient.
+    """
+    lumberbuffers = dict( (filename, make_lumberbuffer(filename, readonly=True))
+                          for filename in logs_to_stream )
+    if options.lodge:
+        # every worker follows the remote lodge itself
+        lodge = Lodge([Fellow(name=options.name, lumberfiles=[])],
+                      host=options.lodge, check_in=False)
+        lodge.start_mirror()
+    else:
+        lodge = ReplicaLodge()
     return (lumberbuffers, lodge)
 
 
+def bus_path():
+    return options.bus_socket or os.path.join(
+        tempfile.gettempdir(), 'lumberjack-%d.sock' % options.listenport)
+
+
+def run_workers(logs_to_stream):
+    """
+    Fork an ingest process and --workers HTTP workers, restarting any that
+    die. Workers each bind the port with SO_REUSEPORT so the kernel spreads
+    connections across them, or share one socket bound before forking where
+    that's not available.
+    """
+    sockets = None
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sockets = tornado.netutil.bind_sockets(options.listenport)
+
+    task_id = tornado.process.fork_processes(options.workers + 1)
+    if task_id == 0:
+        # the workers index and timestamp their own copies, this one's
+        # never read by clients
+        lumberbuffers, lodge = setup_global_models(logs_to_stream,
+                                                   served=False)
+        IngestBus(bus_path(), lumberbuffers, lodge)
+        log.info('Ingest process tailing %d files', len(lumberbuffers))
+        run_ioloop()
+    else:
+        lumberbuffers, lodge = setup_worker_models(logs_to_stream)
+        tornado.ioloop.IOLoop.current().spawn_callback(
+            BusClient(bus_path(), lumberbuffers, lodge).connect)
+        if sockets is None:
+            sockets = tornado.netutil.bind_sockets(options.listenport,
+                                                   reuse_port=True)
+        log.info('HTTP worker %d serving on port %d', task_id, options.listenport)
+        serve(lumberbuffers, lodge, sockets)
+
+
+def run_ioloop():
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    try:
+        ioloop.start()
+    except KeyboardInterrupt:
+        log.info('Keyboard interrupt. Shutting down...')
+
+
 def main():
     logs_to_stream = tornado.options.parse_command_line()
     logging.getLogger().setLevel(getattr(logging, options.logging.upper()))
@@ -99,25 +334,55 @@ def main():
         # parse_command_line gives options if they're at the end
         # of the line. For example lumberjack log1 log2 --logging=debug
         # gives ['log1', 'log2', '--logging=debug'].
-        lumberbuffers, lodge = setup_global_models(
-            [l for l in logs_to_stream if not l.startswith('--')]
-            )
+        logs_to_stream = [l for l in logs_to_stream if not l.startswith('--')]
     else:
         sys.stderr.write("Didn't specify any files to stream\n")
         options.print_help()
         sys.exit(1)
-            
+
+    if options.workers > 1:
+        run_workers(logs_to_stream)
+    else:
+        lumberbuffers, lodge = setup_global_models(logs_to_stream)
+        serve(lumberbuffers, lodge)
+
+
+def serve(lumberbuffers, lodge, sockets=None):
+    """Serve HTTP on --listenport, or on sockets if they're given"""
+    upstreams = UpstreamPool( grace_period=options.proxy_grace_period,
+                              keep_lines=options.bufferlen,
+                              compression_options=compression_options() )
+    lag = LoopLag().start()
+
     routes = (
         ( r'/', MainHandler, 
           dict(lodge=lodge) ),
         ( r'/lodge/?', LodgeHandler, 
           dict(lodge=lodge) ),
+        ( r'/_stats/?', StatsHandler,
+          dict(cache=lumberbuffers, upstreams=upstreams) ),
+        ( r'/metrics/?', MetricsHandler,
+          dict(cache=lumberbuffers, upstreams=upstreams, lag=lag) ),
+        ( r'/search/?', SearchHandler,
+          dict(cache=lumberbuffers) ),
+        ( r'/socket/?', MultiplexSocket,
+          dict(cache=lumberbuffers) ),
+        ( r'/merge/?', MergeHandler,
+          dict(cache=lumberbuffers, upstreams=upstreams) ),
+        ( r'/merge/socket.*', MergeSocket,
+          dict(cache=lumberbuffers, upstreams=upstreams) ),
         ( r'/([\w.\.%]+)/?', LumberHandler, 
           dict(cache=lumberbuffers) ),
         ( r'/([\w.\.%]+)/socket.*', LumberSocket, 
           dict(cache=lumberbuffers) ),
-        ( r'/([\w.\.]+)/([\w.\.%]+)/?', ProxyHandler ),
-        ( r'/([\w.\.]+)/([\w.\.%]+)/socket.*', ProxySocket )
+        ( r'/([\w.\.%]+)/history/?', HistoryHandler,
+          dict(cache=lumberbuffers) ),
+        ( r'/([\w.\.%]+)/search/?', SearchHandler,
+          dict(cache=lumberbuffers) ),
+        ( r'/([\w.\.]+)/([\w.\.%]+)/?', ProxyHandler,
+          dict(upstreams=upstreams) ),
+        ( r'/([\w.\.]+)/([\w.\.%]+)/socket.*', ProxySocket,
+          dict(upstreams=upstreams) )
         )
 
     app_settings = dict(
@@ -128,14 +393,13 @@ def main():
 
     app = tornado.web.Application( routes, **app_settings )
     
-    app.listen(options.listenport)
-
-    ioloop = tornado.ioloop.IOLoop.instance()
+    if sockets is None:
+        app.listen(options.listenport)
+    else:
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
 
-    try:
-        ioloop.start()
-    except KeyboardInterrupt:
-        log.info('Keyboard interrupt. Shutting down...')
+    run_ioloop()
 
 
 if __name__ == "__main__":
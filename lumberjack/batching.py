@@ -0,0 +1,75 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Lines read from a file, held for a moment so they fan out together """
+from __future__ import absolute_import
+
+import fnmatch
+import logging
+from datetime import timedelta
+
+log = logging.getLogger(__name__)
+
+import tornado.ioloop
+
+DEFAULT_INTERVAL  = 0.05
+DEFAULT_MAX_BYTES = 256 * 1024
+
+
+def unbatched(filename, patterns):
+    """Whether filename matches any of a comma separated list of globs"""
+    return any( fnmatch.fnmatch(filename, pattern.strip())
+                for pattern in (patterns or '').split(',') if pattern.strip() )
+
+
+
+class IngestBatcher(object):
+    """
+    Stands between a file's reads and its buffer's append_list. Every
+    append is a frame written to every subscriber, so a file getting
+    thousands of small writes a second would otherwise cost each client
+    thousands of frames and syscalls. Lines are held until interval seconds
+    after the first of them was read, or until max_bytes of them have been
+    read, whichever comes first, then appended as one list.
+
+    With interval 0, every read's lines are appended straight away.
+    """
+
+    def __init__(self, append, interval=DEFAULT_INTERVAL,
+                 max_bytes=DEFAULT_MAX_BYTES, io_loop=None):
+        self.append    = append
+        self.interval  = interval
+        self.max_bytes = max_bytes
+        self.io_loop   = tornado.ioloop.IOLoop.current() if io_loop is None else io_loop
+        self.lines     = list()
+        self.nbytes    = 0
+        self.timeout   = None
+
+
+    def add(self, lines, size):
+        """Take lines, read as size bytes"""
+        self.lines.extend(lines)
+        self.nbytes += size
+        if self.interval <= 0 or self.nbytes >= self.max_bytes:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = self.io_loop.add_timeout(
+                timedelta(seconds=self.interval), self.flush )
+
+
+    def flush(self):
+        """Append whatever's held, if anything"""
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+        lines, self.lines, self.nbytes = self.lines, list(), 0
+        if lines:
+            self.append(lines)
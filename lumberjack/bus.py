@@ -0,0 +1,262 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+The Unix socket between the ingest process and the HTTP workers of a
+lumberjack started with --workers.
+
+The ingest process tails the files and owns the real LumberBuffers and
+Lodge. Every worker keeps a replica of each, fed over the bus, so the
+handlers in a worker subscribe, replay and page through history exactly as
+they would in a single process lumberjack.
+
+Messages are JSON, each behind a 4 byte length:
+
+    hello    ingest -> worker   on connect, with the lodge if it's ours
+    lines    ingest -> worker   a Frame appended to a file's buffer
+    fellow   ingest -> worker   a check-in, and the lodge version it made
+    check_in worker -> ingest   a check-in a worker was sent
+"""
+from __future__ import absolute_import
+
+import socket
+import struct
+import random
+import logging
+from functools import partial
+
+log = logging.getLogger(__name__)
+
+import tornado.gen
+import tornado.ioloop
+import tornado.netutil
+import tornado.iostream
+import tornado.tcpserver
+from tornado.escape import utf8
+
+from .models import Lodge, Fellow
+from .util import serialize, deserialize
+
+HEADER = struct.Struct('!I')
+
+
+def encode(message):
+    return framed( utf8(serialize(message)) )
+
+
+def framed(body):
+    return HEADER.pack(len(body)) + body
+
+
+def lines_message(lumberfile, frame):
+    """A lines message around a Frame's JSON, which is already encoded"""
+    return framed( b'{"type": "lines", "file": ' + utf8(serialize(lumberfile)) +
+                   b', "frame": ' + frame.json + b'}' )
+
+
+
+class BusConnection(object):
+    """Length prefixed messages in and out of one end of the bus"""
+
+    def __init__(self, stream, on_message):
+        self.stream = stream
+        self.on_message = on_message
+        self._read_header()
+
+
+    def _read_header(self):
+        try:
+            self.stream.read_bytes(HEADER.size, self._on_header)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+    def _on_header(self, data):
+        try:
+            self.stream.read_bytes(HEADER.unpack(data)[0], self._on_body)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+    def _on_body(self, data):
+        self.on_message(self, deserialize(data.decode('utf-8')))
+        self._read_header()
+
+
+    def send(self, payload):
+        """Write an already encoded message"""
+        if self.stream.closed():
+            return
+        try:
+            self.stream.write(payload)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+
+class IngestBus(tornado.tcpserver.TCPServer):
+    """
+    The ingest process's end. Each append to a buffer goes to every worker
+    as one message, built once from the append's Frame.
+    """
+
+    def __init__(self, path, lumberbuffers, lodge):
+        super(IngestBus, self).__init__()
+        self.path          = path
+        self.lumberbuffers = lumberbuffers
+        self.lodge         = lodge
+        self.epoch         = '%x' % random.getrandbits(32)
+        self.workers       = set()
+
+        for lumberfile, buf in lumberbuffers.items():
+            buf.subscribe( 'bus', partial(self._publish_lines, lumberfile) )
+        if lodge.authoritative:
+            lodge.listeners.append(self._publish_fellow)
+        self.add_socket(tornado.netutil.bind_unix_socket(path))
+        log.info('Ingest bus listening on %s', path)
+
+
+    def handle_stream(self, stream, address):
+        conn = BusConnection(stream, self.on_message)
+        self.workers.add(conn)
+        stream.set_close_callback(lambda: self.workers.discard(conn))
+
+        conn.send(encode(dict( type='hello',
+                               epoch=self.epoch,
+                               lodge=self.lodge if self.lodge.authoritative else None )))
+        for lumberfile, buf in self.lumberbuffers.items():
+            conn.send(lines_message(lumberfile, buf.since()))
+        log.debug('Worker connected to the ingest bus')
+
+
+    def _publish_lines(self, lumberfile, frame):
+        payload = lines_message(lumberfile, frame)
+        for conn in self.workers:
+            conn.send(payload)
+
+
+    def _publish_fellow(self, name):
+        payload = encode(dict( type='fellow',
+                               fellow=self.lodge.fellows[name],
+                               version=self.lodge.version ))
+        for conn in self.workers:
+            conn.send(payload)
+
+
+    def on_message(self, conn, message):
+        if message['type'] == 'check_in':
+            self.lodge.check_in( Fellow.from_dict(message['fellow']) )
+        else:
+            log.warning('Unexpected %s message on the ingest bus', message['type'])
+
+
+
+class ReplicaLodge(Lodge):
+    """
+    A worker's copy of the ingest process's lodge. Check-ins are passed on
+    to the ingest, which sends every change back to all the workers in the
+    same order, so they all agree on versions.
+    """
+
+    def __init__(self, bus=None):
+        Lodge.__init__(self, [], check_in=False)
+        self.bus = bus
+
+
+    def check_in(self, fellow):
+        if fellow.lumberfiles is None and fellow.name not in self.fellows:
+            return False
+        self.bus.send( encode(dict(type='check_in', fellow=fellow)) )
+        return True
+
+
+    def replace(self, data):
+        lodge = Lodge.from_dict(data)
+        self.host, self.epoch, self.fellows = lodge.host, lodge.epoch, lodge.fellows
+        self.version = lodge.version
+        self.sorted_version = None
+        self.changes.clear()
+
+
+    def update(self, fellow, version):
+        self.fellows[fellow.name] = fellow
+        self.version = version - 1
+        self._changed(fellow.name)
+
+
+
+class BusClient(object):
+    """A worker's end. Keeps the worker's buffers and lodge in step"""
+
+    def __init__(self, path, lumberbuffers, lodge):
+        self.path          = path
+        self.lumberbuffers = lumberbuffers
+        self.lodge         = lodge
+        self.conn          = None
+        self.epoch         = None
+        self.resetting     = set() # files to start over on the next message
+        if isinstance(lodge, ReplicaLodge):
+            lodge.bus = self
+
+
+    @tornado.gen.coroutine
+    def connect(self):
+        """Connect to the ingest process, waiting for it as long as it takes"""
+        delay = 0.1
+        while True:
+            stream = tornado.iostream.IOStream(
+                socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self.path)
+                break
+            except (tornado.iostream.StreamClosedError, socket.error):
+                yield tornado.gen.sleep(delay)
+                delay = min(delay * 2, 5)
+
+        self.conn = BusConnection(stream, self.on_message)
+        stream.set_close_callback(self._on_close)
+        log.debug('Connected to the ingest bus at %s', self.path)
+
+
+    def _on_close(self):
+        log.warning('Lost the ingest bus, reconnecting')
+        self.conn = None
+        tornado.ioloop.IOLoop.current().spawn_callback(self.connect)
+
+
+    def send(self, payload):
+        if self.conn is not None:
+            self.conn.send(payload)
+
+
+    def on_message(self, conn, message):
+        kind = message['type']
+        if kind == 'lines':
+            frame = message['frame']
+            buf = self.lumberbuffers.get(message['file'])
+            if buf is not None:
+                reset = message['file'] in self.resetting
+                self.resetting.discard(message['file'])
+                buf.replicate(frame['seq'], frame['logs'], reset=reset,
+                              epoch=frame.get('epoch'))
+        elif kind == 'fellow':
+            if isinstance(self.lodge, ReplicaLodge):
+                self.lodge.update( Fellow.from_dict(message['fellow']),
+                                   message['version'] )
+        elif kind == 'hello':
+            if message['epoch'] != self.epoch:
+                # a new ingest process, whose numbering may not match ours
+                self.resetting = set(self.lumberbuffers)
+                self.epoch = message['epoch']
+            if message['lodge'] is not None and isinstance(self.lodge, ReplicaLodge):
+                self.lodge.replace(message['lodge'])
+        else:
+            log.warning('Unexpected %s message on the ingest bus', kind)
@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Server side filtering of the lines a subscriber gets """
+from __future__ import absolute_import
+
+import re
+
+# log levels from least to most severe. level=WARN passes anything at WARN
+# or above.
+LEVELS = ( 'TRACE', 'DEBUG', 'INFO', 'NOTICE', 'WARN', 'WARNING', 'ERROR',
+           'SEVERE', 'CRITICAL', 'ALERT', 'FATAL', 'EMERG' )
+
+FILTER_ARGUMENTS = ('grep', 'regex', 'level', 'invert')
+
+
+class LineFilter(object):
+    """
+    Which lines a subscription wants. Every given criterion has to match:
+
+    grep   -- the line contains this substring
+    regex  -- the line matches this regular expression somewhere
+    level  -- the line mentions this log level, or a more severe one
+    invert -- pass exactly the lines the criteria above would drop
+
+    Filters with the same criteria compare equal, so a LumberBuffer can run
+    each distinct filter once per line and share the result.
+    """
+
+    def __init__(self, grep=None, regex=None, level=None, invert=False):
+        self.grep   = grep
+        self.regex  = regex
+        self.level  = level.upper() if level else None
+        self.invert = bool(invert)
+
+        self.pattern = re.compile(regex) if regex else None
+        self.level_pattern = None
+        if self.level:
+            if self.level not in LEVELS:
+                raise ValueError('Unknown log level %s' % level)
+            severe = LEVELS[LEVELS.index(self.level):]
+            self.level_pattern = re.compile(r'\b(?:%s)\b' % '|'.join(severe),
+                                            re.IGNORECASE)
+
+
+    @staticmethod
+    def from_handler(handler):
+        """The filter asked for in a request's query string, or None"""
+        return LineFilter.from_arguments(
+            dict( (name, handler.get_argument(name, None))
+                  for name in FILTER_ARGUMENTS ))
+
+
+    @staticmethod
+    def from_arguments(arguments):
+        """The filter asked for by a dict of arguments, or None"""
+        args = dict( (name, arguments.get(name)) for name in FILTER_ARGUMENTS )
+        if not any(args[name] for name in ('grep', 'regex', 'level')):
+            return None
+        args['invert'] = args['invert'] not in (None, '', '0', 'false', 0)
+        return LineFilter(**args)
+
+
+    @property
+    def key(self):
+        return (self.grep, self.regex, self.level, self.invert)
+
+
+    def __eq__(self, other):
+        return isinstance(other, LineFilter) and self.key == other.key
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+    def __repr__(self):
+        return 'LineFilter(%s)' % ', '.join( '%s=%r' % item for item in
+                                            self.arguments().items() )
+
+
+    def arguments(self):
+        """Query arguments that ask another lumberjack for this filter"""
+        args = dict()
+        for name in ('grep', 'regex', 'level'):
+            if getattr(self, name):
+                args[name] = getattr(self, name)
+        if self.invert:
+            args['invert'] = 1
+        return args
+
+
+    def match(self, line):
+        matched = ( (self.grep is None or self.grep in line) and
+                    (self.pattern is None or self.pattern.search(line) is not None) and
+                    (self.level_pattern is None or
+                     self.level_pattern.search(line) is not None) )
+        return matched != self.invert
+
+
+    def apply(self, lines):
+        return [ line for line in lines if self.match(line) ]
@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Encode-once payloads handed to every subscriber of a LumberBuffer """
+from __future__ import absolute_import
+
+import time
+import zlib
+import struct
+
+from tornado.escape import utf8
+
+from .util import serialize, deserialize
+
+OPCODE_TEXT = 0x1
+
+
+class EncodeStats(object):
+    """Time spent encoding frames, for /metrics"""
+
+    __slots__ = ('json_seconds', 'json_count', 'deflate_seconds', 'deflate_count')
+
+    def __init__(self):
+        self.json_seconds    = 0.0
+        self.json_count      = 0
+        self.deflate_seconds = 0.0
+        self.deflate_count   = 0
+
+encode_stats = EncodeStats()
+
+
+def websocket_frame(payload, opcode=OPCODE_TEXT, compressed=False):
+    """
+    A complete, unmasked (server to client) RFC 6455 frame around payload.
+    compressed sets RSV1, marking a permessage-deflate message (RFC 7692).
+    """
+
+    length = len(payload)
+    first = 0x80 | opcode # FIN
+    if compressed:
+        first |= 0x40
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length <= 0xFFFF:
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + payload
+
+
+def deflated_websocket_frame(payload, wbits=zlib.MAX_WBITS, level=6):
+    """A permessage-deflate compressed websocket frame around payload"""
+    start = time.time()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -wbits)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    # the empty block a sync flush ends with is implied (RFC 7692 7.2.1)
+    frame = websocket_frame(data[:-4], compressed=True)
+    encode_stats.deflate_seconds += time.time() - start
+    encode_stats.deflate_count += 1
+    return frame
+
+
+
+class Frame(object):
+    """
+    What a LumberBuffer hands its subscribers on every append. The JSON body
+    and the websocket frame around it are built the first time a subscriber
+    asks for them and then shared, so a chunk gets encoded once no matter
+    how many clients are watching.
+
+    The same goes for compressed websocket frames: each is deflated on its
+    own, without reference to earlier messages, so one copy is valid for
+    every client that negotiated permessage-deflate.
+
+    The JSON always ends in a newline, which makes the HTTP stream
+    newline-delimited JSON: clients can split it into documents however
+    the bytes happen to arrive.
+    """
+
+    __slots__ = ('data', '_json', '_websocket', '_deflated')
+
+    def __init__(self, data):
+        self.data       = data
+        self._json      = None
+        self._websocket = None
+        self._deflated  = None
+
+
+    def __len__(self):
+        return len(self.json)
+
+
+    @staticmethod
+    def from_json(message):
+        """A frame received from another lumberjack, keeping its encoding"""
+        frame = Frame(deserialize(message))
+        frame._json = utf8(message)
+        if not frame._json.endswith(b'\n'):
+            frame._json += b'\n'
+        return frame
+
+
+    @staticmethod
+    def merge(frames):
+        """One frame carrying the lines of all of frames, in order"""
+        data = dict(logs=[ line for frame in frames
+                           for line in frame.data['logs'] ],
+                    seq=frames[0].data.get('seq'))
+        for key in ('next', 'epoch'):
+            if key in frames[-1].data:
+                data[key] = frames[-1].data[key]
+        if any( frame.data.get('reset') for frame in frames ):
+            data['reset'] = True
+        for key in ('sources', 'times'):
+            # a merged stream's per-line tags, which go with the lines
+            if all( key in frame.data for frame in frames ):
+                data[key] = [ value for frame in frames
+                              for value in frame.data[key] ]
+        gap = sum( frame.data.get('gap', 0) for frame in frames )
+        if gap:
+            data['gap'] = gap
+        return Frame(data)
+
+
+    @property
+    def next_seq(self):
+        """
+        Where a client that has seen this frame picks up from. Filtered
+        frames skip lines, so they say so under 'next'.
+        """
+        if 'next' in self.data:
+            return self.data['next']
+        return (self.data.get('seq') or 0) + len(self.data['logs'])
+
+
+    @property
+    def json(self):
+        if self._json is None:
+            start = time.time()
+            self._json = utf8(serialize(self.data)) + b'\n'
+            encode_stats.json_seconds += time.time() - start
+            encode_stats.json_count += 1
+        return self._json
+
+
+    @property
+    def websocket(self):
+        if self._websocket is None:
+            self._websocket = websocket_frame(self.json)
+        return self._websocket
+
+
+    def websocket_deflated(self, wbits=zlib.MAX_WBITS, level=6, min_bytes=0):
+        """
+        The websocket frame, compressed with a wbits sized window, unless
+        the body is under min_bytes and not worth it.
+        """
+        if len(self.json) < min_bytes:
+            return self.websocket
+        if self._deflated is None:
+            self._deflated = dict()
+        if wbits not in self._deflated:
+            self._deflated[wbits] = deflated_websocket_frame(self.json, wbits,
+                                                             level)
+        return self._deflated[wbits]
+
+
+    def tagged(self, stream):
+        """
+        The JSON with "stream": stream added, for a socket carrying several
+        streams. The shared encoding is spliced, not re-encoded.
+        """
+        return b'{"stream": ' + utf8(serialize(stream)) + b', ' + self.json[1:]
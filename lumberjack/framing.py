@@ -0,0 +1,107 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Turning raw bytes read from a file into whole lines """
+from __future__ import absolute_import
+
+import codecs
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_LINE_LENGTH = 64 * 1024
+
+
+class LineFramer(object):
+    """
+    Splits a stream of byte chunks into decoded lines. A line that's cut
+    off at the end of one chunk is held back and finished by the next, so
+    reads that land mid-line never produce broken entries.
+
+    Chunks are scanned in place through a memoryview; only the bytes of a
+    line that straddles two chunks get copied. Lines longer than
+    max_line_length bytes are truncated, and the rest of them discarded.
+
+    framer = LineFramer()
+    framer.feed(b'first\\nsec')   # ['first']
+    framer.feed(b'ond\\n')        # ['second']
+    """
+
+    def __init__(self, max_line_length=DEFAULT_MAX_LINE_LENGTH,
+                 encoding='utf-8', errors='replace'):
+        self.max_line_length = max_line_length
+        self.encoding        = encoding
+        self.errors          = errors
+        self.decoder         = codecs.getdecoder(encoding)
+        self.partial         = bytearray()
+        self.truncated       = 0  # bytes dropped from the held-back line
+        self.lines_truncated = 0
+        self.lines_dropped   = 0
+
+
+    def feed(self, data):
+        """Returns the list of lines completed by data"""
+
+        lines = list()
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+
+        if self.partial or self.truncated:
+            idx = data.find(b'\n')
+            if idx < 0:
+                self._hold(view)
+                return lines
+            self._hold(view[:idx])
+            self._emit(self.partial, lines, self.truncated)
+            self.partial = bytearray()
+            self.truncated = 0
+            pos = idx + 1
+
+        maxlen = self.max_line_length
+        while pos < end:
+            idx = data.find(b'\n', pos)
+            if idx < 0:
+                self._hold(view[pos:])
+                break
+            if idx - pos > maxlen:
+                self._emit(view[pos:pos+maxlen], lines, idx - pos - maxlen)
+            else:
+                self._emit(view[pos:idx], lines)
+            pos = idx + 1
+
+        return lines
+
+
+    def _hold(self, view):
+        room = self.max_line_length - len(self.partial)
+        if len(view) > room:
+            self.partial.extend(view[:max(room, 0)])
+            self.truncated += len(view) - max(room, 0)
+        else:
+            self.partial.extend(view)
+
+
+    def _emit(self, view, lines, truncated=0):
+        if len(view) and view[-1:] == b'\r':
+            view = view[:-1]
+        try:
+            line = self.decoder(view, self.errors)[0]
+        except UnicodeDecodeError as e:
+            self.lines_dropped += 1
+            log.warning("Dropping a line that isn't valid %s: %s",
+                        self.encoding, e)
+            return
+
+        if truncated:
+            self.lines_truncated += 1
+            line += u' [truncated %d bytes]' % truncated
+        lines.append(line)
@@ -11,31 +11,168 @@
 # under the License.
 from __future__ import absolute_import
 
+import re
+import zlib
 import logging
+from datetime import timedelta
+from functools import partial
+from operator import attrgetter
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
 import tornado.gen
 import tornado.web
 import tornado.ioloop
+import tornado.iostream
 import tornado.websocket
 import tornado.httpclient
+from tornado.escape import utf8
 from tornado.options import options
 
+from .filters import LineFilter
+from .frames import websocket_frame, deflated_websocket_frame
+from .metrics import lumberjack_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from .models import (
     Fellow,
     DEFAULT_FELLOW_NAME,
-    Lodge,
-    ProxyStreamer
+    Subscriber,
+    StreamCredit,
+    TimeWindow
 )
+from .merge import MergedStream
+from .timestamps import parse_time
 from .util import (
     slug, deslug,
-    serialize
+    serialize, deserialize
 )
 
 
+def seq_argument(handler, name='since'):
+    """A sequence number from the query string, or None"""
+    value = handler.get_argument(name, None)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise tornado.web.HTTPError(400, '%s must be a sequence number', name)
+
+
+
+def epoch_argument(handler, since):
+    """?epoch=, the numbering since is in, if there's a since at all"""
+    if since is None:
+        return None
+    return handler.get_argument('epoch', None)
+
+
+
+def time_argument(handler, name):
+    """A unix or ISO 8601 time from the query string, or None"""
+    value = handler.get_argument(name, None)
+    if value is None:
+        return None
+    try:
+        return parse_time(value)
+    except ValueError:
+        raise tornado.web.HTTPError(400, '%s must be a unix or ISO 8601 time',
+                                    name)
+
+
+
+def window_arguments(handler, buf):
+    """
+    (seq to replay from, or None, ?to=<time>, or None, and the epoch the
+    seq was numbered in, or None). ?since=<seq> says where to replay from,
+    with ?epoch= if the client knows it; failing that, ?from=<time> does,
+    as the first line written at or after it.
+    """
+    since = seq_argument(handler)
+    epoch = epoch_argument(handler, since)
+    start = time_argument(handler, 'from')
+    if since is None and start is not None:
+        since = buf.seq_at(start)
+    return since, time_argument(handler, 'to'), epoch
+
+
+
+def merge_arguments(handler, cache):
+    """
+    The files ?file= asks for, as (paths here, {host: [paths there]}). A
+    file elsewhere is given as <host>:<path>, and one on this lumberjack
+    can be too. Unknown local files are a 404.
+    """
+    local, remote = list(), dict()
+    for value in handler.get_arguments('file'):
+        if ':/' in value and not value.startswith('/'):
+            host, path = value.split(':/', 1)
+            path = '/' + path
+        else:
+            host, path = options.name, value
+        if host == options.name:
+            if path not in cache:
+                raise tornado.web.HTTPError(404, 'No such file: %s', path)
+            if path not in local:
+                local.append(path)
+        elif path not in remote.setdefault(host, list()):
+            remote[host].append(path)
+    if not local and not remote:
+        raise tornado.web.HTTPError(400, 'Merge what? Give file')
+    return local, remote
+
+
+
+def merged_stream(handler, identifier, subscriber):
+    """A MergedStream for a merge request's arguments, opened"""
+    local, remote = merge_arguments(handler, handler.cache)
+    try:
+        window = float(handler.get_argument('window', options.merge_window))
+    except ValueError:
+        raise tornado.web.HTTPError(400, 'window must be a number of seconds')
+    merged = MergedStream( identifier, subscriber, options.name, local, remote,
+                           handler.cache, handler.upstreams,
+                           line_filter=filter_argument(handler),
+                           start=time_argument(handler, 'from'),
+                           window=max(window, 0) )
+    merged.open()
+    return merged
+
+
+
+def filter_argument(handler):
+    """The LineFilter the query string asks for, or None"""
+    try:
+        return LineFilter.from_handler(handler)
+    except (ValueError, re.error) as e:
+        raise tornado.web.HTTPError(400, 'Bad filter: %s', e)
+
+
+
+def compression_options():
+    """Websocket compression options for tornado, or None for no compression"""
+    if not options.compression_level:
+        return None
+    return dict(compression_level=options.compression_level)
+
+
+
+def negotiated_wbits(handler):
+    """
+    Window size for a websocket's compressed frames, or None if the client
+    didn't negotiate permessage-deflate.
+    """
+    compressor = getattr(handler.ws_connection, '_compressor', None)
+    if compressor is None:
+        return None
+    return getattr(compressor, '_max_wbits', zlib.MAX_WBITS)
+
+
+
 class BaseHandler(tornado.web.RequestHandler):
 
+    compressor = None
+
     def sender_wants_json(self):
         return 'Accept' in self.request.headers and \
                self.request.headers['Accept'].find('json') > 0
@@ -49,8 +186,100 @@ class BaseHandler(tornado.web.RequestHandler):
             return self.render(template, **kwargs)
 
 
+    def start_compression(self):
+        """Gzip the rest of a streaming response, if the client takes gzip"""
+        if options.compression_level and \
+           'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.add_header('Vary', 'Accept-Encoding')
+            self.compressor = zlib.compressobj(options.compression_level,
+                                               zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+    def write_stream(self, payload, callback=None):
+        """Write and flush one message of a streaming response"""
+        if self.compressor is not None:
+            # sync flush, so the client can decode every message as it arrives
+            payload = self.compressor.compress(payload) + \
+                      self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.write(payload)
+        self.flush(callback=callback)
+
+
+    def finish_stream(self):
+        """End a streaming response, gzip trailer and all"""
+        if self.compressor is not None:
+            self.write(self.compressor.flush())
+            self.compressor = None
+        self.finish()
+
+
+    def stream_subscriber(self):
+        """A Subscriber that streams frames out as this response's JSON"""
+        self.set_header('Content-Type', 'application/json')
+        self.start_compression()
+        return Subscriber( self.write_stream, attrgetter('json'),
+                           close=self.request.connection.close,
+                           policy=options.slow_consumer_policy,
+                           max_bytes=options.subscriber_buffer_bytes,
+                           name=self.request.remote_ip+' http',
+                           transport='http' )
+
+
+
+class BaseSocket(tornado.websocket.WebSocketHandler):
+
+    def get_compression_options(self):
+        return compression_options()
+
+
+    def socket_subscriber(self):
+        """A Subscriber that sends frames out on this websocket"""
+        encode = attrgetter('websocket')
+        wbits = negotiated_wbits(self)
+        if wbits is not None:
+            encode = lambda frame: frame.websocket_deflated(
+                wbits, options.compression_level, options.compression_min_bytes)
+
+        return Subscriber( self.write_frame, encode,
+                           close=self.close,
+                           policy=options.slow_consumer_policy,
+                           max_bytes=options.subscriber_buffer_bytes,
+                           name=self.request.remote_ip+' websocket',
+                           transport='websocket' )
+
+
+    def write_frame(self, payload, callback=None):
+        """Put a shared, already framed message straight on the wire"""
+        if self.ws_connection is None:
+            return
+        try:
+            self.ws_connection.stream.write(payload, callback)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+    def on_message(self, message):
+        pass
+
+
+
+def listing_arguments(handler, default_limit=None):
+    """(q, offset, limit) for a page of a lodge listing"""
+    try:
+        offset = max(int(handler.get_argument('offset', 0)), 0)
+        limit = handler.get_argument('limit', default_limit)
+        limit = None if limit is None else max(int(limit), 0)
+    except ValueError:
+        raise tornado.web.HTTPError(400, 'offset and limit must be numbers')
+    return handler.get_argument('q', None), offset, limit
+
+
 
 class MainHandler(BaseHandler):
+    """Every living lumberjack's files, a page at a time. ?q= searches"""
+
+    PAGE_SIZE = 50
 
     def initialize(self, lodge=None):
         self.lodge = lodge
@@ -60,21 +289,16 @@ class MainHandler(BaseHandler):
     @tornado.gen.coroutine
     def get(self):
         if not self.lodge.authoritative:
-            client = tornado.httpclient.AsyncHTTPClient()
-            response = yield client.fetch( 
-                "http://"+self.lodge.host+":"+str(options.listenport)+"/",
-                headers=dict(Accept="application/json")
-                )
-            log.debug("Lodge get - received response from remote: %s", 
-                      response.body)
-            lodge=Lodge.deserialize(response.body)
+            lodge = yield self.lodge.mirror.get()
         else:
             lodge = self.lodge
 
-        fellows = [ fel.copy() for fel in lodge.alive_lumberjacks() ]
+        q, offset, limit = listing_arguments(self, self.PAGE_SIZE)
+        total, page = lodge.listing(q, offset, limit, alive_only=True)
+        fellows = [ fel.copy() for fel in page ]
 
         for fellow in fellows:
-            if fellow.name != DEFAULT_FELLOW_NAME and \
+            if fellow.name != DEFAULT_FELLOW_NAME and fellow.lumberfiles and \
                fellow.name not in fellow.lumberfiles[0].slug:
                 for f in fellow.lumberfiles:
                     f.slug = fellow.name+'/'+f.slug
@@ -82,30 +306,95 @@ class MainHandler(BaseHandler):
         if self.sender_wants_json():
             self.write(serialize(self.lodge))
         else:
-            self.render("main.html", fellows=fellows)
+            self.render("main.html", fellows=fellows, q=q or '',
+                        offset=offset, limit=limit, total=total)
 
 
 
 class LodgeHandler(BaseHandler):
-    
+    """
+    The lodge's membership. Plain GETs carry an ETag that changes with
+    every check-in. ?since=<version>&epoch=<epoch> answers with just the
+    fellows that checked in since then, as {"delta": true, ...}, and
+    &wait=<seconds> holds the request open until there's something to say.
+
+    Any of ?q=, ?offset= and ?limit= asks for a page of the fellows in name
+    order instead, with the number that matched under 'total'.
+
+    Check-ins are POSTed one fellow at a time, or by regional lodges as
+    {"region": ..., "fellows": [...]}. The reply lists under 'unknown' any
+    fellows that left out their lumberfiles but are new to this lodge.
+    """
+
+    MAX_WAIT = 120
+
     def initialize(self, lodge=None):
         self.lodge = lodge
 
 
+    @tornado.gen.coroutine
     def get(self):
+        since = seq_argument(self)
+        if since is not None and self.get_argument('epoch', None) == self.lodge.epoch:
+            if since == self.lodge.version:
+                try:
+                    wait = min(float(self.get_argument('wait', 0)), self.MAX_WAIT)
+                except ValueError:
+                    raise tornado.web.HTTPError(400, 'wait must be a number of seconds')
+                if wait > 0:
+                    try:
+                        yield tornado.gen.with_timeout( timedelta(seconds=wait),
+                                                        self.lodge.changed )
+                    except tornado.gen.TimeoutError:
+                        pass
+            fellows = self.lodge.changes_since(since)
+            if fellows is not None:
+                self.write(serialize(dict( host=self.lodge.host,
+                                           epoch=self.lodge.epoch,
+                                           version=self.lodge.version,
+                                           delta=True,
+                                           fellows=fellows )))
+                return
+
+        if any(self.get_argument(name, None) is not None
+               for name in ('q', 'offset', 'limit')):
+            q, offset, limit = listing_arguments(self)
+            total, fellows = self.lodge.listing(
+                q, offset, limit,
+                alive_only=self.get_argument('alive', '') not in ('', '0', 'false'))
+            self.write(serialize(dict( host=self.lodge.host,
+                                       epoch=self.lodge.epoch,
+                                       version=self.lodge.version,
+                                       total=total,
+                                       offset=offset,
+                                       fellows=fellows )))
+            return
+
+        self.set_header('ETag', self.lodge.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
         self.write(serialize(self.lodge))
 
     def post(self):
-        fellow = Fellow.deserialize(self.request.body)
-        if fellow.alive():
-            log.debug('Fellow %s checked in', fellow.name)
-            if fellow.name in self.lodge.fellows:
-                self.lodge.fellows[fellow.name].last_checked_in = fellow.last_checked_in
-            else:
-                self.lodge.fellows[fellow.name] = fellow
-        else: # not alive
-            log.warning('Fellow lumberjack %s tried to check '+
-                            'in past curfew. Denied.', fellow.name)
+        data = deserialize(self.request.body)
+        if 'region' in data:
+            log.debug('Region %s forwarded %d check-ins',
+                      data['region'], len(data['fellows']))
+            fellows = [ Fellow.from_dict(f) for f in data['fellows'] ]
+        else:
+            fellows = [ Fellow.from_dict(data) ]
+
+        unknown = list()
+        for fellow in fellows:
+            if fellow.alive():
+                log.debug('Fellow %s checked in', fellow.name)
+                if not self.lodge.check_in(fellow):
+                    unknown.append(fellow.name)
+            else: # not alive
+                log.warning('Fellow lumberjack %s tried to check '+
+                                'in past curfew. Denied.', fellow.name)
+        self.write(serialize(dict(unknown=unknown)))
 
 
 
@@ -120,117 +409,482 @@ class LumberHandler(BaseHandler):
 
         if lumberfile in self.cache:
             self.lumberfile = lumberfile
+            line_filter = filter_argument(self)
             if self.sender_wants_json():
-                # stream it out in json forever by keeping the request open
-                # note: tornado writes json whenever you give a dict to 
-                #   self.write()
-                self.write( dict(logs=[chunk for chunk in self.cache[lumberfile]]) )
-                self.flush()
-
-                def _push(data):
-                    self.write(dict(logs=data))
-                    self.flush()
-                
-                self.cache[lumberfile].subscribe( id(self.request), _push )
+                # stream it out in json forever by keeping the request open.
+                # a client that says where it left off (?since=<seq>) only
+                # gets what it missed, otherwise it gets the whole buffer.
+                # ?from= and ?to= pick out lines by when they were written,
+                # and with ?to= the stream ends once it's past
+                buf = self.cache[lumberfile]
+                subscriber = self.stream_subscriber()
+                since, to, epoch = window_arguments(self, buf)
+                stop = None if to is None else buf.seq_at(to, after=True)
+                subscriber( buf.since(since, line_filter, stop=stop,
+                                      epoch=epoch) )
+                if stop is not None and stop < buf.next_seq:
+                    subscriber.end(self.finish_stream)
+                    return
+                if to is not None:
+                    subscriber = TimeWindow(buf, subscriber, to,
+                                            self.window_over, line_filter)
+                buf.subscribe( id(self.request), subscriber, line_filter )
 
                 log.debug( "Subscribed as streaming request: %s" % (lumberfile) )
             else:
                 self.render( "lumber.html", 
                              filename=lumberfile, 
-                             lumberfile=reduce( lambda x,y: x+'\n'+y, self.cache[lumberfile]) )
+                             seq=self.cache[lumberfile].next_seq,
+                             epoch=self.cache[lumberfile].epoch,
+                             lumberfile='\n'.join(self.cache[lumberfile]
+                                                   if line_filter is None else
+                                                   line_filter.apply(self.cache[lumberfile])) )
         else: # not in the cache
             self.send_error(status_code=404)
             self.flush()
             self.finish()
 
+    def window_over(self):
+        buf = self.cache[self.lumberfile]
+        subscriber = buf.callbacks[id(self.request)]
+        buf.unsubscribe( id(self.request) )
+        subscriber.end(self.finish_stream)
+
     def on_connection_close(self):
-        self.cache[self.lumberfile].unsubscribe( id(self.request) )
+        if id(self.request) in self.cache[self.lumberfile].callbacks:
+            self.cache[self.lumberfile].unsubscribe( id(self.request) )
         log.debug( "Unsubscribed from httpstream. file: %s" 
                        % (self.lumberfile) )
 
 
 
-class LumberSocket(tornado.websocket.WebSocketHandler):
+class LumberSocket(BaseSocket):
 
     def initialize(self, cache=None):
         self.cache = cache
 
     def open(self, lumberfile):
         self.lumberfile = deslug(lumberfile)
-        self.cache[self.lumberfile].subscribe( id(self.stream), 
-                                               lambda data: self.write_message(dict(logs=data)) )
+        subscriber = self.socket_subscriber()
+        line_filter = filter_argument(self)
+        # only replay history to clients that ask for it with ?since=<seq>
+        # or ?from=<time>. ?to=<time> closes the socket once it's past
+        buf = self.cache[self.lumberfile]
+        since, to, epoch = window_arguments(self, buf)
+        stop = None if to is None else buf.seq_at(to, after=True)
+        if since is not None or stop is not None:
+            subscriber( buf.since(since, line_filter, stop=stop, epoch=epoch) )
+        if stop is not None and stop < buf.next_seq:
+            subscriber.end(self.close)
+            return
+        if to is not None:
+            subscriber = TimeWindow(buf, subscriber, to, self.window_over,
+                                    line_filter)
+        buf.subscribe( id(self.stream), subscriber, line_filter )
         log.debug( "Subscribed as websocket: %s" % (self.lumberfile) )
 
-    def on_message(self):
-        pass
+    def window_over(self):
+        buf = self.cache[self.lumberfile]
+        subscriber = buf.callbacks[id(self.stream)]
+        buf.unsubscribe( id(self.stream) )
+        subscriber.end(self.close)
 
     def on_close(self):
         # unsubscribe from the lumberbuffer
-        self.cache[self.lumberfile].unsubscribe( id(self.stream) )
+        if id(self.stream) in self.cache[self.lumberfile].callbacks:
+            self.cache[self.lumberfile].unsubscribe( id(self.stream) )
         log.debug( "Unsubscribed from websocket: %s" % (self.lumberfile) )
 
 
 
+class MultiplexSocket(BaseSocket):
+    """
+    Any number of files over one websocket. The client sends JSON control
+    messages, each naming a stream of its choosing:
+
+        {"op": "subscribe", "stream": 1, "file": "/var/log/messages"}
+        {"op": "credit", "stream": 1, "messages": 10}
+        {"op": "unsubscribe", "stream": 1}
+
+    A subscribe takes since, epoch, from, to and the filter arguments, just
+    like a file's own socket's query string, and credit: how many messages
+    may be sent on the stream before the client grants more with a credit
+    message. Every message sent back says which stream it's for under
+    "stream". A stream that couldn't be subscribed gets one with "error",
+    and one that ended here (past its `to`, or too slow under the
+    disconnect policy) one with "closed".
+    """
+
+    # frames each stream remembers the encoding of, since a Subscriber
+    # asks for queued frames' sizes more than once
+    ENCODED_FRAMES = 16
+
+    def initialize(self, cache=None):
+        self.cache = cache
+        self.streams = dict() # stream -> (lumberfile, subscriber, credit)
+
+    def open(self):
+        log.debug( "Opened multiplexed websocket" )
+
+    def on_message(self, message):
+        try:
+            control = deserialize(message)
+            op, stream = control['op'], control['stream']
+            if isinstance(stream, (list, dict)):
+                raise ValueError(stream)
+        except (ValueError, KeyError, TypeError):
+            return self.send_control(dict(error='Bad control message: %s' % message))
+
+        ops = dict(subscribe=self.subscribe, unsubscribe=self.unsubscribe,
+                   credit=self.credit)
+        if op not in ops:
+            return self.send_control(dict(stream=stream,
+                                          error='Unknown op: %s' % op))
+        try:
+            ops[op](stream, control)
+        except (ValueError, TypeError, re.error) as e:
+            self.send_control(dict(stream=stream, error=str(e)))
+
+    def send_control(self, data):
+        self.write_frame(websocket_frame(utf8(serialize(data) + '\n')))
+
+    def identifier(self, stream):
+        return (id(self.stream), stream)
+
+    def subscribe(self, stream, control):
+        lumberfile = control.get('file')
+        if lumberfile not in self.cache:
+            raise ValueError('No such file: %s' % lumberfile)
+        line_filter = LineFilter.from_arguments(control)
+        since = control.get('since')
+        since = None if since is None else int(since)
+        epoch = None if since is None else control.get('epoch')
+        start, to = [ None if control.get(name) is None else
+                      parse_time(control[name]) for name in ('from', 'to') ]
+        credit = control.get('credit')
+        credit = None if credit is None else int(credit)
+        if credit is not None and credit < 0:
+            raise ValueError('credit must be 0 or more: %d' % credit)
+        credit = StreamCredit(self.write_frame, credit)
+        if stream in self.streams:
+            self.unsubscribe(stream)
+
+        subscriber = Subscriber( credit.write, self.stream_encoder(stream),
+                                 close=partial(self.stream_over, stream, 'slow'),
+                                 policy=options.slow_consumer_policy,
+                                 max_bytes=options.subscriber_buffer_bytes,
+                                 name='%s socket stream %s' % (self.request.remote_ip,
+                                                               stream),
+                                 transport='multiplexed' )
+        self.streams[stream] = (lumberfile, subscriber, credit)
+
+        buf = self.cache[lumberfile]
+        if since is None and start is not None:
+            since = buf.seq_at(start)
+        stop = None if to is None else buf.seq_at(to, after=True)
+        if since is not None or stop is not None:
+            subscriber( buf.since(since, line_filter, stop=stop, epoch=epoch) )
+        if stop is not None and stop < buf.next_seq:
+            return self.stream_over(stream, 'window')
+        callback = subscriber
+        if to is not None:
+            callback = TimeWindow(buf, subscriber, to,
+                                  partial(self.stream_over, stream, 'window'),
+                                  line_filter)
+        buf.subscribe( self.identifier(stream), callback, line_filter )
+        log.debug( "Subscribed multiplexed stream %s to %s", stream, lumberfile )
+
+    def stream_encoder(self, stream):
+        """Encodes frames tagged with stream, for this socket"""
+        wbits = negotiated_wbits(self)
+        encoded = OrderedDict() # id(frame) -> (frame, payload)
+        def encode(frame):
+            key = id(frame)
+            if key in encoded and encoded[key][0] is frame:
+                return encoded[key][1]
+            payload = frame.tagged(stream)
+            if wbits is not None and len(payload) >= options.compression_min_bytes:
+                payload = deflated_websocket_frame(payload, wbits,
+                                                   options.compression_level)
+            else:
+                payload = websocket_frame(payload)
+            encoded[key] = (frame, payload)
+            if len(encoded) > self.ENCODED_FRAMES:
+                encoded.popitem(last=False)
+            return payload
+        return encode
+
+    def stream_over(self, stream, reason):
+        """End a stream from this end, once what's queued has gone out"""
+        if stream not in self.streams:
+            return
+        lumberfile, subscriber, credit = self.streams[stream]
+        self.unsubscribe(stream, close=False)
+        closed = lambda: self.send_control(dict(stream=stream, closed=reason))
+        if subscriber.closed:
+            # cut off as a slow consumer, with its queue thrown away
+            closed()
+        else:
+            subscriber.end(closed)
+
+    def credit(self, stream, control):
+        if stream in self.streams:
+            self.streams[stream][2].grant(int(control.get('messages', 0)))
+
+    def unsubscribe(self, stream, control=None, close=True):
+        if stream not in self.streams:
+            return
+        lumberfile, subscriber, credit = self.streams.pop(stream)
+        buf = self.cache[lumberfile]
+        if self.identifier(stream) in buf.callbacks:
+            buf.unsubscribe( self.identifier(stream) )
+        if close:
+            # drop anything still queued for it
+            subscriber.closed = True
+        log.debug( "Unsubscribed multiplexed stream %s from %s", stream, lumberfile )
+
+    def on_close(self):
+        for stream in list(self.streams):
+            self.unsubscribe(stream)
+        log.debug( "Closed multiplexed websocket" )
+
+
+
+class HistoryHandler(BaseHandler):
+    """
+    Pages through a file's history as JSON, from memory or the spill store.
+    ?start=<seq> or ?after=<unix time> picks the first line, ?count=<n> how
+    many to return, and the usual filter arguments which lines of those
+    make it into the page. Carry on from seq + len(logs) (or 'next', if
+    filtered) for the next page.
+    """
+
+    MAX_COUNT = 10000
+
+    def initialize(self, cache=None):
+        self.cache = cache
+
+    @tornado.gen.coroutine
+    def get(self, lumberfile):
+        lumberfile = deslug(lumberfile)
+        if lumberfile not in self.cache:
+            raise tornado.web.HTTPError(404)
+
+        after = self.get_argument('after', None)
+        try:
+            count = min(int(self.get_argument('count', 100)), self.MAX_COUNT)
+            after = float(after) if after is not None else None
+            history = self.cache[lumberfile].history(
+                start=seq_argument(self, 'start'), after=after, count=count,
+                line_filter=filter_argument(self))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        try:
+            frame = yield history
+        except (IOError, OSError) as e:
+            log.warning( "Couldn't read history of %s: %s", lumberfile, e )
+            raise tornado.web.HTTPError(503, "Couldn't read history: %s" % e)
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(frame.json)
+
+
+
+class SearchHandler(BaseHandler):
+    """
+    The newest lines containing ?q=<text>, ignoring case, from one file's
+    buffer or, at /search, from every file's. ?limit=<n> caps the matches
+    per file, ?context=<n> adds that many lines either side of each, and
+    the usual filter arguments narrow them down. A file's results carry
+    'more' when there are older matches: pass it as ?before=<seq> for the
+    next page.
+    """
+
+    MAX_LIMIT   = 1000
+    MAX_CONTEXT = 50
+
+    def initialize(self, cache=None):
+        self.cache = cache
+
+    @tornado.gen.coroutine
+    def get(self, lumberfile=None):
+        if lumberfile is not None:
+            lumberfile = deslug(lumberfile)
+            if lumberfile not in self.cache:
+                raise tornado.web.HTTPError(404)
+
+        query = self.get_argument('q', '')
+        if not query:
+            raise tornado.web.HTTPError(400, 'Search for what? Give q')
+        try:
+            limit = min(int(self.get_argument('limit', 100)), self.MAX_LIMIT)
+            context = min(int(self.get_argument('context', 0)), self.MAX_CONTEXT)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        arguments = dict(limit=max(limit, 1), context=max(context, 0),
+                         line_filter=filter_argument(self))
+
+        if lumberfile is not None:
+            result = yield self.cache[lumberfile].search(
+                query, before=seq_argument(self, 'before'), **arguments)
+        else:
+            results = yield dict( (name, buf.search(query, **arguments))
+                                  for name, buf in self.cache.items() )
+            result = dict(query=query, files=results)
+        self.write(result)
+
+
+
+class MergeHandler(BaseHandler):
+    """
+    Several files, here or on other lumberjacks, streamed as one in the
+    order their lines were written. ?file=<path> for each file here, or
+    ?file=<host>:<path> for one elsewhere. ?from=<time> starts each with
+    what's buffered since then, and the usual filter arguments apply to
+    every file. Messages carry each line's 'sources' and 'times'.
+    """
+
+    def initialize(self, cache=None, upstreams=None):
+        self.cache = cache
+        self.upstreams = upstreams
+        self.merged = None
+
+    @tornado.web.asynchronous
+    def get(self):
+        if self.sender_wants_json():
+            self.merged = merged_stream(self, id(self.request),
+                                        self.stream_subscriber())
+            log.debug( "Subscribed as merged streaming request" )
+        else:
+            local, remote = merge_arguments(self, self.cache)
+            files = [ options.name+':'+path for path in local ] + \
+                    [ host+':'+path for host, paths in remote.items()
+                      for path in paths ]
+            self.render( "merge.html",
+                         filename=', '.join(files),
+                         seq=None,
+                         epoch=None,
+                         lumberfile='' )
+
+    def on_connection_close(self):
+        if self.merged is not None:
+            self.merged.close()
+        log.debug( "Unsubscribed from merged httpstream" )
+
+
+
+class MergeSocket(BaseSocket):
+
+    def initialize(self, cache=None, upstreams=None):
+        self.cache = cache
+        self.upstreams = upstreams
+        self.merged = None
+
+    def open(self):
+        self.merged = merged_stream(self, id(self.stream),
+                                    self.socket_subscriber())
+        log.debug( "Subscribed as merged websocket" )
+
+    def on_close(self):
+        if self.merged is not None:
+            self.merged.close()
+        log.debug( "Unsubscribed from merged websocket" )
+
+
+
+class StatsHandler(BaseHandler):
+    """Who's subscribed to what, and how far behind they are"""
+
+    def initialize(self, cache=None, upstreams=None):
+        self.cache = cache
+        self.upstreams = upstreams
+
+    def get(self):
+        self.write( dict(
+            files=dict( (lumberfile, buf.subscriber_stats())
+                        for lumberfile, buf in self.cache.items() ),
+            upstreams=self.upstreams.stats() if self.upstreams else []
+            ) )
+
+
+
+class MetricsHandler(BaseHandler):
+    """Everything in /_stats and more, for Prometheus to scrape"""
+
+    def initialize(self, cache=None, upstreams=None, lag=None):
+        self.cache = cache
+        self.upstreams = upstreams
+        self.lag = lag
+
+    def get(self):
+        self.set_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.write( lumberjack_metrics(self.cache, self.upstreams,
+                                       self.lag).text() )
+
+
+
 class ProxyHandler(BaseHandler):
+    """
+    Streams a file from another lumberjack. Every client watching the same
+    file with the same filter shares one upstream connection.
+    """
+
+    def initialize(self, upstreams=None):
+        self.upstreams = upstreams
+        self.upstream = None
 
     @tornado.web.asynchronous
     def get(self, host, lumberfile):
         self.lumberfile, self.host = deslug(lumberfile), host
 
         if self.sender_wants_json():
-            request = tornado.httpclient.HTTPRequest(
-                "ws://"+host+':'+str(options.listenport)+'/'+lumberfile+'/socket', 
-                connect_timeout=900
-                )
-            request = tornado.httpclient._RequestProxy(
-                request, tornado.httpclient.HTTPRequest._DEFAULTS)
-
-            self.conn = ProxyStreamer( tornado.ioloop.IOLoop.current(),
-                                       request,
-                                       output_stream=self ) 
-            # once ProxyStreamer is instantiated, it'll keep writing things to the handler
+            since = seq_argument(self)
+            self.upstream = self.upstreams.subscribe(
+                self.host, self.lumberfile, id(self.request),
+                self.stream_subscriber(),
+                line_filter=filter_argument(self), since=since,
+                epoch=epoch_argument(self, since) )
             log.debug( "Subscribed as streaming proxy host %s file: %s" 
                            % (self.host, self.lumberfile) )
         else:
             self.render( "proxy.html", 
                          host=self.host,
+                         seq=None,
+                         epoch=None,
                          filename=lumberfile )
 
 
     def on_connection_close(self):
-        self.conn.close()
+        if self.upstream is not None:
+            self.upstreams.unsubscribe( self.upstream, id(self.request) )
         log.debug( "Unsubscribed as streaming proxy host %s file: %s" 
                        % (self.host, self.lumberfile) )
 
 
 
-class ProxySocket(tornado.websocket.WebSocketHandler):
+class ProxySocket(BaseSocket):
+
+    def initialize(self, upstreams=None):
+        self.upstreams = upstreams
+        self.upstream = None
+
     def open(self, host, lumberfile):
         self.host = host
         self.lumberfile = deslug(lumberfile)
 
-        request = tornado.httpclient.HTTPRequest(
-            "ws://"+host+':'+str(options.listenport)+'/'+self.lumberfile+'/socket', 
-            connect_timeout=900
-            )
-        request = tornado.httpclient._RequestProxy(
-            request, tornado.httpclient.HTTPRequest._DEFAULTS)
-
-        self.conn = ProxyStreamer( tornado.ioloop.IOLoop.current(), 
-                                   request, 
-                                   output_stream=self, 
-                                   as_websocket=True ) 
+        since = seq_argument(self)
+        self.upstream = self.upstreams.subscribe(
+            self.host, self.lumberfile, id(self.stream),
+            self.socket_subscriber(),
+            line_filter=filter_argument(self), since=since,
+            epoch=epoch_argument(self, since) )
 
         log.debug( "Subscribed as websocket proxy to host %s file %s" 
                        % (self.host, self.lumberfile) )
 
 
-    def on_message(self):
-        pass
-
-
     def on_close(self):
-        self.conn.close()
+        if self.upstream is not None:
+            self.upstreams.unsubscribe( self.upstream, id(self.stream) )
         log.debug( "Unsubscribed websocket proxy to host %s file %s" 
                        % (self.host, self.lumberfile) )
-
@@ -0,0 +1,224 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" One stream of several files' lines, in the order they were written """
+from __future__ import absolute_import
+
+import time
+import heapq
+import logging
+from datetime import timedelta
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+import tornado.ioloop
+
+from .frames import Frame
+
+# lines waiting to be merged, past which the oldest go out regardless
+MAX_HELD_LINES = 50000
+
+
+
+class Merge(object):
+    """
+    A k-way merge of sources of lines into one stream ordered by time.
+    Each source pushes its lines in time order, with their times and what
+    to tag them with; emit gets Frames of merged lines, with the tags under
+    'sources' and the times under 'times', in step with 'logs'.
+
+    The earliest queued line can go out once every source has something
+    queued, since nothing earlier can turn up after it. While some source
+    is quiet, lines wait for it, but no more than `window` seconds after
+    they arrived, or until more than max_lines are waiting. A line that
+    turns up after later ones have gone out is sent anyway, out of order.
+    """
+
+    def __init__(self, emit, window=1.0, max_lines=MAX_HELD_LINES, io_loop=None):
+        self.emit      = emit
+        self.window    = window
+        self.max_lines = max_lines
+        self.io_loop   = tornado.ioloop.IOLoop.current() if io_loop is None else io_loop
+        self.queues    = dict() # source -> deque of (time, line, tag, arrived)
+        self.held      = 0
+        self.timeout   = None
+        self.closed    = False
+
+
+    def add_source(self, source):
+        self.queues.setdefault(source, deque())
+
+
+    def remove_source(self, source):
+        self.held -= len(self.queues.pop(source, ()))
+        self.flush()
+
+
+    def push(self, source, lines, times, tags):
+        if self.closed:
+            return
+        queue = self.queues[source]
+        arrived = time.time()
+        for line, when, tag in zip(lines, times, tags):
+            queue.append( (when, line, tag, arrived) )
+        self.held += len(lines)
+        self.flush()
+
+
+    def flush(self):
+        """Send whatever lines can go out now"""
+        if self.closed:
+            return
+        queues = self.queues
+        # anything that's waited out the window goes, with everything
+        # earlier than it
+        horizon = time.time() - self.window
+        cutoff = None
+        for queue in queues.values():
+            for when, line, tag, arrived in queue:
+                if arrived > horizon:
+                    break
+                cutoff = when if cutoff is None else max(cutoff, when)
+
+        heap = [ (queue[0][0], source) for source, queue in queues.items()
+                 if queue ]
+        heapq.heapify(heap)
+        complete = len(heap) == len(queues)
+        lines, tags, times = list(), list(), list()
+        while heap:
+            when, source = heap[0]
+            if not complete and self.held <= self.max_lines and \
+               (cutoff is None or when > cutoff):
+                break
+            queue = queues[source]
+            when, line, tag, arrived = queue.popleft()
+            lines.append(line)
+            tags.append(tag)
+            times.append(when)
+            self.held -= 1
+            if queue:
+                heapq.heapreplace(heap, (queue[0][0], source))
+            else:
+                heapq.heappop(heap)
+                complete = False
+
+        if lines:
+            self.emit(Frame(dict(logs=lines, sources=tags, times=times)))
+        self._schedule()
+
+
+    def _schedule(self):
+        if self.timeout is not None or not self.held:
+            return
+        oldest = min( queue[0][3] for queue in self.queues.values() if queue )
+        self.timeout = self.io_loop.add_timeout(
+            timedelta(seconds=max(oldest + self.window - time.time(), 0)),
+            self._expired )
+
+
+    def _expired(self):
+        self.timeout = None
+        self.flush()
+
+
+    def close(self):
+        self.closed = True
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+
+
+
+class MergedStream(object):
+    """
+    Files here and on other lumberjacks, merged into one stream for a
+    subscriber. Local files are read straight from their buffers. Each
+    other host's files come over one upstream connection (see
+    lumberjack.proxy), already merged by the lumberjack there, and are
+    merged in here as one source.
+
+    local is a list of paths here, tagged name:path; remote a dict of
+    host -> list of paths, tagged however the lumberjack there tags them.
+    With start, each file begins with whatever's buffered from that unix
+    time on, rather than with the next line written.
+    """
+
+    def __init__(self, identifier, subscriber, name, local, remote,
+                 cache, upstreams, line_filter=None, start=None, window=1.0):
+        self.identifier  = identifier
+        self.subscriber  = subscriber
+        self.name        = name
+        self.local       = local
+        self.remote      = remote
+        self.cache       = cache
+        self.upstreams   = upstreams
+        self.line_filter = line_filter
+        self.start       = start
+        self.merge       = Merge(subscriber, window=window)
+        self.subscribed  = list() # upstreams
+
+
+    def open(self):
+        for path in self.local:
+            self.merge.add_source(path)
+        for host in self.remote:
+            self.merge.add_source(host)
+
+        for path in self.local:
+            buf = self.cache[path]
+            callback = self._local_callback(path, buf)
+            if self.start is not None:
+                callback(buf.since(buf.seq_at(self.start)))
+            # unfiltered, to know each line's seq, so it shares one group
+            # with every other unfiltered subscriber
+            buf.subscribe(self.identifier, callback)
+
+        for host, paths in self.remote.items():
+            self.subscribed.append(self.upstreams.subscribe_merged(
+                host, paths, self.identifier, self._remote_callback(host),
+                line_filter=self.line_filter, start=self.start ))
+
+
+    def _local_callback(self, path, buf):
+        tag = self.name + ':' + path
+        line_filter = self.line_filter
+        def callback(frame):
+            seq = frame.data['seq']
+            lines, times = list(), list()
+            time_of = buf.times.time_of
+            for i, line in enumerate(frame.data['logs']):
+                if line_filter is None or line_filter.match(line):
+                    lines.append(line)
+                    times.append(time_of(seq + i))
+            if lines:
+                self.merge.push(path, lines, times, [tag] * len(lines))
+        return callback
+
+
+    def _remote_callback(self, host):
+        def callback(frame):
+            data = frame.data
+            if data.get('times') is None or not data['logs']:
+                return
+            self.merge.push(host, data['logs'], data['times'], data['sources'])
+        return callback
+
+
+    def close(self):
+        self.merge.close()
+        for path in self.local:
+            buf = self.cache[path]
+            if self.identifier in buf.callbacks:
+                buf.unsubscribe(self.identifier)
+        for upstream in self.subscribed:
+            self.upstreams.unsubscribe(upstream, self.identifier)
+        self.subscribed = list()
@@ -0,0 +1,265 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Prometheus text format for /metrics, and the instruments that need more
+than a plain counter.
+
+The hot paths only ever add to ints and floats that already exist on the
+objects they're about (a buffer, a Subscriber, a Sluice). Everything else
+is worked out when /metrics is scraped.
+"""
+from __future__ import absolute_import
+
+import logging
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+import tornado.ioloop
+
+from . import frames
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a fast callback up to something that stalls everyone
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Counts of observations at or under each of buckets, plus a sum"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1) # the last is +Inf
+        self.sum     = 0.0
+        self.count   = 0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+
+
+class LoopLag(object):
+    """
+    How late the ioloop gets round to a callback it was asked to run
+    interval seconds from now. Anything blocking the loop shows up here.
+    """
+
+    def __init__(self, interval=0.5, io_loop=None):
+        self.interval  = interval
+        self.io_loop   = io_loop or tornado.ioloop.IOLoop.current()
+        self.histogram = Histogram()
+        self.last      = 0.0
+
+
+    def start(self):
+        self._schedule()
+        return self
+
+
+    def _schedule(self):
+        expected = self.io_loop.time() + self.interval
+        self.io_loop.add_timeout(expected, lambda: self._tick(expected))
+
+
+    def _tick(self, expected):
+        self.last = max(self.io_loop.time() - expected, 0.0)
+        self.histogram.observe(self.last)
+        self._schedule()
+
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join( '%s="%s"' % (k, _escape(v))
+                              for k, v in sorted(labels.items()) )
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+
+class Exposition(object):
+    """
+    A page of metrics being put together:
+
+        page = Exposition()
+        page.add('lumberjack_buffer_lines', 'gauge', 'Lines held',
+                 [ (dict(file=name), len(buf)) for name, buf in cache.items() ])
+        handler.write(page.text())
+    """
+
+    def __init__(self):
+        self.lines = list()
+
+
+    def add(self, name, kind, help, samples):
+        """samples are (labels dict, value) pairs"""
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            self.lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+
+    def histograms(self, name, help, series):
+        """series are (labels dict, Histogram) pairs"""
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s histogram' % name)
+        for labels, histogram in series:
+            total = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),),
+                                    histogram.counts):
+                total += count
+                bucket = dict(labels, le=_number(float(bound)))
+                self.lines.append('%s_bucket%s %d' % (name, _labels(bucket), total))
+            self.lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                               _number(histogram.sum)))
+            self.lines.append('%s_count%s %d' % (name, _labels(labels),
+                                                 histogram.count))
+
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+
+def lumberjack_metrics(cache, upstreams=None, lag=None):
+    """Everything a lumberjack knows about itself, as an Exposition"""
+    page = Exposition()
+
+    page.add('lumberjack_ingest_lines_total', 'counter',
+             'Lines appended to each file\'s buffer',
+             [ (dict(file=name), buf.ingested_lines) for name, buf in cache.items() ])
+    page.add('lumberjack_ingest_bytes_total', 'counter',
+             'Bytes read from each file',
+             [ (dict(file=name), buf.ingested_bytes) for name, buf in cache.items() ])
+    page.add('lumberjack_ingest_batches_total', 'counter',
+             'Lists of lines appended to each file\'s buffer, each sent '+
+             'as one frame',
+             [ (dict(file=name), buf.ingested_batches) for name, buf in cache.items() ])
+    page.add('lumberjack_buffer_lines', 'gauge',
+             'Lines held in each file\'s buffer',
+             [ (dict(file=name), len(buf)) for name, buf in cache.items() ])
+    page.add('lumberjack_buffer_capacity_lines', 'gauge',
+             'Most lines each line-bounded buffer holds',
+             [ (dict(file=name), buf.maxlen) for name, buf in cache.items()
+               if getattr(buf, 'maxlen', None) ])
+    page.add('lumberjack_buffer_bytes', 'gauge',
+             'Bytes held in each byte-bounded buffer',
+             [ (dict(file=name), buf.nbytes) for name, buf in cache.items()
+               if hasattr(buf, 'max_bytes') ])
+    page.add('lumberjack_buffer_capacity_bytes', 'gauge',
+             'Most bytes each byte-bounded buffer holds',
+             [ (dict(file=name), buf.max_bytes) for name, buf in cache.items()
+               if hasattr(buf, 'max_bytes') ])
+
+    page.add('lumberjack_search_index_chunks', 'gauge',
+             'Chunks of lines whose text each file\'s search index holds',
+             [ (dict(file=name), buf.index.nchunks) for name, buf in cache.items()
+               if buf.index is not None ])
+    page.add('lumberjack_search_index_postings', 'gauge',
+             'Trigram postings in each file\'s search index',
+             [ (dict(file=name), buf.index.npostings) for name, buf in cache.items()
+               if buf.index is not None ])
+
+    subscribers = dict()
+    backlog = list()
+    for name, buf in cache.items():
+        for identifier, callback in buf.callbacks.items():
+            transport = getattr(callback, 'transport', None) or 'internal'
+            key = (name, transport)
+            subscribers[key] = subscribers.get(key, 0) + 1
+            if hasattr(callback, 'queued_bytes'):
+                backlog.append( (dict(file=name, transport=transport,
+                                      subscriber=callback.name, id=identifier),
+                                 callback) )
+    page.add('lumberjack_subscribers', 'gauge',
+             'Subscribers to each file, by transport',
+             [ (dict(file=name, transport=transport), count)
+               for (name, transport), count in subscribers.items() ])
+    page.add('lumberjack_subscriber_queued_bytes', 'gauge',
+             'Bytes waiting to go out to each subscriber',
+             [ (labels, s.queued_bytes) for labels, s in backlog ])
+    page.add('lumberjack_subscriber_sent_bytes_total', 'counter',
+             'Bytes sent to each subscriber',
+             [ (labels, s.sent_bytes) for labels, s in backlog ])
+    page.add('lumberjack_subscriber_dropped_lines_total', 'counter',
+             'Lines each subscriber missed for being too slow',
+             [ (labels, s.dropped_lines) for labels, s in backlog ])
+
+    stats = frames.encode_stats
+    page.add('lumberjack_encode_seconds_total', 'counter',
+             'Time spent encoding frames, by format',
+             [ (dict(format='json'), stats.json_seconds),
+               (dict(format='deflate'), stats.deflate_seconds) ])
+    page.add('lumberjack_encodes_total', 'counter',
+             'Frames encoded, by format',
+             [ (dict(format='json'), stats.json_count),
+               (dict(format='deflate'), stats.deflate_count) ])
+
+    if upstreams is not None:
+        live = list(upstreams.upstreams.values())
+        def upstream_labels(upstream, **labels):
+            line_filter, lumberfile = upstream.line_filter, upstream.lumberfile
+            if isinstance(lumberfile, tuple):
+                # a merged upstream's files
+                lumberfile = ','.join(lumberfile)
+            return dict(labels, host=upstream.host, file=lumberfile,
+                        filter='' if line_filter is None else
+                               urlencode(sorted(line_filter.arguments().items())))
+        page.add('lumberjack_proxy_upstreams', 'gauge',
+                 'Connections to other lumberjacks for proxied files',
+                 [ (dict(), len(live)) ])
+        proxied = list()
+        for upstream in live:
+            transports = dict()
+            for callback in upstream.callbacks.values():
+                transport = getattr(callback, 'transport', None) or 'internal'
+                transports[transport] = transports.get(transport, 0) + 1
+            proxied.extend( (upstream_labels(upstream, transport=transport), count)
+                            for transport, count in transports.items() )
+        page.add('lumberjack_proxy_subscribers', 'gauge',
+                 'Subscribers to each proxied file, by transport',
+                 proxied)
+        page.add('lumberjack_proxy_received_bytes_total', 'counter',
+                 'Bytes received from each upstream',
+                 [ (upstream_labels(u), u.received_bytes) for u in live ])
+        page.add('lumberjack_proxy_reconnects_total', 'counter',
+                 'Times each upstream had to reconnect',
+                 [ (upstream_labels(u), u.reconnects) for u in live ])
+
+    if lag is not None:
+        page.histograms('lumberjack_ioloop_lag_seconds',
+                        'How late the ioloop ran timed callbacks',
+                        [ (dict(), lag.histogram) ])
+    return page
@@ -11,22 +11,36 @@
 # under the License.
 from __future__ import absolute_import
 
+import sys
+import time
+import random
 import socket
 import logging
 import datetime
+from array import array
+from itertools import islice
 from collections import deque
 from functools import partial
+from operator import attrgetter
 
 log = logging.getLogger(__name__)
 
+import tornado.gen
 import tornado.ioloop
 import tornado.websocket
 import tornado.httpclient
+from tornado.ioloop import IOLoop
+from tornado.httputil import url_concat
+from tornado.concurrent import Future
 from tornado.options import options
 
+from .frames import Frame
+from . import search
+from .timestamps import LineTimes
 from .util import (
     serialize, deserialize,
-    now
+    now,
+    UINT64
 )
 
 hostname = socket.gethostname()
@@ -35,11 +49,55 @@ DEFAULT_CURFEW      = datetime.timedelta(minutes=20)
 DEFAULT_FELLOW_NAME = hostname
 DEFAULT_LODGE_NAME  = hostname
 
+# how often a regional lodge forwards its check-ins to its parent
+DEFAULT_FORWARD_INTERVAL = datetime.timedelta(seconds=10)
+
+# check-ins a lodge remembers for followers asking what changed
+CHANGE_LOG_LENGTH   = 1024
+
+
+def lodge_url(host):
+    """Where the lodge on host takes check-ins. host can include a port"""
+    if ':' not in host:
+        host += ':'+str(options.listenport)
+    return "http://"+host+"/lodge"
+
+
 
 class Lodge(object):
-    """ Where all the lumberjacks check in. Shows living lumberjacks"""
+    """
+    Where all the lumberjacks check in. Shows living lumberjacks
+
+    Every check-in bumps version and is remembered for a while, so followers
+    can ask for just what changed since the version they have (see
+    changes_since) or wait for the next change. epoch is different every
+    time a lodge starts, so followers notice a restart and refetch.
+
+    A lodge on another host is read through a LodgeMirror.
+
+    Big fleets can be split into regions: a lodge with a parent takes
+    check-ins from its own lumberjacks and every so often forwards what
+    changed to the parent in one batch, leaving out lumberfiles the parent
+    already has.
+    """
+
+    def __init__(self, fellows, host=None, check_in=True, parent=None,
+                 forward_interval=DEFAULT_FORWARD_INTERVAL):
+        self.version = 0
+        self.epoch   = '%x' % random.getrandbits(32)
+        self.changes = deque(maxlen=CHANGE_LOG_LENGTH) # (version, fellow name)
+        self.changed = Future()
+        self.mirror  = None
+        self.parent  = parent
+        self.listeners = list() # called with the name of each fellow that checks in
+        self.sorted  = list() # fellows by name, for listings
+        self.sorted_version = None # the version they were sorted at
+
+        # what the lodge we check in with already knows
+        self.lodge_has_files = False
+        self.forwarded       = 0      # version last forwarded to the parent
+        self.parent_has_files = set() # fellow names
 
-    def __init__(self, fellows, host=None, check_in=True):
         if host is None:
             # start your own lodge
             self.host = DEFAULT_FELLOW_NAME
@@ -55,6 +113,7 @@ class Lodge(object):
             if check_in:
                 self.httpclient = tornado.httpclient.AsyncHTTPClient()
                 check_in_func = partial(self.check_in_remotely, fellows[0])
+                self.start_mirror()
 
         if check_in:
             check_in_func()
@@ -63,10 +122,93 @@ class Lodge(object):
                 check_in_func,
                 check_in_frequency
                 ).start()
+
+        if parent is not None:
+            self.httpclient = tornado.httpclient.AsyncHTTPClient()
+            if check_in:
+                tornado.ioloop.PeriodicCallback(
+                    self.forward_to_parent,
+                    forward_interval.total_seconds() * 1000
+                    ).start()
             
 
+    def start_mirror(self):
+        """Keep a local copy of the remote lodge's membership"""
+        self.mirror = LodgeMirror(self.host, ttl=options.lodge_ttl)
+        if options.lodge_push:
+            IOLoop.current().spawn_callback(self.mirror.follow)
+
+
+    @property
+    def etag(self):
+        return '"%s-%d"' % (self.epoch, self.version)
+
+
+    def check_in(self, fellow):
+        """
+        Record a check-in posted by fellow. A check-in without lumberfiles
+        means they haven't changed; if this lodge doesn't know the fellow
+        (say it's been restarted) it's ignored, and False returned so the
+        fellow can send them.
+        """
+        if fellow.name in self.fellows:
+            known = self.fellows[fellow.name]
+            known.last_checked_in = fellow.last_checked_in
+            if fellow.lumberfiles is not None:
+                known.lumberfiles = fellow.lumberfiles
+        elif fellow.lumberfiles is None:
+            return False
+        else:
+            self.fellows[fellow.name] = fellow
+        self._changed(fellow.name)
+        return True
+
+
+    def listing(self, q=None, offset=0, limit=None, alive_only=False):
+        """
+        (how many fellows match, the page of them from offset on) in name
+        order. q matches a fellow's name or any of its files' paths.
+        """
+        if self.sorted_version != self.version:
+            # a check-in can join a fellow or swap in a new copy of one
+            self.sorted = sorted(self.fellows.values(), key=attrgetter('name'))
+            self.sorted_version = self.version
+        fellows = self.sorted
+        if alive_only:
+            fellows = [ f for f in fellows if f.alive() ]
+        if q:
+            fellows = [ f for f in fellows if q in f.name or
+                        any(q in l.path for l in f.lumberfiles) ]
+        stop = None if limit is None else offset + limit
+        return len(fellows), fellows[offset:stop]
+
+
+    def _changed(self, name):
+        self.version += 1
+        self.changes.append( (self.version, name) )
+        changed, self.changed = self.changed, Future()
+        changed.set_result(self.version)
+        for listener in self.listeners:
+            listener(name)
+
+
+    def changes_since(self, version):
+        """
+        The fellows that checked in after version, or None if that's too
+        long ago to remember and the whole lodge is needed.
+        """
+        if version > self.version:
+            return None
+        if version < self.version and \
+           (not self.changes or self.changes[0][0] > version + 1):
+            return None
+        names = set( name for v, name in self.changes if v > version )
+        return [ self.fellows[name] for name in names if name in self.fellows ]
+
+
     def check_in_locally(self, fellow):
         self.fellows[fellow.name].last_checked_in = now()
+        self._changed(fellow.name)
         log.debug('Locally posted check-in for %s', fellow.name)
 
     
@@ -74,25 +216,78 @@ class Lodge(object):
         def _check_in_cb(resp):
             if resp.code == 200:
                 log.debug('Posted check-in: %d', resp.code)
+                unknown = deserialize(resp.body).get('unknown') if resp.body else None
+                if unknown:
+                    # the lodge forgot us, so tell it everything
+                    self.lodge_has_files = False
+                    self.check_in_remotely(fellow)
+                else:
+                    self.lodge_has_files = True
             else:
                 msg = ('Failed to post check-in.\n'+
                        '%d: %s'%(resp.code, resp.body))
                 log.error(msg)
 
         fellow.last_checked_in = now()
+        body = fellow._serialize()
+        if self.lodge_has_files:
+            del body['lumberfiles']
+        body = serialize(body)
 
         if log.isEnabledFor(logging.DEBUG):
-            log.debug("Posting check-in: %s", serialize(fellow))
+            log.debug("Posting check-in: %s", body)
 
         request = tornado.httpclient.HTTPRequest(
-            url="http://"+self.host+":"+str(options.listenport)+"/lodge",
+            url=lodge_url(self.host),
             method="POST",
-            body=serialize(fellow)
+            body=body
             )
 
         self.httpclient.fetch( request, callback=_check_in_cb )
 
 
+    def forward_to_parent(self):
+        """
+        Send the parent lodge every check-in since the last forward. Returns
+        the request's Future, or None if there was nothing to send.
+        """
+        fellows = self.changes_since(self.forwarded)
+        if fellows is None:
+            # too much has happened to say what, so send everyone
+            fellows = list(self.fellows.values())
+            self.parent_has_files.clear()
+        if not fellows:
+            return
+
+        def _forward_cb(resp, version=self.version, sent=None):
+            if resp.code != 200:
+                log.error('Failed to forward %d check-ins to %s. %d: %s',
+                          len(sent), self.parent, resp.code, resp.body)
+                return
+            self.forwarded = max(self.forwarded, version)
+            self.parent_has_files.update(sent)
+            for name in deserialize(resp.body).get('unknown', ()):
+                # it'll go with its files next time
+                self.parent_has_files.discard(name)
+                self._changed(name)
+
+        batch = list()
+        for fellow in fellows:
+            data = fellow._serialize()
+            if fellow.name in self.parent_has_files:
+                del data['lumberfiles']
+            batch.append(data)
+
+        request = tornado.httpclient.HTTPRequest(
+            url=lodge_url(self.parent),
+            method="POST",
+            body=serialize(dict(region=self.host, fellows=batch))
+            )
+        log.debug('Forwarding %d check-ins to %s', len(batch), self.parent)
+        return self.httpclient.fetch( request, callback=partial(
+            _forward_cb, sent=[ f.name for f in fellows ]) )
+
+
     def alive_lumberjacks(self):
         return [ fellow for fellow in self.fellows.values() if fellow.alive() ]
 
@@ -100,6 +295,8 @@ class Lodge(object):
     def _serialize(self):
         return dict( 
             host=self.host,
+            epoch=self.epoch,
+            version=self.version,
             fellows=list( self.fellows.values() )
             )
 
@@ -107,9 +304,12 @@ class Lodge(object):
     @staticmethod
     def from_dict(data):
         data['fellows'] = [ Fellow.from_dict(f) for f in data['fellows'] ]
-        return Lodge( data['fellows'],
-                      host=data['host'],
-                      check_in=False )        
+        lodge = Lodge( data['fellows'],
+                       host=data['host'],
+                       check_in=False )        
+        lodge.epoch = data.get('epoch', lodge.epoch)
+        lodge.version = data.get('version', 0)
+        return lodge
 
 
     @staticmethod
@@ -118,6 +318,103 @@ class Lodge(object):
         return Lodge.from_dict(data)
 
 
+
+class LodgeMirror(object):
+    """
+    A local copy of a lodge on another host, so pages can be rendered
+    without asking it anything.
+
+    With follow() running, the lodge pushes every check-in here as it
+    happens (GET /lodge?since=<version> is a long poll for changes) and the
+    copy is always current. Without it, or while the lodge is unreachable,
+    the copy is trusted for ttl seconds and then revalidated with
+    If-None-Match, which costs the lodge nothing if nobody's checked in.
+    """
+
+    WAIT = 60 # seconds a long poll is held open by the lodge
+
+    def __init__(self, host, ttl=60):
+        self.host       = host
+        self.ttl        = ttl
+        self.lodge      = None
+        self.fetched_at = 0
+        self.following  = False
+        self.httpclient = tornado.httpclient.AsyncHTTPClient()
+
+
+    @property
+    def url(self):
+        return lodge_url(self.host)
+
+
+    @tornado.gen.coroutine
+    def get(self):
+        """The lodge, fetched or revalidated only if the copy's gone stale"""
+        if self.lodge is None or \
+           (not self.following and time.time() - self.fetched_at > self.ttl):
+            yield self.refresh()
+        raise tornado.gen.Return(self.lodge)
+
+
+    @tornado.gen.coroutine
+    def refresh(self):
+        headers = dict(Accept="application/json")
+        if self.lodge is not None:
+            headers['If-None-Match'] = self.lodge.etag
+        response = yield self.httpclient.fetch( self.url, headers=headers,
+                                                raise_error=False )
+        if response.code == 304:
+            self.fetched_at = time.time()
+        elif response.code == 200:
+            self.lodge = Lodge.deserialize(response.body)
+            self.fetched_at = time.time()
+        elif self.lodge is None:
+            response.rethrow()
+        else:
+            log.warning("Couldn't revalidate lodge %s: %s",
+                        self.host, response.error)
+
+
+    def apply(self, data):
+        """Fold a full listing or a delta from the lodge into the copy"""
+        if not data.get('delta') or self.lodge is None:
+            self.lodge = Lodge.from_dict(data)
+        else:
+            for fellow in data['fellows']:
+                fellow = Fellow.from_dict(fellow)
+                self.lodge.fellows[fellow.name] = fellow
+            self.lodge.version = data['version']
+            self.lodge.sorted_version = None
+        self.fetched_at = time.time()
+
+
+    @tornado.gen.coroutine
+    def follow(self):
+        """Keep the copy current by long polling the lodge for changes"""
+        delay = 1
+        while True:
+            url = self.url
+            if self.lodge is not None:
+                url = url_concat(url, dict(since=self.lodge.version,
+                                           epoch=self.lodge.epoch,
+                                           wait=self.WAIT))
+            try:
+                response = yield self.httpclient.fetch(
+                    url, headers=dict(Accept="application/json"),
+                    request_timeout=self.WAIT + 30 )
+                self.apply( deserialize(response.body) )
+                self.following = True
+                delay = 1
+            except Exception as e:
+                # fall back on ttl revalidation until the lodge is back
+                self.following = False
+                log.warning("Lost the lodge feed from %s (%s), retrying in %d seconds",
+                            self.host, e, delay)
+                yield tornado.gen.sleep(delay)
+                delay = min(delay * 2, 60)
+
+
+
 class Fellow(object):
 
     def __init__(self, name=None, curfew=None, 
@@ -145,7 +442,10 @@ class Fellow(object):
         data['last_checked_in'] = datetime.datetime.fromtimestamp(
             float(data['last_checked_in']) )
         data['curfew'] = datetime.timedelta(seconds=data['curfew'])
-        data['lumberfiles'] = [ AttrBag(**l) for l in data['lumberfiles'] ]
+        if data.get('lumberfiles') is not None:
+            data['lumberfiles'] = [ AttrBag(**l) for l in data['lumberfiles'] ]
+        else: # unchanged since the last check-in
+            data['lumberfiles'] = None
         return Fellow(**data)
 
 
@@ -160,67 +460,626 @@ class Fellow(object):
 
 
 
-class LumberBuffer(deque):
+class BaseLumberBuffer(object):
+    """
+    The subscription and numbering half of a LumberBuffer. Subclasses store
+    the lines; they call _published() after storing each appended list and
+    provide __len__, __iter__ and lines_from(index, stop).
+
+    With a spill store (see lumberjack.spill) every line is also written to
+    disk, and history() can page through far more than fits in memory.
+    Numbering carries on from wherever the store left off.
+
+    With a SearchIndex (see lumberjack.search), search() finds lines in a
+    buffer of millions in milliseconds. Without one it scans the buffer.
+
+    Every line is stamped with when it was written, from the line itself
+    if there's a TimestampParser (see lumberjack.timestamps) and it finds a
+    time there, or else when it arrived. seq_at() finds the first line of
+    a time range by binary search.
+
+    Subscribers can pass a LineFilter. Subscribers with equal filters share
+    one group: each appended line goes through each group's filter once,
+    and the group shares one Frame of whatever passed. Filtered frames skip
+    lines, so they also carry 'next', the seq to resume from.
+    """
+
+    def __init__(self, spill=None, index=None, timestamps=None, capacity=1024):
+        self.callbacks = dict()  # identifier -> callback
+        self.groups    = dict()  # LineFilter or None -> {identifier: callback}
+        self.filters   = dict()  # identifier -> LineFilter or None
+        self.spill     = spill
+        self.index     = index
+        self.times     = LineTimes(timestamps, capacity)
+        self.next_seq  = 0 if spill is None else spill.next_seq
+        # which numbering seqs belong to: a new one whenever they start over
+        self.epoch     = spill.epoch if spill is not None else None
+        if self.epoch is None:
+            self.epoch = '%x' % random.getrandbits(32)
+        self.ingested_lines = 0
+        self.ingested_bytes = 0 # counted by whoever reads the file
+        self.ingested_batches = 0
+
+
+    def __str__(self):
+        return str( len(self) )
+
+
+    def append(self, item):
+        self.append_list([item])
+
+
+    def _published(self, l):
+        seq = self.next_seq
+        self.next_seq += len(l)
+        self.ingested_lines += len(l)
+        self.ingested_batches += 1
+        self.times.add(seq, l, len(self))
+        if self.spill is not None:
+            self.spill.append(l)
+        if self.index is not None:
+            self.index.add(seq, l)
+            self.index.prune(self.first_seq)
+        if not self.callbacks:
+            return
+
+        frame = Frame(dict(logs=l, seq=seq, epoch=self.epoch))
+        for line_filter, callbacks in list(self.groups.items()):
+            if line_filter is None:
+                shared = frame
+            else:
+                lines = line_filter.apply(l)
+                if not lines:
+                    continue
+                shared = Frame(dict(logs=lines, seq=seq, next=self.next_seq,
+                                    epoch=self.epoch))
+            for callback in list(callbacks.values()):
+                callback(shared)
+
+
+    @property
+    def first_seq(self):
+        return self.next_seq - len(self)
+
+
+    def replicate(self, seq, lines, reset=False, epoch=None):
+        """
+        Append lines numbered from seq by a buffer in another process (see
+        lumberjack.bus), skipping any already here. With reset, or if lines
+        were missed in between, whatever's buffered is thrown away and
+        numbering carries on from seq. epoch is the other buffer's, which
+        this one takes on so clients see the same numbering everywhere.
+        """
+        if epoch is not None and epoch != self.epoch:
+            self.epoch = epoch
+            reset = True
+        if reset or seq > self.next_seq:
+            self.clear()
+            self.next_seq = seq
+        elif seq < self.next_seq:
+            lines = lines[self.next_seq - seq:]
+        if lines:
+            self.append_list(lines)
+
+
+    def since(self, seq=None, line_filter=None, stop=None, epoch=None):
+        """
+        A Frame of every buffered line numbered seq or later, and before
+        stop if that's given, or the whole buffer if seq is None. If lines
+        the client wanted have already aged out, the frame says how many
+        under 'gap'. A seq from the future (say, from before a restart) gets
+        the whole buffer too.
+
+        epoch is the one seq was numbered in. If it isn't this buffer's,
+        numbering has started over since (the lumberjack restarted without
+        a spill store, say) and seq means nothing here: the frame has the
+        whole buffer, marked 'reset'.
+        """
+        first = self.first_seq
+        reset = seq is not None and epoch is not None and epoch != self.epoch
+        if seq is None or seq > self.next_seq or reset:
+            seq = first
+        stop = self.next_seq if stop is None else max(stop, seq, first)
+        data = dict(logs=self.lines_from(max(seq - first, 0), stop - first),
+                    seq=max(seq, first), epoch=self.epoch)
+        if seq < first:
+            data['gap'] = first - seq
+        if reset:
+            data['reset'] = True
+        if line_filter is not None:
+            data['logs'] = line_filter.apply(data['logs'])
+            data['next'] = stop
+        return Frame(data)
+
+
+    def seq_at(self, when, after=False):
+        """
+        The seq of the first buffered line written at or after unix time
+        when (strictly after, with after), or next_seq if none was
+        """
+        return self.times.seq_at(when, after)
+
+
+    def history(self, start=None, after=None, count=100, line_filter=None):
+        """
+        A Future resolving to a Frame of up to count lines, beginning with
+        line number start or with the first line written after unix time
+        `after`, less whatever line_filter drops. Ranges still in memory are
+        served from memory; anything older is read from the spill store off
+        the ioloop.
+        """
+        first = self.first_seq
+        if after is None and (start is None or start >= first or
+                              self.spill is None):
+            start = first if start is None else start
+            index = max(start - first, 0)
+            future = Future()
+            future.set_result(self._history_frame(
+                start, max(start, first), self.lines_from(index, index+count),
+                line_filter))
+            return future
+
+        if self.spill is None:
+            raise ValueError('History by time needs a spill store')
+        if after is not None:
+            read = self.spill.read_after_async(after, count)
+        else:
+            read = self.spill.read_async(start, count)
+
+        future = Future()
+        io_loop = IOLoop.current()
+        def _done(read):
+            try:
+                seq, lines = read.result()
+            except Exception:
+                # say a segment expired out from under the read
+                future.set_exc_info(sys.exc_info())
+                return
+            future.set_result(self._history_frame(start, seq, lines,
+                                                  line_filter))
+        read.add_done_callback(lambda read: io_loop.add_callback(_done, read))
+        return future
+
+
+    def search(self, query, limit=100, context=0, before=None, line_filter=None):
+        """
+        A Future resolving to the newest lines containing query, ignoring
+        case. See lumberjack.search.search.
+        """
+        return search.search(self, query, limit=limit, context=context,
+                             before=before, line_filter=line_filter)
+
+
+    @staticmethod
+    def _history_frame(wanted, seq, lines, line_filter=None):
+        data = dict(logs=lines, seq=seq)
+        if wanted is not None and wanted < seq:
+            data['gap'] = seq - wanted
+        if line_filter is not None:
+            data['logs'] = line_filter.apply(lines)
+            data['next'] = seq + len(lines)
+        return Frame(data)
+
+
+    def subscribe(self, identifier, callback, line_filter=None):
+        if identifier in self.callbacks:
+            self.unsubscribe(identifier)
+        self.callbacks[identifier] = callback
+        self.filters[identifier] = line_filter
+        self.groups.setdefault(line_filter, dict())[identifier] = callback
+
+
+    def unsubscribe(self, identifier):
+        del(self.callbacks[identifier])
+        line_filter = self.filters.pop(identifier)
+        group = self.groups[line_filter]
+        del(group[identifier])
+        if not group:
+            del(self.groups[line_filter])
+
+
+    def subscriber_stats(self):
+        return [ callback.stats() for callback in self.callbacks.values()
+                 if hasattr(callback, 'stats') ]
+
+
+
+class LumberBuffer(BaseLumberBuffer, deque):
     """
     LumberBuffer keeps a running, fixed-length, buffer of everything appended to it.
     Whenever something calls append(), LumberBuffer calls whatever callbacks added
-    by previous calls to subscribe().
+    by previous calls to subscribe() with a Frame of the new lines. The frame
+    is shared by every callback, so it's only ever encoded once.
+
+    Every line gets a sequence number one higher than the line before it.
+    Frames carry the number of their first line as 'seq', and since() gives
+    back whatever a client that has seen everything before a given number
+    is missing.
 
     Use should be something like:
     buf = LumberBuffer(maxlen=100)
-    def my_callback(item):
-        print "I just appended something"
+    def my_callback(frame):
+        print "I just appended something", frame.data['logs']
 
-    buf.subscribe(my_callback)
+    buf.subscribe('me', my_callback)
 
     for i in range(5):
         buf.append(i)
     """
 
-    def __init__(self, maxlen=200):
-        self.callbacks = dict()
-        super(LumberBuffer, self).__init__(maxlen=maxlen)
+    def __init__(self, maxlen=200, spill=None, index=None, timestamps=None):
+        BaseLumberBuffer.__init__(self, spill=spill, index=index,
+                                  timestamps=timestamps, capacity=maxlen or 1024)
+        deque.__init__(self, maxlen=maxlen)
 
+        
+    def append_list(self, l):
+        self.extend(l)
+        self._published(l)
 
-    def __str__(self):
-        return str( len(self) )
 
-        
-    def append(self, item):
-        super(LumberBuffer, self).append(item)
-        for callback in self.callbacks.values():
-            callback(item)
+    def lines_from(self, index, stop=None):
+        return list(islice(self, index, stop))
+
+
+
+class CompactLumberBuffer(BaseLumberBuffer):
+    """
+    A LumberBuffer bounded by bytes instead of lines. Lines are stored UTF-8
+    encoded, back to back, in one preallocated bytearray used as a ring;
+    two arrays index where each line starts and how long it is. That's 12
+    bytes of bookkeeping per line instead of a str object each, and a file
+    full of 64KB stack traces can't use more memory than one of short lines.
+
+    Positions in the ring are kept as ever-increasing virtual offsets. A
+    line that wouldn't fit before the physical end of the ring starts over
+    at its beginning instead, so every line is contiguous and views() can
+    hand out plain memoryview slices. Those views are only good until the
+    next append overwrites them.
+    """
+
+    INITIAL_INDEX_SIZE = 1024
+
+    def __init__(self, max_bytes=1024*1024, spill=None, index=None,
+                 timestamps=None):
+        BaseLumberBuffer.__init__(self, spill=spill, index=index,
+                                  timestamps=timestamps)
+        self.max_bytes = max_bytes
+        self.ring      = bytearray(max_bytes)
+        self.starts    = array(UINT64, [0]) * self.INITIAL_INDEX_SIZE
+        self.lengths   = array('I', [0]) * self.INITIAL_INDEX_SIZE
+        self.head      = 0 # index slot of the oldest line
+        self.count     = 0
+        self.end       = 0 # virtual offset where the next line goes
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __iter__(self):
+        for view in self.views():
+            yield view.tobytes().decode('utf-8')
+
+
+    def clear(self):
+        self.head = self.count = 0
+
+
+    @property
+    def nbytes(self):
+        """Bytes of line data currently held"""
+        if not self.count:
+            return 0
+        return self.end - self.starts[self.head]
+
 
-        
     def append_list(self, l):
-        super(LumberBuffer, self).extend(item for item in l)
-        for callback in self.callbacks.values():
-            callback(l)
+        for line in l:
+            self._store(line.encode('utf-8'))
+        self._published(l)
 
 
-    def subscribe(self, identifier, callback):
-        self.callbacks[identifier] = callback
+    def _store(self, data):
+        size = self.max_bytes
+        if len(data) > size:
+            # cut on a character boundary, so the line still decodes
+            data = data[:size].decode('utf-8', 'ignore').encode('utf-8')
+        length = len(data)
 
+        start = self.end
+        if start % size + length > size:
+            start += size - start % size # wrap to the beginning of the ring
+        self.end = start + length
+
+        # evict whatever the new line is about to overwrite
+        floor = self.end - size
+        while self.count and self.starts[self.head] < floor:
+            self.head = (self.head + 1) % len(self.starts)
+            self.count -= 1
+
+        if self.count == len(self.starts):
+            self._grow_index()
+        slot = (self.head + self.count) % len(self.starts)
+        self.starts[slot], self.lengths[slot] = start, length
+        self.count += 1
+
+        offset = start % size
+        self.ring[offset:offset+length] = data
 
-    def unsubscribe(self, identifier):
-        del(self.callbacks[identifier])
+
+    def _grow_index(self):
+        capacity = len(self.starts)
+        order = [ (self.head + i) % capacity for i in range(self.count) ]
+        self.starts  = array(UINT64, [ self.starts[i] for i in order ]) + \
+                       array(UINT64, [0]) * capacity
+        self.lengths = array('I', [ self.lengths[i] for i in order ]) + \
+                       array('I', [0]) * capacity
+        self.head = 0
+
+
+    def views(self, index=0, stop=None):
+        """memoryviews of each buffered line, oldest first, from index on"""
+        ring = memoryview(self.ring)
+        size, capacity = self.max_bytes, len(self.starts)
+        stop = self.count if stop is None else min(stop, self.count)
+        for i in range(index, stop):
+            slot = (self.head + i) % capacity
+            offset = self.starts[slot] % size
+            yield ring[offset:offset+self.lengths[slot]]
+
+
+    def lines_from(self, index, stop=None):
+        return [ view.tobytes().decode('utf-8')
+                 for view in self.views(index, stop) ]
+
+
+
+class Subscriber(object):
+    """
+    A bounded output queue between a LumberBuffer and one client. Frames go
+    straight out while the client's connection is idle; while a write is
+    still draining they queue up, and once more than max_bytes are waiting
+    the policy decides what gives:
+
+    drop       -- discard the oldest queued frames, then tell the client how
+                  many lines it missed with a {"logs": [], "gap": n} frame
+                  whose seq is the first line after the gap
+    coalesce   -- like drop, but everything that queued up while the client
+                  was busy goes out as one batch
+    disconnect -- hang up on the client
+
+    write(payload, callback) must call callback once payload has left
+    tornado's buffers. encode(frame) picks the bytes to send for a Frame.
+    transport just labels it in /metrics. After end(done), nothing more is
+    taken and done is called once everything queued has gone out.
+    """
+
+    POLICIES = ('drop', 'coalesce', 'disconnect')
+
+    def __init__(self, write, encode, close=None, policy='drop',
+                 max_bytes=1024*1024, name=None, transport=None):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown slow consumer policy: %s' % policy)
+        self.write          = write
+        self.encode         = encode
+        self.close          = close
+        self.policy         = policy
+        self.max_bytes      = max_bytes
+        self.name           = name
+        self.transport      = transport
+        self.queue          = deque()
+        self.queued_bytes   = 0
+        self.busy           = False
+        self.closed         = False
+        self.ending         = None # called once the queue drains, after end()
+        self.gap            = 0   # dropped lines not yet reported
+        self.gap_end        = None # seq of the first line after them
+        self.dropped_lines  = 0
+        self.dropped_frames = 0
+        self.sent_bytes     = 0
+
+
+    def __call__(self, frame):
+        if self.closed or self.ending is not None:
+            return
+        if not self.busy:
+            return self._send(self.encode(frame))
+
+        self.queue.append(frame)
+        self.queued_bytes += len(self.encode(frame))
+        if self.queued_bytes > self.max_bytes:
+            self._overflow()
+
+
+    def _overflow(self):
+        if self.policy == 'disconnect':
+            log.warning('Disconnecting slow consumer %s: %d bytes behind',
+                        self.name, self.queued_bytes)
+            self.closed = True
+            self.queue.clear()
+            self.queued_bytes = 0
+            if self.close is not None:
+                self.close()
+            return
+
+        # always keep the newest frame, even if it's over budget on its own
+        while self.queued_bytes > self.max_bytes and len(self.queue) > 1:
+            frame = self.queue.popleft()
+            self.queued_bytes -= len(self.encode(frame))
+            lines = len(frame.data['logs'])
+            self.gap_end         = frame.next_seq
+            self.gap            += lines
+            self.dropped_lines  += lines
+            self.dropped_frames += 1
+            if frame.data.get('seq') is None:
+                # a merged stream's frames aren't numbered, so nor is its gap
+                self.gap_end = None
+
+
+    def _drained(self):
+        self.busy = False
+        if self.closed:
+            return
+
+        if self.gap:
+            gap, self.gap = self.gap, 0
+            data = dict(logs=[], gap=gap)
+            if self.gap_end is not None:
+                data['seq'] = self.gap_end
+            return self._send(self.encode(Frame(data)))
+
+        if not self.queue:
+            if self.ending is not None:
+                self.ending()
+            return
+        if self.policy == 'coalesce' and len(self.queue) > 1:
+            frame = Frame.merge(self.queue)
+            self.queue.clear()
+            self.queued_bytes = 0
+        else:
+            frame = self.queue.popleft()
+            self.queued_bytes -= len(self.encode(frame))
+        self._send(self.encode(frame))
+
+
+    def end(self, done):
+        """Take no more frames, and call done once the last has been sent"""
+        self.ending = done
+        if not self.busy and not self.closed:
+            done()
+
+
+    def _send(self, payload):
+        self.busy = True
+        self.sent_bytes += len(payload)
+        self.write(payload, self._drained)
+
+
+    def stats(self):
+        return dict(
+            name=self.name,
+            policy=self.policy,
+            queued_frames=len(self.queue),
+            queued_bytes=self.queued_bytes,
+            dropped_lines=self.dropped_lines,
+            dropped_frames=self.dropped_frames,
+            sent_bytes=self.sent_bytes
+            )
+
+
+
+class StreamCredit(object):
+    """
+    Flow control for one of several streams sharing a websocket. The
+    client says how many messages it'll take (credit) and grants more as
+    it gets through them. write() stands between a Subscriber and the socket,
+    and only says a write has drained once it's left tornado's buffers and
+    the stream still has credit. Until then the subscriber's frames queue
+    up under its slow consumer policy, without holding up other streams.
+    A write with no credit left, as on a stream opened with credit 0, is
+    held back whole until grant(). With credit None the stream is only held
+    back by the socket.
+    """
+
+    def __init__(self, write, credit=None):
+        self.write_frame = write
+        self.credit      = credit
+        self.pending     = None # the drained callback being held back
+        self.held        = None # (payload, callback) waiting for credit
+        self.flushed     = True
+
+
+    def write(self, payload, callback=None):
+        if self.credit is not None and self.credit <= 0:
+            self.held = (payload, callback)
+            return
+        self._write(payload, callback)
+
+
+    def _write(self, payload, callback):
+        if self.credit is not None:
+            self.credit -= 1
+        self.pending, self.flushed = callback, False
+        self.write_frame(payload, self._flushed)
+
+
+    def _flushed(self):
+        self.flushed = True
+        self._release()
+
+
+    def grant(self, messages):
+        if self.credit is not None:
+            self.credit += messages
+            if self.held is not None and self.credit > 0:
+                held, self.held = self.held, None
+                self._write(*held)
+            else:
+                self._release()
+
+
+    def _release(self):
+        if self.pending is not None and self.flushed and \
+           (self.credit is None or self.credit > 0):
+            callback, self.pending = self.pending, None
+            callback()
+
+
+
+class TimeWindow(object):
+    """
+    Stands between a buffer and a subscriber that only wants lines written
+    up to unix time `to`. Frames go straight through until one reaches
+    past it; that one is cut short at the last line in the window, and
+    then done() is called, which should unsubscribe this and end the
+    subscriber. Anything else is looked up on the subscriber, so it shows
+    up in /_stats and /metrics like any other.
+    """
+
+    def __init__(self, buf, subscriber, to, done, line_filter=None):
+        self.buf         = buf
+        self.subscriber  = subscriber
+        self.to          = to
+        self.done        = done
+        self.line_filter = line_filter
+        self.finished    = False
+
+
+    def __getattr__(self, name):
+        return getattr(self.subscriber, name)
+
+
+    def __call__(self, frame):
+        if self.finished:
+            return
+        # frames arrive as their lines are appended, so every line from the
+        # frame's seq up to next_seq is in it, less what the filter dropped
+        stop = self.buf.seq_at(self.to, after=True)
+        if stop >= self.buf.next_seq:
+            return self.subscriber(frame)
+
+        self.finished = True
+        if stop > frame.data['seq']:
+            self.subscriber(self.buf.since(frame.data['seq'], self.line_filter,
+                                           stop=stop))
+        self.done()
 
 
 
 class ProxyStreamer(tornado.websocket.WebSocketClientConnection):
+    """
+    A websocket to another lumberjack that hands every message it gets to
+    callback, and then None once the connection closes.
+    """
 
     def __init__(self, *args, **kwargs):
-        self.output_stream = kwargs.pop('output_stream')
-        self.as_websocket = kwargs.pop('as_websocket', False)
+        self.callback = kwargs.pop('callback')
         super(ProxyStreamer, self).__init__(*args, **kwargs)
 
 
     def on_message(self, message):
-        if self.as_websocket:
-            self.output_stream.write_message(message)
-        else:
-            self.output_stream.write(message)
-            self.output_stream.flush()
+        self.callback(message)
             
 
     def _on_close(self):
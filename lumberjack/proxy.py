@@ -0,0 +1,341 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" One upstream connection per remote file, however many viewers it has """
+from __future__ import absolute_import
+
+import logging
+from datetime import timedelta
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+import tornado.ioloop
+import tornado.httpclient
+from tornado.httputil import url_concat
+from tornado.options import options
+
+from .frames import Frame
+from .models import ProxyStreamer
+from .util import slug
+
+MAX_RECONNECT_DELAY = 30 # seconds
+
+
+def upstream_socket_url(host, lumberfile, since=None, line_filter=None,
+                        epoch=None):
+    url = "ws://"+host+':'+str(options.listenport)+'/'+slug(lumberfile)+'/socket'
+    args = dict() if line_filter is None else line_filter.arguments()
+    if since is not None:
+        args['since'] = since
+        if epoch is not None:
+            args['epoch'] = epoch
+    if args:
+        url = url_concat(url, args)
+    return url
+
+
+def merged_socket_url(host, lumberfiles, line_filter=None, start=None):
+    """
+    The merged stream of several files on host, merged as they come in
+    (window=0): the lumberjack asking does the waiting for stragglers.
+    """
+    url = "ws://"+host+':'+str(options.listenport)+'/merge/socket'
+    args = [ ('file', lumberfile) for lumberfile in lumberfiles ]
+    if line_filter is not None:
+        args.extend(sorted(line_filter.arguments().items()))
+    if start is not None:
+        args.append( ('from', repr(start)) )
+    args.append( ('window', 0) )
+    return url_concat(url, args)
+
+
+
+class Upstream(object):
+    """
+    A websocket to a file on another lumberjack, shared by every local
+    client watching it with the same filter. Messages are relayed as the
+    Frames they arrived as, so the JSON is never re-encoded here, and the
+    last few are kept so that late joiners can ask for what they missed.
+
+    If the connection drops it's reopened from the last seq seen, so
+    downstream clients don't notice anything but a delay. If the other
+    lumberjack restarted in the meantime it sends everything it has, marked
+    as a reset, and that's passed on.
+    """
+
+    def __init__(self, host, lumberfile, line_filter=None, io_loop=None,
+                 keep_lines=200, compression_options=None):
+        self.host                = host
+        self.lumberfile          = lumberfile
+        self.line_filter         = line_filter
+        self.io_loop             = tornado.ioloop.IOLoop.current() if io_loop is None else io_loop
+        self.keep_lines          = keep_lines
+        self.compression_options = compression_options
+        self.callbacks           = dict()
+        self.recent              = deque()
+        self.recent_lines        = 0
+        self.next_seq            = None
+        self.epoch               = None
+        self.conn                = None
+        self.closed              = False
+        self.reconnect_delay     = 1
+        self.reconnects          = 0
+        self.received_bytes      = 0
+
+
+    @property
+    def key(self):
+        return (self.host, self.lumberfile, self.line_filter)
+
+
+    def connect(self, since=None, epoch=None):
+        """
+        Open the websocket, from since in epoch if given (the first
+        subscriber's), otherwise from the last seq seen.
+        """
+        if self.closed:
+            return
+        if since is None:
+            since, epoch = self.next_seq, self.epoch
+        request = tornado.httpclient.HTTPRequest(
+            self.url(since, epoch),
+            connect_timeout=900
+            )
+        request = tornado.httpclient._RequestProxy(
+            request, tornado.httpclient.HTTPRequest._DEFAULTS)
+
+        self.conn = ProxyStreamer( self.io_loop,
+                                   request,
+                                   callback=self.on_message,
+                                   compression_options=self.compression_options )
+        self.io_loop.add_future(self.conn.connect_future, self._on_connect)
+        log.debug( "Opened upstream to host %s file %s", self.host, self.lumberfile )
+
+
+    def url(self, since=None, epoch=None):
+        return upstream_socket_url(self.host, self.lumberfile, since,
+                                   self.line_filter, epoch)
+
+
+    def _on_connect(self, future):
+        if future.exception() is not None:
+            log.warning( "Couldn't reach %s for %s: %s",
+                         self.host, self.lumberfile, future.exception() )
+            self._reconnect()
+
+
+    def on_message(self, message):
+        if self.closed:
+            # torn down before the connection was even up
+            if message is not None:
+                self.conn.close()
+            return
+        if message is None: # connection closed
+            self._reconnect()
+            return
+
+        self.reconnect_delay = 1
+        self.received_bytes += len(message)
+        frame = Frame.from_json(message)
+        if frame.data.get('seq') is not None:
+            self.next_seq = frame.next_seq
+        if frame.data.get('reset'):
+            # what's kept was numbered by the lumberjack before it restarted
+            self.recent.clear()
+            self.recent_lines = 0
+        self.epoch = frame.data.get('epoch', self.epoch)
+
+        self.recent.append(frame)
+        self.recent_lines += len(frame.data['logs'])
+        while len(self.recent) > 1 and self.recent_lines > self.keep_lines:
+            self.recent_lines -= len(self.recent.popleft().data['logs'])
+
+        for callback in list(self.callbacks.values()):
+            callback(frame)
+
+
+    def _reconnect(self):
+        if self.closed:
+            return
+        self.reconnects += 1
+        log.warning( "Lost upstream to host %s file %s, reconnecting in %d seconds",
+                     self.host, self.lumberfile, self.reconnect_delay )
+        self.io_loop.add_timeout( timedelta(seconds=self.reconnect_delay),
+                                  self.connect )
+        self.reconnect_delay = min(self.reconnect_delay * 2, MAX_RECONNECT_DELAY)
+
+
+    def since(self, seq, epoch=None):
+        """
+        The kept messages from seq on, as Frames to send in order. The
+        first says under 'gap' how many lines before it are gone, if seq
+        is older than anything kept. The rest go as they came, each with
+        its own seq and gap. If seq is from an epoch the other lumberjack
+        has since left behind, it's everything kept, marked 'reset'.
+        """
+        frames = list(self.recent)
+        if epoch is not None and self.epoch is not None and epoch != self.epoch:
+            if frames:
+                frames[0] = Frame(dict(frames[0].data, reset=True))
+            return frames
+
+        frames = [ frame for frame in frames if frame.next_seq > seq ]
+        if not frames:
+            return frames
+        data = frames[0].data
+        first = data.get('seq') or 0
+        if first < seq and 'next' not in data:
+            # unfiltered, so its lines are numbered consecutively and the
+            # ones already seen can be cut off
+            data = dict(data, logs=data['logs'][seq - first:], seq=seq)
+            data.pop('gap', None)
+            frames[0] = Frame(data)
+        elif seq < first:
+            frames[0] = Frame(dict(data, gap=first - seq))
+        return frames
+
+
+    def subscribe(self, identifier, callback, since=None, epoch=None):
+        if since is not None:
+            for frame in self.since(since, epoch):
+                callback(frame)
+        self.callbacks[identifier] = callback
+
+
+    def unsubscribe(self, identifier):
+        self.callbacks.pop(identifier, None)
+
+
+    def close(self):
+        self.closed = True
+        if self.conn is not None:
+            self.conn.close()
+        log.debug( "Closed upstream to host %s file %s", self.host, self.lumberfile )
+
+
+    def stats(self):
+        return dict(
+            host=self.host,
+            lumberfile=self.lumberfile,
+            filter=None if self.line_filter is None else self.line_filter.arguments(),
+            subscribers=len(self.callbacks),
+            next_seq=self.next_seq,
+            reconnects=self.reconnects,
+            received_bytes=self.received_bytes
+            )
+
+
+
+class MergedUpstream(Upstream):
+    """
+    An Upstream of the merged stream of several files on one host (see
+    lumberjack.merge). Its messages aren't numbered, so a dropped
+    connection picks up with the next lines written, and late joiners
+    don't get anything replayed. start only applies to the first
+    connection.
+    """
+
+    def __init__(self, host, lumberfiles, line_filter=None, start=None,
+                 **kwargs):
+        super(MergedUpstream, self).__init__(host, tuple(lumberfiles),
+                                             line_filter, **kwargs)
+        self.start = start
+
+
+    @property
+    def key(self):
+        return (self.host, self.lumberfile, self.line_filter, self.start)
+
+
+    def url(self, since=None, epoch=None):
+        return merged_socket_url(self.host, self.lumberfile, self.line_filter,
+                                 self.start if not self.reconnects else None)
+
+
+
+class UpstreamPool(object):
+    """
+    Hands out shared Upstreams by (host, file, filter), counting who's using
+    each. Once the last subscriber leaves, an upstream lingers for
+    grace_period seconds in case someone else turns up (a page reload, say)
+    before it's closed.
+    """
+
+    def __init__(self, io_loop=None, grace_period=30, keep_lines=200,
+                 compression_options=None):
+        self.io_loop             = tornado.ioloop.IOLoop.current() if io_loop is None else io_loop
+        self.grace_period        = grace_period
+        self.keep_lines          = keep_lines
+        self.compression_options = compression_options
+        self.upstreams           = dict()
+        self.reapers             = dict()
+
+
+    def subscribe(self, host, lumberfile, identifier, callback,
+                  line_filter=None, since=None, epoch=None):
+        key = (host, lumberfile, line_filter)
+        upstream = self.upstreams.get(key)
+        if upstream is None:
+            upstream = self.upstreams[key] = Upstream(
+                host, lumberfile, line_filter,
+                io_loop=self.io_loop,
+                keep_lines=self.keep_lines,
+                compression_options=self.compression_options )
+            upstream.connect(since, epoch)
+            # the first subscriber's history comes straight from upstream
+            since = None
+        elif key in self.reapers:
+            self.io_loop.remove_timeout(self.reapers.pop(key))
+
+        upstream.subscribe(identifier, callback, since, epoch)
+        return upstream
+
+
+    def subscribe_merged(self, host, lumberfiles, identifier, callback,
+                         line_filter=None, start=None):
+        """
+        Like subscribe, but to the merged stream of lumberfiles on host.
+        Subscribers asking for the same files, filter and start share it.
+        """
+        key = (host, tuple(lumberfiles), line_filter, start)
+        upstream = self.upstreams.get(key)
+        if upstream is None:
+            upstream = self.upstreams[key] = MergedUpstream(
+                host, lumberfiles, line_filter, start=start,
+                io_loop=self.io_loop,
+                keep_lines=self.keep_lines,
+                compression_options=self.compression_options )
+            upstream.connect()
+        elif key in self.reapers:
+            self.io_loop.remove_timeout(self.reapers.pop(key))
+
+        upstream.subscribe(identifier, callback)
+        return upstream
+
+
+    def unsubscribe(self, upstream, identifier):
+        upstream.unsubscribe(identifier)
+        if not upstream.callbacks and upstream.key not in self.reapers:
+            self.reapers[upstream.key] = self.io_loop.add_timeout(
+                timedelta(seconds=self.grace_period),
+                lambda: self._reap(upstream) )
+
+
+    def _reap(self, upstream):
+        self.reapers.pop(upstream.key, None)
+        if not upstream.callbacks:
+            upstream.close()
+            self.upstreams.pop(upstream.key, None)
+
+
+    def stats(self):
+        return [ upstream.stats() for upstream in self.upstreams.values() ]
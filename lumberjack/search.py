@@ -0,0 +1,331 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Case-insensitive substring search over the lines a LumberBuffer holds """
+from __future__ import absolute_import
+
+import re
+import time
+import logging
+from array import array
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+import tornado.gen
+
+# lines are indexed a chunk at a time, and chunks are grouped into blocks.
+# A block's postings say which of its chunks contain each trigram, so a
+# chunk number fits in a byte. Blocks are dropped whole once every line in
+# them has aged out of the buffer, and each chunk's lines as soon as they
+# have.
+CHUNK_LINES  = 128
+BLOCK_CHUNKS = 256
+BLOCK_LINES  = CHUNK_LINES * BLOCK_CHUNKS
+
+# a search hands the ioloop back at least this often
+SLICE_SECONDS = 0.005
+
+# only trigrams inside words are indexed. Any word in a query is part of
+# a word in every line it matches, so its trigrams are in that line's too.
+WORD = re.compile(r'\w{3,}', re.UNICODE)
+
+# word -> its trigrams, shared by every index. Words repeat from line to
+# line, so this saves slicing them up again. Numbers and ids hardly ever
+# do, so they aren't kept.
+MAX_CACHED_WORDS = 20000
+_trigrams = dict()
+
+
+def trigrams(words):
+    """Every trigram inside any of a set of lower case words"""
+    known = words.intersection(_trigrams)
+    grams = set().union(*map(_trigrams.__getitem__, known))
+    for word in words.difference(known):
+        found = tuple(set( word[i:i+3] for i in range(len(word) - 2) ))
+        if word.isalpha():
+            if len(_trigrams) >= MAX_CACHED_WORDS:
+                _trigrams.clear()
+            _trigrams[word] = found
+        grams.update(found)
+    return grams
+
+
+def text_trigrams(text):
+    return trigrams(set(WORD.findall(text.lower())))
+
+
+def chunk_text(chunk):
+    """A chunk's lines joined by newlines, however it's stored"""
+    return '\n'.join(chunk) if isinstance(chunk, tuple) else chunk
+
+
+def chunk_lines(chunk):
+    return list(chunk) if isinstance(chunk, tuple) else chunk.split('\n')
+
+
+
+class Block(object):
+    """BLOCK_LINES consecutive lines, as chunks and trigram postings"""
+
+    __slots__ = ('first_seq', 'chunks', 'postings', 'npostings')
+
+    def __init__(self, first_seq):
+        self.first_seq = first_seq
+        self.chunks    = list()  # tuples of lines, or them joined by newlines
+        self.postings  = dict()  # trigram -> array of chunks that have it
+        self.npostings = 0
+
+
+    def add(self, lines, share_lines=False):
+        chunk = len(self.chunks)
+        text = '\n'.join(lines)
+        self.chunks.append(tuple(lines) if share_lines else text)
+        grams = text_trigrams(text)
+        postings = self.postings
+        for gram in grams:
+            try:
+                postings[gram].append(chunk)
+            except KeyError:
+                postings[gram] = array('B', [chunk])
+        self.npostings += len(grams)
+
+
+    def matching(self, grams):
+        """The chunks that have every one of grams, newest first"""
+        if not grams:
+            return range(len(self.chunks) - 1, -1, -1)
+        found = list()
+        for gram in grams:
+            chunks = self.postings.get(gram)
+            if chunks is None:
+                return ()
+            found.append(chunks)
+        found.sort(key=len)
+        chunks = set(found[0])
+        for other in found[1:]:
+            chunks.intersection_update(other)
+            if not chunks:
+                return ()
+        return sorted(chunks, reverse=True)
+
+
+
+class SearchIndex(object):
+    """
+    A trigram index of the lines appended to a buffer, kept up to date by
+    the buffer as it goes: add() every list of lines appended, and prune()
+    with the buffer's first_seq so lines leave the index as they leave the
+    buffer. Lines are held here until there's a chunk of them, then
+    indexed in one go.
+
+    The index keeps each chunk's lines itself, so a search never has to
+    look anything up in the buffer. With share_lines that's the very line
+    strings it was given, which costs nothing more if the buffer holds on
+    to them too, as a LumberBuffer does. Otherwise it's a copy of their
+    text, which is more compact than the strings.
+    """
+
+    def __init__(self, share_lines=False):
+        self.share_lines = share_lines
+        self.blocks    = deque()
+        self.pending   = list() # lines not yet in a chunk
+        self.next_seq  = 0
+        self.first_seq = 0
+        self.npostings = 0
+        self.nchunks   = 0
+
+
+    def clear(self, seq=0):
+        self.blocks.clear()
+        self.pending   = list()
+        self.next_seq  = self.first_seq = seq
+        self.npostings = self.nchunks = 0
+
+
+    @property
+    def pending_seq(self):
+        return self.next_seq - len(self.pending)
+
+
+    def add(self, seq, lines):
+        if seq != self.next_seq:
+            # the buffer started numbering over, say as a replica catching up
+            self.clear(seq)
+        self.pending.extend(lines)
+        self.next_seq = seq + len(lines)
+        while len(self.pending) >= CHUNK_LINES:
+            self._index(self.pending_seq, self.pending[:CHUNK_LINES])
+            del self.pending[:CHUNK_LINES]
+
+
+    def _index(self, seq, lines):
+        if not self.blocks or len(self.blocks[-1].chunks) == BLOCK_CHUNKS:
+            self.blocks.append(Block(seq))
+        block = self.blocks[-1]
+        before = block.npostings
+        block.add(lines, self.share_lines)
+        self.npostings += block.npostings - before
+        self.nchunks += 1
+
+
+    def prune(self, first_seq):
+        """Forget lines numbered before first_seq"""
+        self.first_seq = first_seq
+        blocks = self.blocks
+        while blocks and blocks[0].first_seq + BLOCK_LINES <= first_seq:
+            block = blocks.popleft()
+            self.npostings -= block.npostings
+            self.nchunks -= sum( 1 for chunk in block.chunks if chunk is not None )
+        if blocks:
+            oldest = blocks[0]
+            stale = min((first_seq - oldest.first_seq) // CHUNK_LINES,
+                        len(oldest.chunks))
+            for chunk in range(stale - 1, -1, -1):
+                if oldest.chunks[chunk] is None:
+                    break
+                oldest.chunks[chunk] = None
+                self.nchunks -= 1
+
+
+    def candidates(self, grams, before):
+        """
+        (seq of the first line, text) of each chunk that might hold a line
+        with all of grams numbered before `before`, newest first. It's safe
+        to carry on with after lines have been added and pruned.
+        """
+        pending_seq, pending = self.pending_seq, list(self.pending)
+        if pending and pending_seq < before:
+            yield pending_seq, '\n'.join(pending)
+        for block in reversed(list(self.blocks)):
+            if block.first_seq >= before:
+                continue
+            chunks = block.chunks
+            for chunk in block.matching(grams):
+                seq = block.first_seq + chunk * CHUNK_LINES
+                lines = chunks[chunk]
+                if seq < before and lines is not None:
+                    yield seq, chunk_text(lines)
+
+
+    def lines(self, start, stop):
+        """Whatever lines numbered from start up to stop are still held"""
+        start, stop = max(start, self.first_seq), min(stop, self.next_seq)
+        lines = list()
+        seq = start
+        while seq < stop:
+            if seq >= self.pending_seq:
+                offset = seq - self.pending_seq
+                lines.extend(self.pending[offset:offset + stop - seq])
+                break
+            chunk_seq, chunk = self._chunk(seq)
+            if chunk is None:
+                break
+            offset = seq - chunk_seq
+            chunk = chunk_lines(chunk)[offset:offset + stop - seq]
+            lines.extend(chunk)
+            seq += len(chunk)
+        return lines
+
+
+    def _chunk(self, seq):
+        if not self.blocks:
+            return seq, None
+        i = (seq - self.blocks[0].first_seq) // BLOCK_LINES
+        if not 0 <= i < len(self.blocks):
+            return seq, None
+        block = self.blocks[i]
+        chunk = (seq - block.first_seq) // CHUNK_LINES
+        if chunk >= len(block.chunks):
+            return seq, None
+        return block.first_seq + chunk * CHUNK_LINES, block.chunks[chunk]
+
+
+
+class BufferScan(object):
+    """
+    What a SearchIndex offers a search, for a buffer without one: every
+    line is a candidate, read from a copy of the buffer taken up front.
+    """
+
+    SCAN_LINES = CHUNK_LINES * 16
+
+    def __init__(self, buf):
+        self.first_seq = buf.first_seq
+        self.next_seq  = buf.next_seq
+        self.snapshot  = buf.lines_from(0)
+
+
+    def candidates(self, grams, before):
+        stop = min(before, self.next_seq) - self.first_seq
+        while stop > 0:
+            start = max(stop - self.SCAN_LINES, 0)
+            yield self.first_seq + start, '\n'.join(self.snapshot[start:stop])
+            stop = start
+
+
+    def lines(self, start, stop):
+        return self.snapshot[max(start - self.first_seq, 0):
+                             max(stop - self.first_seq, 0)]
+
+
+
+@tornado.gen.coroutine
+def search(buf, query, limit=100, context=0, before=None, line_filter=None):
+    """
+    Up to limit of the newest lines in buf containing query, ignoring case,
+    and numbered before `before` if that's given. Uses the buffer's
+    SearchIndex if it has one and scans it otherwise; either way the ioloop
+    gets a turn every SLICE_SECONDS.
+
+    Resolves to a dict of the matches, newest first, each with its seq and
+    up to `context` lines either side, and 'more': the `before` that gets
+    the next page, or None if that was all of them.
+    """
+    source = buf.index if buf.index is not None else BufferScan(buf)
+    needle = query.lower()
+    grams = text_trigrams(needle)
+    before = buf.next_seq if before is None else before
+
+    matches = list()
+    more = None
+    started = time.time()
+    for first, text in source.candidates(grams, before):
+        lowered = text.lower()
+        if needle in lowered:
+            lines = text.split('\n')
+            lowered = lowered.split('\n')
+            for i in range(len(lines) - 1, -1, -1):
+                seq = first + i
+                if seq >= before or seq < source.first_seq or \
+                   needle not in lowered[i] or \
+                   (line_filter is not None and not line_filter.match(lines[i])):
+                    continue
+                if len(matches) == limit:
+                    more = matches[-1]['seq']
+                    break
+                matches.append(dict(seq=seq, line=lines[i]))
+        if more is not None:
+            break
+        if time.time() - started > SLICE_SECONDS:
+            yield tornado.gen.moment
+            started = time.time()
+
+    if context:
+        for match in matches:
+            seq = match['seq']
+            match['before'] = source.lines(seq - context, seq)
+            match['after'] = source.lines(seq + 1, seq + 1 + context)
+
+    raise tornado.gen.Return(dict(query=query, matches=matches, more=more,
+                                  first_seq=buf.first_seq,
+                                  next_seq=buf.next_seq,
+                                  indexed=buf.index is not None))
@@ -20,9 +20,14 @@ from itertools import chain
 
 log = logging.getLogger(__name__)
 
+import tornado.web
 import tornado.ioloop
 
+from . import pools
 from .models import Sluice
+from .multiplex import multiplexed
+from .checkpoints import Checkpoints
+from ..metrics import Exposition, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from ..util import import_config_file
 
 
@@ -37,30 +42,95 @@ opt_list = [
     optparse.make_option('-i', '--report-interval', action="store", type="int",
                          dest="report_interval", default=10,
                          help="If logging is at info or debug, print reports "+
-                         "at this interval in seconds. Default: 10")
+                         "at this interval in seconds. Default: 10"),
+    optparse.make_option('--checkpoint-file', action="store", type="string",
+                         dest="checkpoint_file", default="",
+                         help="Remember in this file how far each sluice's "+
+                         "parser got, and pick up from there after a restart"),
+    optparse.make_option('--checkpoint-interval', action="store", type="float",
+                         dest="checkpoint_interval", default=1.0,
+                         help="Write the checkpoint file at most this often, "+
+                         "in seconds. 0 writes after every message. Default: 1"),
+    optparse.make_option('--metrics-port', action="store", type="int",
+                         dest="metrics_port", default=0,
+                         help="Serve Prometheus metrics at /metrics on this "+
+                         "port. Default: off"),
+    optparse.make_option('--multiplex', action="store_true",
+                         dest="multiplex", default=False,
+                         help="Read every file on a lumberjack over one "+
+                         "websocket to its /socket, rather than a connection "+
+                         "per file")
     ]
 
 open_sluices = dict()
 
 
 def print_report(conns):
-    """Nicely print out open_sluices"""
-
+    """
+    Nicely print out open_sluices: counts, how many messages are waiting
+    for a parser, and moving averages of how long they waited and how long
+    parsing took, in ms.
+    """
+
+    if not conns:
+        return
+    keys = sorted( next(iter(conns.values())).stats.__dict__.keys() )
     message = list()
-    for url, sluice in conns.iteritems():
+    for url, sluice in conns.items():
         message.append( 
-            url + '\t' + '\t'.join([str(v) for v in 
-                                    sluice.stats.__dict__.values()]) 
+            url + '\t' + '\t'.join([ '%.1f' % v if isinstance(v, float) else str(v)
+                                     for v in (getattr(sluice.stats, k) for k in keys) ])
         )
-    header = '\t'.join( chain(['host'], conns.values()[0].stats.__dict__.keys()) )
-    lines = '-'*len(max(message))
-    print >> sys.stderr, lines
-    print >> sys.stderr, header
-    print >> sys.stderr, lines
-    print >> sys.stderr, '\n'.join(message)
-    print >> sys.stderr, lines
+    header = '\t'.join( chain(['host'], keys) )
+    lines = '-'*max(len(m) for m in message)
+    sys.stderr.write( '\n'.join([lines, header, lines] + message + [lines]) + '\n' )
         
 
+def sluice_metrics(conns):
+    """open_sluices' stats as an Exposition"""
+    page = Exposition()
+    counters = (
+        ('sluice_received_bytes_total', 'raw_received', 'Bytes received'),
+        ('sluice_received_lines_total', 'log_received', 'Lines received'),
+        ('sluice_dropped_lines_total', 'log_dropped',
+         'Lines the lumberjack said were missed'),
+        ('sluice_receive_failures_total', 'recv_fail',
+         'Messages that weren\'t JSON, and lost connections'),
+        ('sluice_reconnects_total', 'reconnects', 'Times the stream reconnected'),
+        ('sluice_resets_total', 'resets',
+         'Times the lumberjack had started numbering lines over'),
+        ('sluice_parse_failures_total', 'parsefxn_fail', 'Times the parser raised'),
+        ('sluice_batches_total', 'batches', 'Messages or batches handed to the parser'),
+        ('sluice_pauses_total', 'pauses', 'Times reading paused for the parser'),
+        )
+    for name, stat, help in counters:
+        page.add(name, 'counter', help,
+                 [ (dict(url=url), getattr(sluice.stats, stat))
+                   for url, sluice in conns.items() ])
+    page.add('sluice_queue_depth', 'gauge', 'Messages waiting for a pooled parser',
+             [ (dict(url=url), sluice.stats.queue_depth)
+               for url, sluice in conns.items() ])
+    page.histograms('sluice_wait_seconds', 'Time messages waited for a pooled parser',
+                    [ (dict(url=url), sluice.wait_seconds)
+                      for url, sluice in conns.items() ])
+    page.histograms('sluice_parse_seconds', 'Time the parser took per call',
+                    [ (dict(url=url), sluice.parse_seconds)
+                      for url, sluice in conns.items() ])
+    return page
+
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def initialize(self, conns=None):
+        self.conns = conns
+
+    def get(self):
+        self.set_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.write(sluice_metrics(self.conns).text())
+
+
+
 def main():
     """Command line interface for sluices"""
 
@@ -74,19 +144,42 @@ def main():
     try:
         import_config_file(open(opts.config_file), opts.__dict__, opts.__dict__)
     except IOError:
-        print >> sys.stderr, "Couldn't find a config file to parse"
+        sys.stderr.write("Couldn't find a config file to parse\n")
         parser.print_help()
         sys.exit(1)
 
     ioloop = tornado.ioloop.IOLoop.instance()
 
-    for url, cfg in opts.sluice_config.iteritems():
+    checkpoints = None
+    if opts.checkpoint_file:
+        checkpoints = Checkpoints(opts.checkpoint_file,
+                                  interval=opts.checkpoint_interval,
+                                  io_loop=ioloop)
+
+    for url, cfg in opts.sluice_config.items():
         log.info('Adding sluice for %s', url)
         open_sluices[url] = Sluice( 
             url, 
             cfg['parser'],
-            io_loop=ioloop
-        ).open()
+            io_loop=ioloop,
+            reopen_delay=cfg.get('reopen_delay', 1),
+            max_reopen_delay=cfg.get('max_reopen_delay', 60),
+            mode=cfg.get('mode', 'inline'),
+            workers=cfg.get('workers', 1),
+            queue_size=cfg.get('queue_size', 100),
+            batch_lines=cfg.get('batch_lines'),
+            batch_bytes=cfg.get('batch_bytes'),
+            batch_latency=cfg.get('batch_latency'),
+            checkpoints=checkpoints
+        )
+
+    if opts.multiplex:
+        sockets = multiplexed(open_sluices.values(), io_loop=ioloop)
+        log.info('Multiplexing over %d sockets', len(sockets))
+
+    # after every sluice has registered its parser, so forked workers have them
+    for sluice in open_sluices.values():
+        sluice.open()
         
     if opts.logging.upper() in ('INFO', 'DEBUG'):
         # periodically print reports
@@ -96,14 +189,23 @@ def main():
             io_loop=ioloop
         ).start()
 
+    if opts.metrics_port:
+        tornado.web.Application(
+            [ (r'/metrics/?', MetricsHandler, dict(conns=open_sluices)) ]
+        ).listen(opts.metrics_port)
+
     log.info('Starting streaming now...')
 
     try:
         ioloop.start()
     except KeyboardInterrupt:
-        print >> sys.stderr, "Shutting down..."
+        sys.stderr.write("Shutting down...\n")
     finally:
+        # delivers what's still batched or queued before the pools go
         [ val.close() for val in open_sluices.values() ]
+        pools.shutdown()
+        if checkpoints is not None:
+            checkpoints.close()
 
 
 if __name__ == '__main__':
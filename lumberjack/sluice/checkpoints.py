@@ -0,0 +1,100 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Where each sluice's parser got up to, kept on disk across restarts """
+from __future__ import absolute_import
+
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+import tornado.ioloop
+
+from ..util import serialize, deserialize
+
+
+class Checkpoints(object):
+    """
+    A JSON file of url -> the seq of the first line its parser hasn't
+    handled yet, and the epoch that seq was numbered in (see
+    BaseLumberBuffer.since), which tells a lumberjack that's started
+    numbering over not to trust it. ack() only updates memory. Every interval seconds, if
+    anything changed, the whole file is rewritten, fsynced and renamed over
+    the old one, so one fsync covers every ack since the last and a crash
+    leaves either the old file or the new.
+
+    A crash can lose the last interval's acks, and those lines are parsed
+    again after a restart. A clean close() loses nothing.
+    """
+
+    def __init__(self, path, interval=1.0, io_loop=None):
+        self.path     = path
+        self.interval = interval
+        self.io_loop  = io_loop or tornado.ioloop.IOLoop.current()
+        self.dirty    = False
+        self.syncs    = 0
+        try:
+            with open(path) as f:
+                self.positions = deserialize(f.read())
+        except IOError:
+            self.positions = dict()
+        except ValueError:
+            log.error('Checkpoint file %s is corrupt, starting over', path)
+            self.positions = dict()
+        self.timer = None
+        if interval:
+            self.timer = tornado.ioloop.PeriodicCallback(
+                self.sync, interval * 1000, io_loop=self.io_loop)
+            self.timer.start()
+
+
+    def get(self, url):
+        """(seq, epoch) to resume url from, or Nones"""
+        position = self.positions.get(url)
+        if isinstance(position, dict):
+            return position.get('seq'), position.get('epoch')
+        # a bare seq, from before checkpoints had epochs
+        return position, None
+
+
+    def ack(self, url, seq, epoch=None):
+        position = dict(seq=seq, epoch=epoch)
+        if self.positions.get(url) != position:
+            self.positions[url] = position
+            self.dirty = True
+        if not self.interval:
+            self.sync()
+
+
+    def sync(self):
+        if not self.dirty:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(serialize(self.positions))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        # the rename isn't durable until the directory is
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.dirty = False
+        self.syncs += 1
+
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.stop()
+        self.sync()
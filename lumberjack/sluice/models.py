@@ -11,35 +11,156 @@
 # under the License.
 from __future__ import absolute_import
 
+import time
+import random
 import logging
-from functools import wraps
+from functools import wraps, partial
+from collections import deque
+from concurrent.futures import wait as futures_wait
 from datetime import timedelta
 
 log = logging.getLogger(__name__)
 
 from tornado.ioloop import IOLoop
-import tornado.httpclient
+from tornado.concurrent import Future
+from tornado.httputil import url_concat
 
 from ..util import deserialize
 from ..models import AttrBag
+from ..framing import LineFramer
+from ..frames import Frame
+from ..metrics import Histogram
+from .stream import HTTPStream
+from . import pools
+
+# one document is a whole message from a lumberjack, which can be big
+MAX_DOCUMENT_LENGTH = 256 * 1024 * 1024
+
+
+def end_seq(data):
+    """Where a client that has seen message data picks up from"""
+    if data.get('next') is not None:
+        return data['next']
+    if data.get('seq') is not None:
+        return data['seq'] + len(data['logs'])
+
+
+class Backoff(object):
+    """
+    How long to wait before reconnecting: doubling from initial up to
+    maximum, and back to initial after reset(). Each wait is picked at
+    random between half and all of that, so sluices cut off together don't
+    all come back at once.
+    """
+
+    def __init__(self, initial=1, maximum=60):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay   = initial
+
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.delay * 2, self.maximum)
+        return random.uniform(delay / 2.0, delay)
+
+
+    def reset(self):
+        self.delay = self.initial
+
 
 
 class Sluice(object):
+    """
+    Streams a lumberjack's JSON output into parsefxn, one message at a time.
+    Messages are newline-delimited, so they're split out of the stream by a
+    LineFramer however TCP chops them up.
+
+    mode says where parsefxn runs: 'inline' on the ioloop, or in a 'thread'
+    or 'process' pool of workers, shared with other sluices asking for the
+    same. Pooled messages wait in a queue of up to queue_size and go to the
+    pool one at a time, so they're parsed in order. When the queue fills
+    the sluice stops reading the stream until it's half drained, and TCP
+    pushes back on the lumberjack, whose slow subscriber policy takes it
+    from there.
+
+    Setting any of batch_lines, batch_bytes or batch_latency (seconds)
+    hands parsefxn batches instead: messages are merged into one, with the
+    same shape, until it has batch_lines lines or batch_bytes bytes of
+    JSON, or its first message is batch_latency old (1 second if only the
+    others are set). close() delivers whatever's left.
+
+    With checkpoints, each message's end is acked there once parsefxn has
+    returned without raising, and a new Sluice resumes from the url's
+    checkpoint. Reconnects resume from the last message received, queued
+    or not, since the queue outlives the connection. Either way the sluice
+    says which epoch its seq is from, and if the lumberjack has started
+    numbering over since, it resends its whole buffer and the reset is
+    logged and counted.
+
+    A sluice that's cut off reconnects after reopen_delay seconds, doubling
+    each time up to max_reopen_delay, and starting over once a connection
+    delivers a message.
+    """
     
     def __init__(self, url, parsefxn, 
-                 reopen_delay=1,   io_loop=None):
+                 reopen_delay=1,   io_loop=None,   max_reopen_delay=60,
+                 mode='inline', workers=1, queue_size=100,
+                 batch_lines=None, batch_bytes=None, batch_latency=None,
+                 checkpoints=None):
         self.url             = url
         self.parsefxn        = parsefxn
-        self.reopen_delay    = reopen_delay
+        self.backoff         = Backoff(reopen_delay, max_reopen_delay)
         self.io_loop          = IOLoop.instance() if io_loop is None else io_loop
+        self.mode            = mode
+        self.queue_size      = queue_size
+        self.batch_lines     = batch_lines
+        self.batch_bytes     = batch_bytes
+        self.batch_latency   = batch_latency
+        self.batching        = bool(batch_lines or batch_bytes or batch_latency)
+        if self.batching and not batch_latency:
+            self.batch_latency = 1
 
+        self.pool       = pools.get_pool(mode, workers)
+        self.parser     = parsefxn
+        self.parser_key = pools.register(parsefxn)
         self.parsefxn   = self.wrap_parsefxn(parsefxn)
-        self.client     = None
+        self.queue      = deque() # (time queued, message)
+        self.parsing    = None # the pool's Future for the message it has
+        self.in_flight  = None # and that message
+        self.batch      = list()
+        self.batched    = [0, 0] # lines, bytes
+        self.batch_timeout = None
+        self.paused     = None # a Future while reading's paused
+        self.framer     = None
+        self.stream     = None
         self.connection = None
+        self.opened     = 0    # connections made, so stale callbacks can tell
+        # a MultiplexedSocket to read over instead of a connection of its
+        # own, with the file and arguments to subscribe to it with
+        self.multiplexed      = None
+        self.stream_file      = None
+        self.stream_arguments = None
+        self.checkpoints = checkpoints
+        # where to resume from after a reconnect, and which numbering
+        # that's in
+        self.next_seq, self.epoch = ( (None, None) if checkpoints is None
+                                      else checkpoints.get(url) )
         self.stats      = AttrBag( raw_received  = 0,
                                    log_received  = 0,
+                                   log_dropped   = 0,
                                    recv_fail     = 0,
-                                   parsefxn_fail = 0 )
+                                   reconnects    = 0,
+                                   resets        = 0,
+                                   parsefxn_fail = 0,
+                                   batches       = 0,
+                                   queue_depth   = 0,
+                                   pauses        = 0,
+                                   wait_ms       = 0.0,
+                                   parse_ms      = 0.0 )
+        # for /metrics: stats holds moving averages, these the distribution
+        self.wait_seconds  = Histogram()
+        self.parse_seconds = Histogram()
 
 
     def wrap_parsefxn(self, f):
@@ -47,44 +168,201 @@ class Sluice(object):
         @wraps(f, assigned=[], updated=('__dict__',))
         def wrapper(*args, **kwargs):
 
-            data = args[0]
+            chunk = args[0]
 
-            self.stats.raw_received += len(data)
-            data = deserialize(data)
-            self.stats.log_received += len(data)
-            
-            if not data:
-                self.reopen()
-                return None
+            self.stats.raw_received += len(chunk)
+            for document in self.framer.feed(chunk):
+                if not document:
+                    continue
+                try:
+                    data = deserialize(document)
+                except ValueError as e:
+                    self.stats.recv_fail += 1
+                    log.warning('Skipping a message that isn\'t JSON: %s', e)
+                    continue
+                self.received(data, len(document))
+
+            # the stream doesn't read another chunk until this resolves
+            return self.backpressure()
+        
+        return wrapper
+
+
+    def received(self, data, size):
+        """Take one message from the lumberjack, size bytes of JSON"""
+        self.stats.log_received += len(data['logs'])
+        self.stats.log_dropped += data.get('gap', 0)
+        epoch = data.get('epoch')
+        if data.get('reset') or (epoch is not None and self.epoch is not None
+                                 and epoch != self.epoch):
+            self.stats.resets += 1
+            log.warning('%s started numbering its lines over (restarted without '
+                        'a spill store?), some may be parsed twice or missed',
+                        self.url)
+        if epoch is not None:
+            self.epoch = epoch
+        if end_seq(data) is not None:
+            self.next_seq = end_seq(data)
+        self.backoff.reset()
+
+        if self.batching:
+            self._batch(data, size)
+        else:
+            self._deliver(data)
+
+
+    def backpressure(self):
+        """
+        A Future to wait on before taking any more messages if the pool's
+        queue is full, otherwise None
+        """
+        if self.pool is None:
+            return None
+        self._dispatch()
+        if self.paused is None and len(self.queue) >= self.queue_size:
+            self.paused = Future()
+            self.stats.pauses += 1
+            log.debug('Parsers behind on %s, pausing', self.url)
+        return self.paused
+
+
+    def _batch(self, data, size):
+        self.batch.append(data)
+        self.batched[0] += len(data['logs'])
+        self.batched[1] += size
+        if (self.batch_lines and self.batched[0] >= self.batch_lines) or \
+           (self.batch_bytes and self.batched[1] >= self.batch_bytes):
+            self.flush()
+        elif self.batch_timeout is None:
+            self.batch_timeout = self.io_loop.add_timeout(
+                timedelta(seconds=self.batch_latency), self.flush )
 
+
+    def flush(self):
+        """Deliver the batch so far, if there is one"""
+        if self.batch_timeout is not None:
+            self.io_loop.remove_timeout(self.batch_timeout)
+            self.batch_timeout = None
+        if not self.batch:
+            return
+        batch, self.batch, self.batched = self.batch, list(), [0, 0]
+        if len(batch) == 1:
+            self._deliver(batch[0])
+        else:
+            self._deliver(Frame.merge([ Frame(data) for data in batch ]).data)
+        if self.pool is not None:
+            self._dispatch()
+
+
+    def _deliver(self, data):
+        """Parse data now, or queue it for the pool"""
+        self.stats.batches += 1
+        if self.pool is None:
+            start = time.time()
             try:
-                return f(data)
+                self.parser(data)
+                self._ack(data)
             except Exception as e:
                 self.stats.parsefxn_fail += 1
                 log.exception(e)
-        
-        return wrapper
+            self._timed('parse_ms', self.parse_seconds, time.time() - start)
+        else:
+            self.queue.append( (time.time(), data) )
+            self.stats.queue_depth = len(self.queue)
+
+
+    def _record(self, data, future):
+        try:
+            result, seconds = future.result()
+            self._timed('parse_ms', self.parse_seconds, seconds)
+            self._ack(data)
+        except Exception as e:
+            self.stats.parsefxn_fail += 1
+            log.exception(e)
+
+
+    def _ack(self, data):
+        if self.checkpoints is not None and end_seq(data) is not None:
+            self.checkpoints.ack(self.url, end_seq(data), data.get('epoch'))
+
+
+    def _timed(self, stat, histogram, seconds):
+        """Fold a timing into a moving average, in ms, and a histogram"""
+        histogram.observe(seconds)
+        setattr( self.stats, stat,
+                 0.9 * getattr(self.stats, stat) + 0.1 * seconds * 1000 )
+
+
+    def _dispatch(self):
+        """Hand the next queued message to the pool, if it's free"""
+        if self.parsing or not self.queue:
+            return
+        queued, data = self.queue.popleft()
+        self.stats.queue_depth = len(self.queue)
+        self._timed('wait_ms', self.wait_seconds, time.time() - queued)
+        self.parsing = self.pool.submit(pools.call_parser, self.parser_key, data)
+        self.in_flight = data
+        self.io_loop.add_future(self.parsing, partial(self._parsed, data))
+
+
+    def _parsed(self, data, future):
+        if future is not self.parsing:
+            return # close() already saw to it
+        self.parsing = None
+        self._record(data, future)
+
+        if self.paused is not None and len(self.queue) <= self.queue_size // 2:
+            log.debug('Parsers caught up on %s, resuming', self.url)
+            self.paused, paused = None, self.paused
+            paused.set_result(None)
+        self._dispatch()
     
 
     def open(self):
-        
-        request = tornado.httpclient.HTTPRequest( 
-            self.url,
-            headers            = dict(Accept="application/json"),
-            connect_timeout    = 10,
-            request_timeout    = 0,
-            streaming_callback = self.parsefxn
-        )
-        
-        self.client = tornado.httpclient.AsyncHTTPClient(io_loop = self.io_loop)
-        self.connection = self.client.fetch(
-            request, 
-            callback=lambda r: self.reopen()
+
+        if self.multiplexed is not None:
+            self.multiplexed.subscribe(self)
+            return self
+
+        if self.stream is not None and self.stream.closed:
+            return self # close()d while waiting to reconnect
+
+        url = self.url
+        if self.next_seq is not None:
+            # only ask for what we haven't seen yet
+            since = dict(since=self.next_seq)
+            if self.epoch is not None:
+                since['epoch'] = self.epoch
+            url = url_concat(url, since)
+
+        # anything left over from the last connection was cut off
+        self.framer = LineFramer(max_line_length=MAX_DOCUMENT_LENGTH)
+        self.stream = HTTPStream(
+            url,
+            self.parsefxn,
+            headers         = dict(Accept="application/json"),
+            connect_timeout = 10
         )
+        self.opened += 1
+        self.connection = self.stream.start()
+        self.io_loop.add_future(self.connection,
+                                partial(self._closed, self.opened))
         log.info( "Subscribed: "+ self.url)
         
         return self
     
+    def _closed(self, opened, future):
+        if opened != self.opened:
+            return
+        try:
+            future.result()
+        except Exception as e:
+            log.warning('Stream from %s ended: %s', self.url, e)
+        if self.stream.closed:
+            return
+        self.reopen()
+
+
     def reopen(self):
         
         if not self.connection.done():
@@ -92,19 +370,39 @@ class Sluice(object):
             return None
         else:
             self.stats.recv_fail += 1
-            log.warning('Reconnecting in %d seconds', self.reopen_delay)
+            self.stats.reconnects += 1
+            delay = self.backoff.next()
+            log.warning('Reconnecting to %s in %.1f seconds', self.url, delay)
             self.io_loop.add_timeout(
-                deadline = timedelta(seconds=self.reopen_delay),
+                deadline = timedelta(seconds=delay),
                 callback = self.open
             )
-            self.reopen_delay *= 2
             return True
 
 
     def close(self):
+        """
+        Hang up, then deliver the last batch and wait for the pool to parse
+        everything queued. Blocks, so it's fine once the ioloop's stopped.
+        """
         log.info('Shutting down sluice for url %s', self.url)
-        del self.connection
-        del self.client
+        if self.multiplexed is not None:
+            self.multiplexed.unsubscribe(self)
+        elif self.stream is not None:
+            self.stream.close()
+        self.flush()
+        if self.pool is None:
+            return
+        if self.parsing is not None:
+            future, self.parsing = self.parsing, None
+            futures_wait([future])
+            self._record(self.in_flight, future)
+        while self.queue:
+            queued, data = self.queue.popleft()
+            future = self.pool.submit(pools.call_parser, self.parser_key, data)
+            futures_wait([future])
+            self._record(data, future)
+        self.stats.queue_depth = 0
         
 
             
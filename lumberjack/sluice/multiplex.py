@@ -0,0 +1,210 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Every sluice reading from one lumberjack, over one websocket """
+from __future__ import absolute_import
+
+import logging
+
+log = logging.getLogger(__name__)
+
+import tornado.gen
+import tornado.websocket
+from tornado.ioloop import IOLoop
+
+try:
+    from urllib.parse import urlsplit, parse_qsl
+except ImportError:
+    from urlparse import urlsplit, parse_qsl
+
+from .models import Backoff
+from ..util import serialize, deserialize, deslug
+
+# messages a lumberjack sends on a stream before hearing that it's been
+# taken: enough to keep a sluice busy while its credit goes back
+DEFAULT_CREDIT = 8
+
+
+def socket_key(url):
+    """
+    (the multiplexed socket URL for url's lumberjack, the file it's for,
+    its query arguments), or None if url isn't a plain file URL and needs
+    its own connection
+    """
+    parts = urlsplit(url)
+    path = parts.path.strip('/')
+    if parts.scheme not in ('http', 'https') or not path or '/' in path:
+        return None
+    scheme = 'wss' if parts.scheme == 'https' else 'ws'
+    return ( '%s://%s/socket' % (scheme, parts.netloc), deslug(path),
+             dict(parse_qsl(parts.query)) )
+
+
+def multiplexed(sluices, io_loop=None):
+    """
+    Put every sluice whose URL is a plain file on a lumberjack onto one
+    MultiplexedSocket per lumberjack. Returns the sockets by URL.
+    """
+    sockets = dict()
+    for sluice in sluices:
+        key = socket_key(sluice.url)
+        if key is None:
+            continue
+        url, lumberfile, arguments = key
+        if url not in sockets:
+            sockets[url] = MultiplexedSocket(url, io_loop=io_loop,
+                                             reopen_delay=sluice.backoff.initial,
+                                             max_reopen_delay=sluice.backoff.maximum)
+        sluice.multiplexed = sockets[url]
+        sluice.stream_file, sluice.stream_arguments = lumberfile, arguments
+    return sockets
+
+
+
+class MultiplexedSocket(object):
+    """
+    One websocket to a lumberjack's /socket, with each subscribed sluice's
+    file on a stream of its own, named by the sluice's URL. Every stream
+    gets `credit` messages of flow control, and a message's credit only
+    goes back once its sluice has taken it, so a sluice whose parsers are
+    behind holds up its own file and nobody else's.
+
+    When the socket drops, it's reopened after a backoff and every sluice
+    resubscribed from where it got to.
+    """
+
+    def __init__(self, url, io_loop=None, credit=DEFAULT_CREDIT,
+                 reopen_delay=1, max_reopen_delay=60):
+        self.url        = url
+        self.io_loop    = IOLoop.current() if io_loop is None else io_loop
+        self.credit     = credit
+        self.backoff    = Backoff(reopen_delay, max_reopen_delay)
+        self.sluices    = dict() # stream -> Sluice
+        self.conn       = None
+        self.connecting = False
+        self.closed     = False
+
+
+    def subscribe(self, sluice):
+        self.sluices[sluice.url] = sluice
+        if self.conn is not None:
+            self._subscribe(sluice)
+        elif not self.connecting:
+            self.connecting = True
+            self.io_loop.spawn_callback(self.run)
+
+
+    def _subscribe(self, sluice):
+        control = dict(sluice.stream_arguments, op='subscribe', stream=sluice.url,
+                       file=sluice.stream_file, credit=self.credit)
+        if sluice.next_seq is not None:
+            # only ask for what we haven't seen yet
+            control['since'] = sluice.next_seq
+            if sluice.epoch is not None:
+                control['epoch'] = sluice.epoch
+        self.send(control)
+        log.info( "Subscribed: %s over %s", sluice.url, self.url )
+
+
+    def unsubscribe(self, sluice):
+        if self.sluices.pop(sluice.url, None) is None:
+            return
+        if self.conn is not None:
+            self.send(dict(op='unsubscribe', stream=sluice.url))
+        if not self.sluices:
+            self.close()
+
+
+    def send(self, control, conn=None):
+        """Send a control message, unless the socket's gone (or isn't conn)"""
+        if self.conn is None or (conn is not None and conn is not self.conn):
+            return
+        try:
+            self.conn.write_message(serialize(control))
+        except tornado.websocket.WebSocketClosedError:
+            pass # the read loop will notice
+
+
+    @tornado.gen.coroutine
+    def run(self):
+        """Connect, and read until the socket drops, then do it again"""
+        while not self.closed and self.sluices:
+            try:
+                self.conn = yield tornado.websocket.websocket_connect(
+                    self.url, connect_timeout=10, compression_options=dict())
+            except Exception as e:
+                log.warning('Couldn\'t connect to %s: %s', self.url, e)
+            else:
+                for sluice in list(self.sluices.values()):
+                    self._subscribe(sluice)
+                while True:
+                    message = yield self.conn.read_message()
+                    if message is None:
+                        break
+                    self.on_message(message)
+                self.conn = None
+                if self.closed:
+                    break
+                log.warning('Lost %s', self.url)
+
+            for sluice in self.sluices.values():
+                sluice.stats.recv_fail += 1
+                sluice.stats.reconnects += 1
+            delay = self.backoff.next()
+            log.warning('Reconnecting to %s in %.1f seconds', self.url, delay)
+            yield tornado.gen.sleep(delay)
+        self.connecting = False
+
+
+    def on_message(self, message):
+        try:
+            data = deserialize(message)
+        except ValueError as e:
+            log.warning('Skipping a message that isn\'t JSON: %s', e)
+            return
+        stream = data.pop('stream', None)
+        sluice = self.sluices.get(stream)
+        if sluice is None:
+            if 'error' in data:
+                log.error('%s: %s', self.url, data['error'])
+            return
+        if 'error' in data:
+            log.error('Couldn\'t subscribe to %s: %s', stream, data['error'])
+            return
+        if data.get('closed') == 'window':
+            log.info('%s is past its ?to=, done', stream)
+            self.sluices.pop(stream)
+            return
+        if 'closed' in data:
+            # cut off as a slow consumer; pick up where it got to
+            log.warning('%s was closed (%s), resubscribing', stream, data['closed'])
+            sluice.stats.reconnects += 1
+            self._subscribe(sluice)
+            return
+
+        self.backoff.reset()
+        sluice.stats.raw_received += len(message)
+        sluice.received(data, len(message))
+        paused = sluice.backpressure()
+        credit = dict(op='credit', stream=stream, messages=1)
+        if paused is None:
+            self.send(credit)
+        else:
+            # a new connection starts its streams with fresh credit
+            conn = self.conn
+            self.io_loop.add_future(paused,
+                                    lambda future: self.send(credit, conn))
+
+
+    def close(self):
+        self.closed = True
+        if self.conn is not None:
+            self.conn.close()
@@ -0,0 +1,66 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Where sluice parsers run when they shouldn't hold up the ioloop """
+from __future__ import absolute_import
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+MODES = ('inline', 'thread', 'process')
+
+# parsers by key. Process pool workers are forked, so they inherit this and
+# only the key has to be pickled: parsers from a sluice config usually can't
+# be.
+parsers = dict()
+
+pools = dict() # (mode, size) -> executor
+
+
+def register(parser):
+    """A key to call parser by with call_parser, in this process or a fork"""
+    key = len(parsers)
+    parsers[key] = parser
+    return key
+
+
+def call_parser(key, data):
+    """(whatever the parser returned, seconds it took)"""
+    start = time.time()
+    result = parsers[key](data)
+    return result, time.time() - start
+
+
+def get_pool(mode, size):
+    """
+    The executor for mode with size workers, shared by every sluice that
+    asks for the same. Register parsers before a process pool's first use,
+    or its workers won't have them.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown parser mode %s, pick one of %s'
+                         % (mode, ', '.join(MODES)))
+    if mode == 'inline':
+        return None
+    if (mode, size) not in pools:
+        executor = ThreadPoolExecutor if mode == 'thread' else ProcessPoolExecutor
+        pools[(mode, size)] = executor(max_workers=size)
+        log.debug('Started a %s pool of %d for parsers', mode, size)
+    return pools[(mode, size)]
+
+
+def shutdown(wait=True):
+    for pool in pools.values():
+        pool.shutdown(wait=wait)
+    pools.clear()
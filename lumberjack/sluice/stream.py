@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" A never-ending HTTP GET that the reader can slow down """
+from __future__ import absolute_import
+
+import sys
+import logging
+from datetime import timedelta
+
+log = logging.getLogger(__name__)
+
+import tornado.gen
+import tornado.locks
+import tornado.iostream
+import tornado.tcpclient
+import tornado.httputil
+import tornado.http1connection
+from tornado.httpclient import HTTPError
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+# connections being set up to any one host at a time: tornado's listen
+# backlog. A config with thousands of URLs on a host could otherwise overflow
+# it, and dropped SYNs wait a second or more to be retried.
+MAX_CONNECTING = 128
+
+connecting = dict() # host:port -> Semaphore
+
+
+class StreamingResponse(tornado.httputil.HTTPMessageDelegate):
+
+    def __init__(self, on_chunk):
+        self.on_chunk = on_chunk
+        self.code     = None
+        self.reason   = None
+
+
+    def headers_received(self, start_line, headers):
+        self.code, self.reason = start_line.code, start_line.reason
+
+
+    def data_received(self, chunk):
+        if self.code == 200:
+            return self.on_chunk(chunk)
+
+
+
+class HTTPStream(object):
+    """
+    GETs url and hands the body to on_chunk as it arrives. If on_chunk
+    returns a Future, nothing more is read off the socket until it
+    resolves, so a reader that's behind pushes back on the sender instead
+    of buffering without limit. (AsyncHTTPClient's streaming_callback can't
+    do that, and gives up after max_body_size.)
+
+    start() resolves when the response ends, raising HTTPError if it wasn't
+    a 200. close() hangs up.
+    """
+
+    def __init__(self, url, on_chunk, headers=None, connect_timeout=10):
+        self.url             = url
+        self.on_chunk        = on_chunk
+        self.headers         = headers or dict()
+        self.connect_timeout = connect_timeout
+        self.stream          = None
+        self.closed          = False
+
+
+    @tornado.gen.coroutine
+    def start(self):
+        parts = urlsplit(self.url)
+        ssl = parts.scheme == 'https'
+        port = parts.port or (443 if ssl else 80)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        address = '%s:%d' % (parts.hostname, port)
+        if address not in connecting:
+            connecting[address] = tornado.locks.Semaphore(MAX_CONNECTING)
+        deadline = timedelta(seconds=self.connect_timeout)
+        with (yield connecting[address].acquire(deadline)):
+            self.stream = yield tornado.gen.with_timeout(
+                deadline,
+                tornado.tcpclient.TCPClient().connect(
+                    parts.hostname, port, ssl_options=dict() if ssl else None) )
+        if self.closed:
+            self.stream.close()
+            return
+
+        conn = tornado.http1connection.HTTP1Connection(
+            self.stream, True,
+            tornado.http1connection.HTTP1ConnectionParameters(
+                no_keep_alive=True, decompress=True, max_body_size=sys.maxsize) )
+        headers = tornado.httputil.HTTPHeaders(self.headers)
+        headers.setdefault('Host', parts.netloc)
+        headers.setdefault('Accept-Encoding', 'gzip')
+        headers['Connection'] = 'close'
+        conn.write_headers(
+            tornado.httputil.RequestStartLine('GET', path, 'HTTP/1.1'), headers)
+        conn.finish()
+
+        response = StreamingResponse(self.on_chunk)
+        try:
+            yield conn.read_response(response)
+        except tornado.iostream.StreamClosedError:
+            pass
+        if response.code is not None and response.code != 200:
+            raise HTTPError(response.code, response.reason)
+
+
+    def close(self):
+        self.closed = True
+        if self.stream is not None:
+            self.stream.close()
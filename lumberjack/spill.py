@@ -0,0 +1,350 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" On-disk history for a LumberBuffer, far longer than fits in memory """
+from __future__ import absolute_import
+
+import os
+import time
+import mmap
+import errno
+import random
+import struct
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+from .util import UINT64
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX   = '.idx'
+EPOCH_FILENAME = 'epoch'
+
+# every INDEX_EVERY'th line gets an index entry of (seq, byte offset, time)
+INDEX_EVERY  = 256
+INDEX_RECORD = struct.Struct('!QQd')
+
+# disk reads happen here, never on the ioloop
+executor = ThreadPoolExecutor(max_workers=2)
+
+
+class Segment(object):
+    """
+    One append-only file of newline terminated lines, numbered from
+    first_seq, plus a sparse index of where every INDEX_EVERY'th line
+    starts and when it was written. The index is kept in memory and
+    appended to a sidecar file so it survives restarts.
+    """
+
+    def __init__(self, directory, first_seq):
+        self.first_seq  = first_seq
+        self.next_seq   = first_seq
+        self.path       = os.path.join(directory, '%020d%s' % (first_seq, SEGMENT_SUFFIX))
+        self.index_path = self.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        self.seqs       = array(UINT64)
+        self.offsets    = array(UINT64)
+        self.times      = array('d')
+        self.size       = 0
+        self.fd         = None
+        self.index_fd   = None
+        self.last_write = time.time()
+
+
+    @staticmethod
+    def create(directory, first_seq):
+        segment = Segment(directory, first_seq)
+        segment.open()
+        return segment
+
+
+    @staticmethod
+    def load(directory, filename):
+        """A segment left behind by an earlier run"""
+
+        segment = Segment(directory, int(filename[:-len(SEGMENT_SUFFIX)]))
+        try:
+            with open(segment.index_path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = b''
+        for pos in range(0, len(data) - INDEX_RECORD.size + 1, INDEX_RECORD.size):
+            seq, offset, when = INDEX_RECORD.unpack_from(data, pos)
+            segment.seqs.append(seq)
+            segment.offsets.append(offset)
+            segment.times.append(when)
+
+        st = os.stat(segment.path)
+        segment.size, segment.last_write = st.st_size, st.st_mtime
+
+        # count the lines written after the last index entry
+        if segment.seqs:
+            segment.next_seq = segment.seqs[-1]
+            start = segment.offsets[-1]
+        else:
+            start = 0
+        with open(segment.path, 'rb') as f:
+            f.seek(start)
+            segment.next_seq += f.read().count(b'\n')
+        return segment
+
+
+    def open(self):
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self.fd       = os.open(self.path, flags, 0o644)
+        self.index_fd = os.open(self.index_path, flags, 0o644)
+
+
+    def close(self):
+        for fd in (self.fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = self.index_fd = None
+
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+    def append(self, lines, now):
+        """Write encoded lines in one go and index the ones that fall due"""
+
+        index = list()
+        offset = self.size
+        seq = self.next_seq
+        for line in lines:
+            if (seq - self.first_seq) % INDEX_EVERY == 0:
+                self.seqs.append(seq)
+                self.offsets.append(offset)
+                self.times.append(now)
+                index.append(INDEX_RECORD.pack(seq, offset, now))
+            offset += len(line) + 1
+            seq += 1
+
+        data = b'\n'.join(lines) + b'\n'
+        os.write(self.fd, data)
+        if index:
+            os.write(self.index_fd, b''.join(index))
+        self.size += len(data)
+        self.next_seq = seq
+        self.last_write = now
+
+
+    def read(self, seq, count):
+        """Up to count lines starting at seq, read through a memory map"""
+
+        i = bisect_right(self.seqs, seq) - 1
+        if i < 0:
+            return []
+        current, offset = self.seqs[i], self.offsets[i]
+
+        lines = list()
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return lines
+            view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                while current < seq:
+                    offset = view.find(b'\n', offset) + 1
+                    if offset == 0:
+                        return lines
+                    current += 1
+                while len(lines) < count:
+                    end = view.find(b'\n', offset)
+                    if end < 0:
+                        break
+                    lines.append(view[offset:end].decode('utf-8', 'replace'))
+                    offset = end + 1
+            finally:
+                view.close()
+        return lines
+
+
+    def seq_at(self, when):
+        """Last indexed seq written at or before unix time `when`"""
+        i = bisect_right(self.times, when) - 1
+        return self.seqs[max(i, 0)] if self.seqs else self.first_seq
+
+
+
+class SegmentStore(object):
+    """
+    Keeps every line appended to a LumberBuffer in a directory of segment
+    files, rolling to a new segment every segment_bytes and deleting the
+    oldest ones once the store passes max_bytes or they're older than
+    max_age seconds. Reads go through read_async so the ioloop never waits
+    on the disk.
+
+    A readonly store reads a directory another process's store is writing:
+    appends are ignored, and every read first picks up whatever segments
+    have been written or expired since the last one.
+    """
+
+    def __init__(self, directory, segment_bytes=64*1024*1024,
+                 max_bytes=1024*1024*1024, max_age=0, readonly=False):
+        self.directory     = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes     = max_bytes
+        self.max_age       = max_age
+        self.readonly      = readonly
+        self.segments      = list()
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(SEGMENT_SUFFIX):
+                self.segments.append(Segment.load(directory, filename))
+        self.next_seq = self.segments[-1].next_seq if self.segments else 0
+        self.epoch = self._load_epoch()
+        if self.segments and not readonly:
+            self.segments[-1].open()
+            log.info('Loaded %d history segments from %s, seq %d to %d',
+                     len(self.segments), directory,
+                     self.first_seq, self.next_seq)
+
+
+    def _load_epoch(self):
+        """
+        The numbering the segments' seqs belong to. It lasts as long as
+        they do: with no segments, numbering starts over at 0 in a new one.
+        A readonly store that finds none gets its epoch from its writer.
+        """
+        path = os.path.join(self.directory, EPOCH_FILENAME)
+        if self.segments or self.readonly:
+            try:
+                with open(path) as f:
+                    return f.read().strip() or None
+            except IOError:
+                if self.readonly:
+                    return None
+        epoch = '%x' % random.getrandbits(32)
+        with open(path, 'w') as f:
+            f.write(epoch)
+        return epoch
+
+
+    @property
+    def first_seq(self):
+        return self.segments[0].first_seq if self.segments else self.next_seq
+
+
+    @property
+    def nbytes(self):
+        return sum(segment.size for segment in self.segments)
+
+
+    def append(self, lines):
+        if not lines or self.readonly:
+            return
+        if not self.segments or self.segments[-1].size >= self.segment_bytes:
+            self._roll()
+        self.segments[-1].append([ line.encode('utf-8') for line in lines ],
+                                 time.time())
+        self.next_seq += len(lines)
+
+
+    def _roll(self):
+        if self.segments:
+            self.segments[-1].close()
+        self.segments.append(Segment.create(self.directory, self.next_seq))
+        self.expire()
+
+
+    def expire(self):
+        """Delete the oldest segments past the size or age limit"""
+        oldest_allowed = time.time() - self.max_age
+        total = self.nbytes
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if total <= self.max_bytes and \
+               not (self.max_age and oldest.last_write < oldest_allowed):
+                break
+            log.debug('Expiring history segment %s', oldest.path)
+            total -= oldest.size
+            oldest.remove()
+            self.segments.pop(0)
+
+
+    def refresh(self):
+        """Catch up with segments written and expired by the writing store"""
+        loaded = dict( (os.path.basename(segment.path), segment)
+                       for segment in self.segments )
+        filenames = sorted( filename for filename in os.listdir(self.directory)
+                            if filename.endswith(SEGMENT_SUFFIX) )
+        segments = list()
+        for filename in filenames:
+            segment = loaded.get(filename)
+            if segment is None or filename == filenames[-1]:
+                # the last one is still growing
+                try:
+                    segment = Segment.load(self.directory, filename)
+                except (IOError, OSError):
+                    continue # expired while we looked
+            segments.append(segment)
+        self.segments = segments
+        if segments:
+            self.next_seq = segments[-1].next_seq
+
+
+    def read(self, seq, count):
+        """(seq of the first line returned, up to count lines from seq on)"""
+
+        if self.readonly:
+            self.refresh()
+        seq = max(seq, self.first_seq)
+        segments = list(self.segments)
+        firsts = [ segment.first_seq for segment in segments ]
+        lines = list()
+        i = max(bisect_right(firsts, seq) - 1, 0)
+        for segment in segments[i:]:
+            if len(lines) >= count:
+                break
+            try:
+                lines.extend(segment.read(seq + len(lines), count - len(lines)))
+            except (IOError, OSError) as e:
+                # expired out from under us
+                log.debug("Couldn't read history segment %s: %s", segment.path, e)
+                if lines:
+                    break
+                seq = segment.next_seq
+        return seq, lines
+
+
+    def seq_at(self, when):
+        """Roughly the first seq written after unix time `when`"""
+        if self.readonly:
+            self.refresh()
+        segments = list(self.segments)
+        lasts = [ segment.last_write for segment in segments ]
+        i = bisect_left(lasts, when)
+        if i >= len(segments):
+            return self.next_seq
+        return segments[i].seq_at(when)
+
+
+    def read_async(self, seq, count):
+        return executor.submit(self.read, seq, count)
+
+
+    def read_after_async(self, when, count):
+        return executor.submit(lambda: self.read(self.seq_at(when), count))
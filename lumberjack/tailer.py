@@ -0,0 +1,342 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" Follow many files from inside one process, instead of a `tail -f` each """
+from __future__ import absolute_import
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+log = logging.getLogger(__name__)
+
+import tornado.ioloop
+
+READ_SIZE         = 64 * 1024    # block size for the backlog scan
+MAX_READ_PER_PASS = 1024 * 1024  # yield to the ioloop after this many bytes
+
+# with inotify running, polling is only a safety net for missed events
+INOTIFY_POLL_FACTOR = 10
+
+# from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_NONBLOCK    = 0o0004000
+IN_CLOEXEC     = 0o2000000
+
+DIRECTORY_MASK = ( IN_MODIFY | IN_ATTRIB | IN_CREATE | IN_DELETE |
+                   IN_MOVED_FROM | IN_MOVED_TO )
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+if hasattr(os, 'pread'):
+    _pread = os.pread
+else:
+    def _pread(fd, length, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+
+def tail_offset(fd, size, lines, block_size=READ_SIZE):
+    """
+    Byte offset where the last `lines` lines of fd begin. Scans backwards
+    from `size` a block at a time, so only the tail of the file gets read.
+    """
+    if lines <= 0 or size <= 0:
+        return size
+
+    # a trailing newline ends the last line; it doesn't start a new one
+    need = lines + 1 if _pread(fd, 1, size - 1) == b'\n' else lines
+
+    end = size
+    while end > 0:
+        start = max(0, end - block_size)
+        block = _pread(fd, end - start, start)
+        idx = len(block)
+        while True:
+            idx = block.rfind(b'\n', 0, idx)
+            if idx < 0:
+                break
+            need -= 1
+            if need == 0:
+                return start + idx + 1
+        end = start
+
+    return 0
+
+
+
+class Inotify(object):
+    """ Minimal ctypes binding to the linux inotify API """
+
+    def __init__(self):
+        libname = ctypes.util.find_library('c')
+        if libname is None:
+            raise OSError(errno.ENOSYS, 'No libc found')
+        self.libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'No inotify support in libc')
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8')
+                                         if not isinstance(path, bytes) else path,
+                                         mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+
+    def read_events(self):
+        """Yields (watch descriptor, mask, name) for every queued event"""
+
+        while True:
+            try:
+                buf = os.read(self.fd, READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not buf:
+                return
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, namelen = _EVENT_HEADER.unpack_from(buf, pos)
+                pos += _EVENT_HEADER.size
+                name = buf[pos:pos+namelen].rstrip(b'\0').decode('utf-8', 'replace')
+                pos += namelen
+                yield wd, mask, name
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+class TailedFile(object):
+    """
+    One followed file. Remembers which inode it has open and how far into it
+    it has read, so that rotation (the path pointing at a new inode) and
+    copytruncate (the file shrinking under us) can be told apart.
+    """
+
+    def __init__(self, path, callback):
+        self.path     = path
+        self.callback = callback
+        self.fd       = None
+        self.ident    = None  # (st_dev, st_ino) of what's open
+        self.offset   = 0
+
+
+    def open(self, backlog=0, from_start=False):
+        """
+        Open the file at self.path. Returns False if it doesn't exist yet.
+        Unless from_start is set, reading begins `backlog` lines from the end.
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                log.info('Waiting for %s to appear', self.path)
+                return False
+            raise
+
+        st = os.fstat(fd)
+        self.fd, self.ident = fd, (st.st_dev, st.st_ino)
+        if from_start:
+            self.offset = 0
+        else:
+            self.offset = tail_offset(fd, st.st_size, backlog)
+        log.debug('Following %s from byte %d', self.path, self.offset)
+        return True
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd, self.ident = None, None
+
+
+    def read(self):
+        """
+        Hand everything appended since the last read to the callback in one
+        chunk. Returns True if it stopped early and there's more to read.
+        """
+        size = os.fstat(self.fd).st_size
+        if size < self.offset:
+            log.info('%s was truncated, reading from the start', self.path)
+            self.offset = 0
+
+        pending = min(size - self.offset, MAX_READ_PER_PASS)
+        if pending <= 0:
+            return False
+
+        data = _pread(self.fd, pending, self.offset)
+        self.offset += len(data)
+        if data:
+            self.callback(data)
+        return self.offset < size
+
+
+    def check(self):
+        """Read new data and follow the path if it was rotated."""
+
+        if self.fd is None:
+            if not self.open(from_start=True):
+                return False
+
+        more = self.read()
+        if more:
+            return True
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # rotated away and not recreated yet; keep the old inode open
+            return False
+
+        if (st.st_dev, st.st_ino) != self.ident:
+            log.info('%s was rotated, following the new file', self.path)
+            # drain whatever the writer got into the old file before it moved
+            while self.read():
+                pass
+            self.close()
+            if self.open(from_start=True):
+                return self.read()
+        return False
+
+
+
+class Tailer(object):
+    """
+    Follows any number of files from the ioloop. Uses one inotify descriptor
+    with a watch per parent directory where available, and falls back to
+    stat polling everywhere else.
+
+    tailer = Tailer()
+    tailer.watch('/var/log/messages', my_callback, backlog=200)
+    tailer.start()
+    """
+
+    def __init__(self, io_loop=None, poll_interval=1.0, use_inotify=True):
+        self.io_loop       = tornado.ioloop.IOLoop.instance() if io_loop is None else io_loop
+        self.poll_interval = poll_interval
+        self.files         = dict()  # abspath -> TailedFile
+        self.directories   = dict()  # watch descriptor -> directory
+        self.poller        = None
+        self.inotify       = None
+
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                log.warning('inotify unavailable (%s), falling back to polling', e)
+
+
+    def watch(self, path, callback, backlog=0):
+        path = os.path.abspath(path)
+        if path in self.files:
+            log.warning('Already following %s', path)
+            return self.files[path]
+
+        tailed = self.files[path] = TailedFile(path, callback)
+        if tailed.open(backlog=backlog):
+            self._check(tailed)
+
+        if self.inotify is not None:
+            directory = os.path.dirname(path)
+            if directory not in self.directories.values():
+                try:
+                    wd = self.inotify.add_watch(directory, DIRECTORY_MASK)
+                    self.directories[wd] = directory
+                except OSError as e:
+                    log.warning("Can't watch %s, relying on polling: %s",
+                                directory, e)
+        return tailed
+
+
+    def start(self):
+        interval = self.poll_interval
+        if self.inotify is not None:
+            self.io_loop.add_handler(self.inotify.fd, self._on_inotify,
+                                     tornado.ioloop.IOLoop.READ)
+            interval *= INOTIFY_POLL_FACTOR
+
+        self.poller = tornado.ioloop.PeriodicCallback(
+            self.poll,
+            interval * 1000, # in ms
+            io_loop=self.io_loop
+            )
+        self.poller.start()
+        return self
+
+
+    def stop(self):
+        if self.poller is not None:
+            self.poller.stop()
+        if self.inotify is not None:
+            self.io_loop.remove_handler(self.inotify.fd)
+            self.inotify.close()
+        for tailed in self.files.values():
+            tailed.close()
+
+
+    def poll(self):
+        for tailed in self.files.values():
+            self._check(tailed)
+
+
+    def _check(self, tailed):
+        try:
+            more = tailed.check()
+        except (OSError, IOError) as e:
+            log.error('Error reading %s: %s', tailed.path, e)
+            return
+        if more:
+            self.io_loop.add_callback(self._check, tailed)
+
+
+    def _on_inotify(self, fd, events):
+        touched = set()
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                log.warning('inotify queue overflowed, polling everything')
+                touched.update(self.files.values())
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            tailed = self.files.get(os.path.join(directory, name))
+            if tailed is not None:
+                touched.add(tailed)
+
+        for tailed in touched:
+            self._check(tailed)
@@ -0,0 +1,365 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+""" When each buffered line was written, for picking out a time range """
+from __future__ import absolute_import
+
+import re
+import time
+import calendar
+import logging
+from array import array
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FORMATS = 'iso,syslog'
+
+# the built in formats are matched at the start of a line, after any
+# spaces or an opening bracket. Anything else is a strptime format.
+ISO    = re.compile(r'[\[ ]*(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d+))?)?'
+                    r' ?(Z|[+-]\d\d:?\d\d)?')
+SYSLOG = re.compile(r'[\[ ]*([A-Z][a-z]{2}) ([ \d]\d) (\d\d):(\d\d):(\d\d)')
+EPOCH  = re.compile(r'[\[ ]*(\d{10}(?:\.\d+)?)(?![\d:])')
+
+MONTHS = dict( (name, i + 1) for i, name in enumerate(
+    'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()) )
+
+# (year, month, day, hour, offset) -> unix time the hour started. Lines
+# come in time order, so nearly every one hits the same hour as the last.
+MAX_CACHED_HOURS = 4096
+_hours = dict()
+
+
+def hour_start(year, month, day, hour, offset=None):
+    """
+    Unix time of the start of an hour, local time if offset (seconds east
+    of UTC) is None
+    """
+    key = (year, month, day, hour, offset)
+    try:
+        return _hours[key]
+    except KeyError:
+        pass
+    if offset is None:
+        start = time.mktime( (year, month, day, hour, 0, 0, 0, 0, -1) )
+    else:
+        start = calendar.timegm( (year, month, day, hour, 0, 0) ) - offset
+    if len(_hours) >= MAX_CACHED_HOURS:
+        _hours.clear()
+    _hours[key] = start
+    return start
+
+
+def utc_offset(zone):
+    """Seconds east of UTC for Z, +hh:mm or +hhmm; None for no zone"""
+    if not zone:
+        return None
+    if zone == 'Z':
+        return 0
+    sign = -1 if zone[0] == '-' else 1
+    digits = zone[1:].replace(':', '')
+    return sign * (int(digits[:2]) * 3600 + int(digits[2:]) * 60)
+
+
+def parse_iso(line, now=None):
+    match = ISO.match(line)
+    if match is None:
+        return None
+    y, mo, d, h, mi, s, frac, zone = match.groups()
+    try:
+        when = hour_start(int(y), int(mo), int(d), int(h), utc_offset(zone))
+    except (ValueError, OverflowError):
+        return None
+    when += int(mi) * 60 + int(s or 0)
+    if frac:
+        when += float('0.' + frac)
+    return when
+
+
+def parse_syslog(line, now=None):
+    """'May  1 14:02:03', which leaves out the year: it's whichever puts the
+    line in the past, give or take a day"""
+    match = SYSLOG.match(line)
+    if match is None or match.group(1) not in MONTHS:
+        return None
+    mon, d, h, mi, s = match.groups()
+    now = time.time() if now is None else now
+    year = time.localtime(now).tm_year
+    try:
+        when = hour_start(year, MONTHS[mon], int(d), int(h))
+        if when > now + 86400:
+            when = hour_start(year - 1, MONTHS[mon], int(d), int(h))
+    except (ValueError, OverflowError):
+        return None
+    return when + int(mi) * 60 + int(s)
+
+
+def parse_epoch(line, now=None):
+    match = EPOCH.match(line)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+BUILTIN_FORMATS = dict(iso=parse_iso, syslog=parse_syslog, epoch=parse_epoch)
+
+
+# what each strptime directive can match, for finding where a time ends
+DIRECTIVES = dict(
+    Y=r'\d{4}', G=r'\d{4}', y=r'\d\d', m=r'\d{1,2}', d=r'\d{1,2}',
+    H=r'\d{1,2}', I=r'\d{1,2}', M=r'\d{1,2}', S=r'\d{1,2}', f=r'\d{1,6}',
+    j=r'\d{1,3}', U=r'\d{1,2}', W=r'\d{1,2}', V=r'\d{1,2}', w=r'\d', u=r'\d',
+    b=r'[^\W\d_]+', B=r'[^\W\d_]+', a=r'[^\W\d_]+', A=r'[^\W\d_]+',
+    p=r'[^\W\d_]+', Z=r'[^\W\d]\w*',
+    z=r'(?P<zone>Z|[+-]\d\d:?\d\d)' )
+DIRECTIVES['%'] = '%'
+
+
+def strptime_pattern(fmt):
+    """
+    A regex matching what fmt could format a time as. Whitespace matches
+    any run of whitespace, as it does for strptime.
+    """
+    pattern, i = list(), 0
+    while i < len(fmt):
+        c = fmt[i]
+        if c == '%':
+            directive = fmt[i + 1:i + 2]
+            if directive not in DIRECTIVES or (directive == 'z' and
+                                               'z' in fmt[:i].replace('%%', '')):
+                raise ValueError('Can\'t find times by %%%s in %s' % (directive, fmt))
+            pattern.append(DIRECTIVES[directive])
+            i += 2
+        else:
+            pattern.append(r'\s+' if c.isspace() else re.escape(c))
+            i += 1
+    return re.compile(''.join(pattern))
+
+
+def strptime_parser(fmt):
+    """
+    A parser for lines that start with a time in strptime format fmt.
+    Raises ValueError for a format it can't find the end of a time in.
+    """
+    pattern = strptime_pattern(fmt)
+    def parse(line, now=None):
+        match = pattern.match(line)
+        if match is None:
+            return None
+        text = match.group(0)
+        zone = match.groupdict().get('zone')
+        if zone is not None:
+            # older strptimes only take +hhmm
+            start, end = match.span('zone')
+            zone = '+0000' if zone == 'Z' else zone.replace(':', '')
+            text = text[:start] + zone + text[end:]
+        try:
+            when = datetime.strptime(text, fmt)
+        except ValueError:
+            return None
+        if when.tzinfo is not None:
+            return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+        return time.mktime(when.timetuple()) + when.microsecond / 1e6
+    check_strptime_parser(fmt, parse)
+    return parse
+
+
+def check_strptime_parser(fmt, parse):
+    """
+    Make sure parse finds the whole time in lines starting with fmt, as
+    wide and as narrow as it gets: every month and weekday name, single
+    digit days and hours, more on the line after. Raises ValueError if not.
+    """
+    samples = [ datetime(2024, month, day, hour, 5, 9, 120000)
+                for month in range(1, 13)
+                # hours clear of the small hours clocks change in
+                for day, hour in ((1, 9), (2, 23), (3, 6), (4, 10),
+                                  (5, 7), (6, 11), (7, 8)) ]
+    for sample in samples:
+        text = sample.strftime(fmt.replace('%z', '+0000').replace('%Z', 'UTC'))
+        try:
+            expected = datetime.strptime(text, fmt).strftime(fmt)
+        except ValueError:
+            continue # fmt can't read back its own output; nothing to check
+        when = parse(text + ' 59 more of the line', None)
+        parsed = None if when is None else datetime.fromtimestamp(when)
+        if parsed is None or ( '%z' not in fmt and '%Z' not in fmt and
+                               parsed.strftime(fmt) != expected ):
+            raise ValueError('Can\'t find the whole time in %r, formatted %s'
+                             % (text, fmt))
+
+
+
+class TimestampParser(object):
+    """
+    Finds when a line was written from the time it starts with. formats is
+    a comma separated list of any of iso (2024-05-01T14:02:03.123Z, with
+    or without a zone, T or a space), syslog (May  1 14:02:03), epoch
+    (1714572123.123) and strptime formats, tried in that order until one
+    matches. Times without a zone are local. The last format to match is
+    tried first next time, since a file hardly ever mixes them.
+    """
+
+    def __init__(self, formats=DEFAULT_FORMATS):
+        if isinstance(formats, str):
+            formats = [ f.strip() for f in formats.split(',') if f.strip() ]
+        self.parsers = list()
+        for fmt in formats:
+            if fmt in BUILTIN_FORMATS:
+                self.parsers.append(BUILTIN_FORMATS[fmt])
+            elif '%' in fmt:
+                self.parsers.append(strptime_parser(fmt))
+            else:
+                raise ValueError('Unknown timestamp format: %s' % fmt)
+        self.last = self.parsers[0] if self.parsers else None
+
+
+    def __call__(self, line, now=None):
+        """Unix time line starts with, or None"""
+        if self.last is None:
+            return None
+        when = self.last(line, now)
+        if when is not None:
+            return when
+        for parse in self.parsers:
+            if parse is not self.last:
+                when = parse(line, now)
+                if when is not None:
+                    self.last = parse
+                    return when
+        return None
+
+
+
+def parse_time(value):
+    """
+    A time from a query string: unix seconds, or an ISO 8601 date and time,
+    local unless it has a zone. Raises ValueError for anything else.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    when = parse_iso(value)
+    if when is None:
+        raise ValueError('Not a unix or ISO 8601 time: %s' % value)
+    return when
+
+
+
+class LineTimes(object):
+    """
+    One unix time for each of a buffer's lines, by seq, eight bytes apiece
+    in an array used as a ring. A buffer calls add() with every list of
+    lines it appends, and how many lines it holds afterwards.
+
+    A line's time is whatever the parser finds at its start. Lines without
+    one, like the rest of a stack trace, get the time of the line before.
+    Lines before the first that has one get the time they arrived, lowered
+    to the first parsed time once there is one. Times never go backwards,
+    so seq_at() can binary search them: a line stamped earlier than the one
+    before it gets that one's time.
+    """
+
+    def __init__(self, parser=None, capacity=1024):
+        self.parser    = parser
+        self.times     = array('d', [0.0]) * max(capacity, 1)
+        self.next_seq  = 0
+        self.count     = 0     # lines held
+        self.last      = 0.0   # time of the newest line
+        self.parsed    = False # whether any line's had a time of its own
+        self.arrived   = 0     # lines since the oldest stamped on arrival
+
+
+    def clear(self, seq=0):
+        self.next_seq = seq
+        self.count = self.arrived = 0
+        self.last = 0.0
+        self.parsed = False
+
+
+    def add(self, seq, lines, count, now=None):
+        if seq != self.next_seq:
+            # the buffer started numbering over, say as a replica catching up
+            self.clear(seq)
+        if count > len(self.times):
+            self._grow(count)
+        now = time.time() if now is None else now
+        parser, times, capacity = self.parser, self.times, len(self.times)
+        last = self.last
+        for line in lines:
+            when = parser(line, now) if parser is not None else None
+            if when is None:
+                if not self.parsed:
+                    last = max(last, now)
+                    self.arrived += 1
+            elif not self.parsed:
+                self.parsed = True
+                self._backfill(seq, when)
+                last = when
+            else:
+                last = max(last, when)
+            times[seq % capacity] = last
+            seq += 1
+        self.last = last
+        self.next_seq = seq
+        self.count = count
+
+
+    @property
+    def first_seq(self):
+        return self.next_seq - self.count
+
+
+    def _backfill(self, seq, when):
+        """Lower the arrival times of the lines before seq to when"""
+        times, capacity = self.times, len(self.times)
+        oldest = max(seq - self.arrived, seq - capacity + 1)
+        for s in range(seq - 1, oldest - 1, -1):
+            if times[s % capacity] <= when:
+                break
+            times[s % capacity] = when
+        self.arrived = 0
+
+
+    def _grow(self, count):
+        old, capacity = self.times, len(self.times)
+        start = self.first_seq % capacity
+        ordered = (old[start:] + old[:start])[:self.count]
+        while capacity < count:
+            capacity *= 2
+        self.times = array('d', [0.0]) * capacity
+        offset = self.first_seq % capacity
+        split = min(len(ordered), capacity - offset)
+        self.times[offset:offset + split] = ordered[:split]
+        self.times[:len(ordered) - split] = ordered[split:]
+
+
+    def time_of(self, seq):
+        return self.times[seq % len(self.times)]
+
+
+    def seq_at(self, when, after=False):
+        """
+        The first line stamped at or after when, or strictly after it with
+        after; next_seq if there isn't one
+        """
+        lo, hi = self.first_seq, self.next_seq
+        times, capacity = self.times, len(self.times)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = times[mid % capacity]
+            if t < when or (after and t == when):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
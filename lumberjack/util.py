@@ -12,11 +12,16 @@
 """ Utility functions """
 from __future__ import absolute_import
 
+import sys
 import json
 import datetime
 
 from tornado.escape import url_escape, url_unescape
 
+# array typecode for unsigned 64 bit ints. 'Q' is new in Python 3.3; 'L'
+# is 64 bits on 64 bit unix Python 2
+UINT64 = 'Q' if sys.version_info >= (3, 3) else 'L'
+
 def slug(url):
     """Not at all like django"""
 
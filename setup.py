@@ -9,17 +9,20 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import sys
 from setuptools import setup, find_packages
 
+install_requires = [ 'tornado>=4.3' ]
+if sys.version_info < (3, 2):
+    install_requires.append('futures')
+
 setup(
     name='lumberjack',
     version='0.3.0',
     description='Real time file streaming over HTTP',
     packages=find_packages(exclude=['ez_setup', 'tests', 'tests.*']),
     zip_safe=False,
-    install_requires=[
-        'tornado>=3.0'
-    ],
+    install_requires=install_requires,
     classifiers=[
         "Development Status :: 3 - Alpha"
     ],